@@ -7,11 +7,10 @@ except ImportError:
     print "couldn't import pwd, ignoring"
     pwd = None
 
-from kid_readout.analysis.noise_measurement import load_noise_pkl
 import glob
 import time
 import kid_readout.analysis.timeseries.noise_fit
-from kid_readout.analysis import kid_response
+from kid_readout.analysis import fitter, kid_response, mcfit
 
 def build_simple_archives(pklglob,index_to_id=None):
     pklnames = glob.glob(pklglob)
@@ -32,6 +31,9 @@ def build_simple_archive(pklnames, index_to_id = None, archive_name=None, archiv
         archive_path = os.path.join(os.path.split(os.path.split(pklnames[0])[0])[0],'archive')
     archname = os.path.join(archive_path,('%s.npy' % archive_name))
 
+    # noise_measurement imports the cryostat temperature readers, which need optional packages such as tailer, so it is
+    # imported only when pickles are loaded.
+    from kid_readout.analysis.noise_measurement import load_noise_pkl
     data = []
     for pklname in pklnames:
         pkl = load_noise_pkl(pklname)
@@ -77,21 +79,49 @@ def add_noise_summary(df,device_band=(1,100),amplifier_band=(2e3,10e3), method=n
     return df
 
 def add_noise_fits(df):
-    def add_noise_fit_info(x):
+    """
+    Fit the single-pole noise model to the second PCA eigenvalue spectrum of every row and add the results as columns.
+
+    The spectra with the same number of frequencies are fit together by noise_fit.fit_single_pole_noise_batch(); if a
+    batch fit raises an exception, the spectra in that batch are fit one at a time instead. Rows without spectra, or
+    whose fits fail, have NaN values.
+    """
+    df = df.copy()
+    columns = [('noise_fit_fc', 'fc'), ('noise_fit_fc_err', 'fc_err'), ('noise_fit_device_noise', 'A'),
+               ('noise_fit_device_noise_err', 'A_err'), ('noise_fit_amplifier_noise', 'nw'),
+               ('noise_fit_amplifier_noise_err', 'nw_err')]
+    for column, _ in columns:
+        df[column] = np.nan
+    spectra = {}
+    for position in range(len(df)):
         try:
-            nf = kid_readout.analysis.timeseries.noise_fit.fit_single_pole_noise(x['pca_freq'].iloc[0],
-                                                                  x['pca_eigvals'].iloc[0][1,:],
-                                                                                 max_num_masked=8)
-        except:
-            return x
-        x['noise_fit_fc'] = nf.fc
-        x['noise_fit_fc_err'] = nf.result.params['fc'].stderr
-        x['noise_fit_device_noise'] = nf.A
-        x['noise_fit_device_noise_err'] = nf.result.params['A'].stderr
-        x['noise_fit_amplifier_noise'] = nf.nw
-        x['noise_fit_amplifier_noise_err'] = nf.result.params['nw'].stderr
-        return x
-    return df.groupby(df.index).apply(add_noise_fit_info)
+            frequency = np.asarray(df['pca_freq'].iloc[position], dtype=np.float)
+            S = np.asarray(df['pca_eigvals'].iloc[position][1, :], dtype=np.float)
+        except Exception:
+            continue
+        if frequency.ndim == 1 and frequency.size and S.shape == frequency.shape:
+            spectra.setdefault(frequency.size, []).append((position, frequency, S))
+    for batch in spectra.values():
+        positions, frequency, S = zip(*batch)
+        try:
+            fits = kid_readout.analysis.timeseries.noise_fit.fit_single_pole_noise_batch(np.vstack(frequency),
+                                                                                      np.vstack(S), max_num_masked=8)
+        except Exception:
+            fits = pd.DataFrame([_single_pole_noise_fit_row(f, s) for f, s in zip(frequency, S)],
+                                columns=[parameter for _, parameter in columns])
+        for column, parameter in columns:
+            df.iloc[list(positions), df.columns.get_loc(column)] = fits[parameter].values
+    return df
+
+def _single_pole_noise_fit_row(frequency, S):
+    """Return a dict of the parameters of a noise_fit.fit_single_pole_noise() fit, or an empty dict if it fails."""
+    try:
+        nf = kid_readout.analysis.timeseries.noise_fit.fit_single_pole_noise(frequency, S, max_num_masked=8)
+    except Exception:
+        return {}
+    return {'fc': nf.fc, 'fc_err': nf.result.params['fc'].stderr,
+            'A': nf.A, 'A_err': nf.result.params['A'].stderr,
+            'nw': nf.nw, 'nw_err': nf.result.params['nw'].stderr}
 
 def add_total_mmw_attenuator_turns(df):
     df['mmw_atten_total_turns'] = np.nan
@@ -156,6 +186,58 @@ def build_response_fit_function(make_plots=False, mcmc_length=500, mcmc_burn_in=
         return x
     return fit_response_mcmc
 
+def fit_responses_mcmc(df, by='resonator_id', nwalkers=32, workers=1, chain_directory=None, seed=None, **kwargs):
+    """
+    Fit the response of every group in df using the same data, model, and prior as build_response_fit_function(), but
+    sample all of the posteriors together using mcfit.sample_batch(), which evaluates the log-probability for many
+    walkers at once, stops each chain when it is much longer than its autocorrelation time, and can run in parallel
+    worker processes.
+
+    df: the archive DataFrame.
+    by: the column or columns that identify the measurements of one resonator.
+    nwalkers: the number of walkers for each posterior.
+    workers: the number of worker processes.
+    chain_directory: if not None, the directory to which the chains are written as they are sampled; the chain for the
+      kth group is chain_k.npy.
+    seed: if not None, the seed used for the initial positions and the sampling, for reproducible results.
+    kwargs: passed to mcfit.ensemble_sample(), such as max_steps or burn_in.
+    Returns a new DataFrame with the response columns added.
+    """
+    random = np.random.RandomState(seed)
+    groups = []
+    initials = []
+    args_list = []
+    for key, x in df.groupby(by):
+        x = x.copy()
+        x['f_0_max'] = x.f_0.max()
+        x['frac_f0'] = 1 - x.f_0 / x.f_0_max
+        mask = (x.sweep_primary_load_temperature < 5) & (x.zbd_power > 0)
+        frac_f0 = np.asarray(x[mask]['frac_f0'], dtype=np.float)
+        zbd_power = np.asarray(x[mask]['zbd_power'], dtype=np.float)
+        errors = np.where(zbd_power > 1e-7, zbd_power * 1e-2, 1e-8)
+        # The walkers start in a ball around the least-squares fit, as in MCMCResonator.setup_sampler, so that the
+        # burn-in is short; the prior is the same as that of MCMCKidResponseFitter.
+        fit = fitter.Fitter(frac_f0, zbd_power, model=kid_response.fractional_freq_to_power_model,
+                            guess=kid_response.fractional_freq_to_power_guess, errors=errors)
+        params = fit.result.params
+        names = ['break_point', 'scale']
+        minimum = np.array([params[name].min for name in names])
+        maximum = np.array([params[name].max for name in names])
+        value = np.array([params[name].value for name in names])
+        width = np.array([params[name].stderr for name in names], dtype=np.float)
+        width = np.maximum(np.where(width > 0, width, 0), 1e-2 * np.abs(value))
+        initials.append(np.clip(value + width * random.randn(nwalkers, len(names)), minimum, maximum))
+        args_list.append((frac_f0, zbd_power, errors, minimum, maximum))
+        groups.append(x)
+    results = mcfit.sample_batch(kid_response.response_log_probability, initials, args_list, workers=workers,
+                                 chain_directory=chain_directory, seed=seed, **kwargs)
+    for x, result in zip(groups, results):
+        x['response_break_point'], x['response_scale'] = result.mean
+        x['response_break_point_err'], x['response_scale_err'] = result.std
+        x['reconstructed_power'] = kid_response.fractional_freq_to_power(x['frac_f0'], *result.mean)
+    return pd.concat(groups)
+
+
 def normalize_f0(x):
     x['f_0_max'] = x[x.sweep_primary_package_temperature < 0.3]['f_0'].max()
     x['frac_f0'] = (x['f_0_max'] - x['f_0']) / x['f_0_max']
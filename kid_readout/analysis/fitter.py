@@ -2,6 +2,7 @@ from __future__ import division
 import numpy as np
 import lmfit
 import scipy.optimize
+import scipy.spatial
 
 
 # todo: rewrite these to use params.valuesdict()
@@ -42,7 +43,7 @@ class Fitter(object):
 
     def __init__(self, x_data, y_data,
                  model=line_model, guess=line_guess, functions=default_functions,
-                 mask=None, errors=None, method='leastsq', **minimize_keywords):
+                 mask=None, errors=None, method='leastsq', jacobian=None, **minimize_keywords):
         """
         Arguments:
 
@@ -61,6 +62,10 @@ class Fitter(object):
 
         method: a string representing the fitting method for lmfit.minimize to use.
 
+        jacobian: a function jacobian(params, x) that returns a dictionary that maps parameter names to the partial
+        derivatives of the model with respect to those parameters, evaluated at x; it must include every parameter that
+        varies. If given, the leastsq method uses these derivatives instead of finite differences.
+
         minimize_keywords: keyword arguments that are passed directly to lmfit.minimize.
 
         Returns:
@@ -87,6 +92,9 @@ class Fitter(object):
         self._functions = functions
         self.method = method
         self.minimize_keywords = minimize_keywords
+        self._jacobian = jacobian
+        if jacobian is not None and method == 'leastsq':
+            self.minimize_keywords.setdefault('Dfun', self._residual_jacobian)
         if mask is None:
             self.mask = np.ones(x_data.shape, dtype=np.bool)
         else:
@@ -157,6 +165,21 @@ class Fitter(object):
         return ((self.y_data[self.mask].view('float') - self.model(params)[self.mask].view('float')) /
                 errors.view('float'))
 
+    def _residual_jacobian(self, params):
+        """
+        This is the derivative of the residual with respect to each varying parameter, in the order used by lmfit, with
+        one column per parameter. Complex values are viewed as pairs of floats as in the residual functions.
+        """
+        derivatives = self._jacobian(params, self.x_data)
+        names = [name for name, parameter in params.items() if parameter.vary and not parameter.expr]
+        columns = []
+        for name in names:
+            column = -(derivatives[name] * np.ones(self.x_data.shape, dtype=self.y_data.dtype))[self.mask].view('float')
+            if self.errors is not None:
+                column = column / self.errors[self.mask].view('float')
+            columns.append(column)
+        return np.column_stack(columns)
+
     def model(self, params=None, x=None):
         """
         Return the model evaluated with the given parameters at the given x-values. Defaults are the fit-derived
@@ -182,28 +205,75 @@ class Fitter(object):
         gradient = (y1 - y) / dx
         return gradient
 
-    def inverse(self, y, params=None, guess=None):
+    def inverse(self, y, params=None, guess=None, table_size=None, max_iterations=20, tolerance=1e-10):
         """
-        Find the modeled x-values that correspond to the given y-values.
-        """
-        if params is None:
-            params = self.result.params
+        Find the modeled x-values that correspond to the given y-values, which can be an array of any shape.
 
-        def resid(x, y):
-            return np.abs(y - self._model(params, x))
+        Each x-value minimizes abs(y - model(x)). Unless guess is given, the initial values come from the nearest
+        point in a table of the model evaluated on a dense grid spanning the x-data, and all values are then refined
+        together using Gauss-Newton iteration with derivatives from finite differences. The table cannot locate values
+        beyond the ends of the x-data, so the initial value of each y-value closest to an end of the table is instead
+        found separately with scipy.optimize.fsolve(), starting from that end, which allows the inverse to extrapolate.
 
-        isscalar = np.isscalar(y)
-        if isscalar:
-            y = np.array([y])
+        guess: None, or a scalar or array of initial x-values that broadcasts to the shape of y.
+
+        table_size: the number of points in the lookup table; the default is ten times the number of data points, and
+        at least 1000.
 
-        def _find_inverse(y):
-            if guess is None:
-                x0 = self.x_data[np.argmin(np.abs(y - self.y_data))]
-            else:
-                x0 = guess
-            return scipy.optimize.fsolve(resid, x0, args=(y,))
+        max_iterations: the maximum number of Gauss-Newton iterations.
 
-        result = np.vectorize(_find_inverse)(y)
+        tolerance: iteration stops when every step is smaller than this times the span of the x-data.
+        """
+        if params is None:
+            params = self.result.params
+        isscalar = np.isscalar(y)
+        y = np.asarray(y)
+        shape = y.shape
+        y = y.ravel()
+        x_min = self.x_data.min()
+        x_max = self.x_data.max()
+        span = x_max - x_min
+        if table_size is None:
+            table_size = max(1000, 10 * self.x_data.size)
+        spacing = span / (table_size - 1)
+        if guess is None:
+            x_table = np.linspace(x_min, x_max, table_size)
+            tree = scipy.spatial.cKDTree(self._as_points(self._model(params, x_table)))
+            distance, index = tree.query(self._as_points(y))
+            x = x_table[index]
+            # The initial value is within about one grid spacing of the answer, so limit the steps to keep the
+            # iteration on the same part of the curve.
+            max_step = spacing
+            at_end = (index == 0) | (index == table_size - 1)
+        else:
+            x = (np.asarray(guess, dtype=np.float) * np.ones(shape)).ravel()
+            max_step = span
+            at_end = np.zeros(x.size, dtype=np.bool)
+        for i in np.flatnonzero(at_end):
+            x[i] = scipy.optimize.fsolve(lambda x0: np.abs(y[i] - self._model(params, x0)), x[i])[0]
+        dx = span * 1e-9
+        # Only the values that have not converged are updated in each iteration.
+        active = np.arange(x.size)
+        for iteration in range(max_iterations):
+            model = self._model(params, x[active])
+            derivative = (self._model(params, x[active] + dx) - model) / dx
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = np.real(np.conj(y[active] - model) * derivative) / np.abs(derivative) ** 2
+            step = np.clip(np.where(np.isfinite(step), step, 0), -max_step, max_step)
+            x[active] += step
+            active = active[np.abs(step) >= tolerance * span]
+            if not active.size:
+                break
+        x = x.reshape(shape)
         if isscalar:
-            result = result[0]
-        return result
+            x = x[()]
+        return x
+
+    @staticmethod
+    def _as_points(values):
+        """Return the given real or complex values as an array of points with shape (values.size, dimensions)."""
+        values = np.asarray(values).ravel()
+        if np.iscomplexobj(values):
+            return np.column_stack((values.real, values.imag))
+        else:
+            return values[:, None]
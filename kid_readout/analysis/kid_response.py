@@ -26,6 +26,19 @@ def fractional_freq_to_power_guess(x, y):
     return params
 
 
+def response_log_probability(positions, x, y, errors, minimum, maximum):
+    """
+    Return the log-probability of the response model for an array of (break_point, scale) positions with shape
+    (walkers, 2), using a uniform prior between the given minimum and maximum arrays and the same Gaussian likelihood
+    as mcfit.MCMCFitter; this is the vectorized form used by mcfit.ensemble_sample().
+    """
+    model = fractional_freq_to_power(x[None, :], positions[:, 0, None], positions[:, 1, None])
+    log_likelihood = (-np.sum(np.log(np.abs(errors)))
+                      - 0.5 * np.sum(np.abs((y[None, :] - model) / errors[None, :]) ** 2, axis=1))
+    in_prior = np.all((positions >= minimum) & (positions <= maximum), axis=1)
+    return np.where(in_prior, log_likelihood, -np.inf)
+
+
 class MCMCKidResponseFitter(mcfit.MCMCFitter):
 
     def __init__(self, x_data, y_data,
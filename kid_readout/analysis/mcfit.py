@@ -1,7 +1,10 @@
+import os
+import multiprocessing
+from collections import namedtuple
+
 import numpy as np
 from scipy.misc import logsumexp
 import emcee
-import corner
 import lmfit
 from kid_readout.analysis.fitter import Fitter
 from kid_readout.analysis.resonator.legacy_resonator import Resonator
@@ -193,3 +196,167 @@ class MCMCResonator(Resonator,MCMCFitter):
             if value > max or value < min:
                 return -np.inf
         return 0.
+
+
+# Batch sampling of independent posteriors.
+
+# chain has shape (steps, walkers, dimensions) and contains every step that was taken; samples contains the steps after
+# burn-in flattened to shape (samples, dimensions).
+MCMCResult = namedtuple('MCMCResult', field_names=['chain', 'samples', 'mean', 'std', 'autocorrelation_time',
+                                                   'acceptance_fraction', 'converged'])
+
+
+def ensemble_sample(log_probability, initial, args=(), max_steps=5000, burn_in=None, check_interval=100,
+                    autocorrelation_factor=50, chain_filename=None, stretch=2, seed=None):
+    """
+    Sample a posterior using the affine-invariant ensemble sampler of Goodman and Weare (2010) with the stretch move,
+    which is the algorithm of emcee.EnsembleSampler, evaluating the log-probability for half of the walkers in each call.
+
+    log_probability: a function log_probability(positions, *args) that takes an array of shape (walkers, dimensions) and
+    returns an array of shape (walkers,) containing the log-probability of each position, which is -inf outside the
+    prior; to use sample_batch() with worker processes, it must be defined at module level.
+
+    initial: an array of initial positions with shape (walkers, dimensions); the number of walkers must be even.
+
+    args: additional arguments passed to log_probability.
+
+    max_steps: the maximum number of steps to take.
+
+    burn_in: the number of steps to discard; None means the first half of the chain, which is also the part that is
+    excluded from the estimates of the autocorrelation time.
+
+    check_interval: the number of steps between estimates of the autocorrelation time.
+
+    autocorrelation_factor: sampling stops when the chain is longer than this many times the largest autocorrelation time
+    and the estimate changed by less than one percent since the previous check.
+
+    chain_filename: if not None, the chain is written to a .npy file at this path as it is sampled; the file is created
+    with max_steps rows that are NaN until they are written, and it is flushed after each check.
+
+    stretch: the scale parameter of the stretch move.
+
+    seed: the seed for the random number generator; None means use a random seed.
+
+    Returns an MCMCResult.
+    """
+    random = np.random.RandomState(seed)
+    positions = np.array(initial, dtype=np.float)
+    walkers, dimensions = positions.shape
+    if walkers % 2:
+        raise ValueError("The number of walkers must be even.")
+    if chain_filename is None:
+        chain = np.empty((max_steps, walkers, dimensions))
+    else:
+        chain = np.lib.format.open_memmap(chain_filename, mode='w+', dtype=np.float,
+                                          shape=(max_steps, walkers, dimensions))
+    chain[:] = np.nan
+    current = _finite_or_minus_infinity(log_probability(positions, *args))
+    halves = (np.arange(walkers // 2), np.arange(walkers // 2, walkers))
+    accepted = np.zeros(walkers)
+    previous_time = np.inf
+    converged = False
+    steps = 0
+    while steps < max_steps and not converged:
+        for active, complement in (halves, halves[::-1]):
+            z = ((stretch - 1) * random.rand(active.size) + 1) ** 2 / stretch
+            partners = positions[complement[random.randint(complement.size, size=active.size)]]
+            proposal = partners + z[:, None] * (positions[active] - partners)
+            proposed = _finite_or_minus_infinity(log_probability(proposal, *args))
+            # A walker that starts outside the prior accepts any proposal inside it.
+            with np.errstate(invalid='ignore'):
+                accept = np.log(random.rand(active.size)) < ((dimensions - 1) * np.log(z) + proposed -
+                                                             current[active])
+            positions[active[accept]] = proposal[accept]
+            current[active[accept]] = proposed[accept]
+            accepted[active[accept]] += 1
+        chain[steps] = positions
+        steps += 1
+        if steps % check_interval == 0 or steps == max_steps:
+            if chain_filename is not None:
+                chain.flush()
+            longest = autocorrelation_time(chain[steps // 2:steps]).max()
+            converged = (steps > autocorrelation_factor * longest and
+                         np.abs(previous_time - longest) < 0.01 * longest)
+            previous_time = longest
+    if burn_in is None:
+        burn_in = steps // 2
+    samples = np.array(chain[burn_in:steps]).reshape((-1, dimensions))
+    return MCMCResult(chain=chain[:steps], samples=samples, mean=samples.mean(axis=0), std=samples.std(axis=0),
+                      autocorrelation_time=autocorrelation_time(chain[steps // 2:steps]),
+                      acceptance_fraction=accepted / steps, converged=converged)
+
+
+def _finite_or_minus_infinity(log_probability):
+    """Return the given log-probability values as floats with NaN replaced by -inf, so that they are never accepted."""
+    log_probability = np.array(log_probability, dtype=np.float)
+    log_probability[np.isnan(log_probability)] = -np.inf
+    return log_probability
+
+
+def sample_batch(log_probability, initials, args_list, workers=1, chain_directory=None, seed=None, **kwargs):
+    """
+    Sample many independent posteriors using ensemble_sample(), optionally in parallel worker processes.
+
+    log_probability: a function with the signature described in ensemble_sample(); if workers > 1, it must be defined
+    at module level so that it can be pickled.
+
+    initials: a sequence of arrays of initial positions, one for each posterior.
+
+    args_list: a sequence of tuples of additional arguments to log_probability, one for each posterior.
+
+    workers: the number of worker processes; if 1, the posteriors are sampled in this process.
+
+    chain_directory: if not None, the chain for posterior number k is written incrementally to chain_k.npy in this
+    directory, which must exist.
+
+    seed: if not None, posterior number k is sampled with seed + k.
+
+    kwargs: passed to ensemble_sample().
+
+    Returns a list of MCMCResult, in the order of initials; the chains of the results are in memory, even if they were
+    also written to files.
+    """
+    tasks = []
+    for index, (initial, args) in enumerate(zip(initials, args_list)):
+        if chain_directory is None:
+            chain_filename = None
+        else:
+            chain_filename = os.path.join(chain_directory, 'chain_{}.npy'.format(index))
+        task_seed = None if seed is None else seed + index
+        tasks.append((log_probability, initial, args, chain_filename, task_seed, kwargs))
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_sample_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [_sample_task(task) for task in tasks]
+
+
+def _sample_task(task):
+    """Sample one posterior; this is module-level so that it can be pickled."""
+    log_probability, initial, args, chain_filename, seed, kwargs = task
+    result = ensemble_sample(log_probability, initial, args=args, chain_filename=chain_filename, seed=seed, **kwargs)
+    # A memory-mapped chain cannot be returned from a worker process.
+    return result._replace(chain=np.array(result.chain))
+
+
+def autocorrelation_time(chain, window_factor=5):
+    """
+    Estimate the integrated autocorrelation time of each parameter from a chain with shape (steps, walkers,
+    dimensions), using the autocorrelation function averaged over walkers and the automatic window of Sokal (1997):
+    the sum is truncated at the smallest lag that is at least window_factor times the estimate.
+    """
+    steps = chain.shape[0]
+    deviation = chain - chain.mean(axis=0)
+    size = 2 ** int(np.ceil(np.log2(2 * steps)))
+    transform = np.fft.rfft(deviation, n=size, axis=0)
+    autocorrelation = np.fft.irfft(transform * np.conj(transform), n=size, axis=0)[:steps].mean(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        autocorrelation /= autocorrelation[0]
+    times = 2 * np.cumsum(autocorrelation, axis=0) - 1
+    inside = np.arange(steps)[:, None] < window_factor * times
+    window = np.where(inside.all(axis=0), steps - 1, inside.argmin(axis=0))
+    return times[window, np.arange(times.shape[1])]
@@ -0,0 +1,358 @@
+"""
+This module fits many resonators at once with the model equations.general_cable * equations.linear_resonator, which is
+the model used by lmfit_resonator.LinearResonatorWithCable.
+
+The fit is a Levenberg-Marquardt minimization done simultaneously for all resonators, using stacked parameter arrays
+and the analytic Jacobian of the model, so the cost per iteration is a few numpy operations on arrays that contain all
+of the data instead of one lmfit call per resonator with numerical derivatives. Each resonator has its own damping
+parameter and stops independently when it converges.
+
+The fit results are available as arrays through BatchLinearResonatorWithCable, and the object for a single resonator
+returned by indexing it supports the same attributes as a fitted LinearResonatorWithCable, such as f_0, Q_i, Q_e,
+remove_background(), and invert().
+"""
+from __future__ import division
+
+import numpy as np
+
+from kid_readout.analysis.resonator import circle, equations, lmfit_resonator
+
+# These are the fitted parameters in the order used for the columns of the parameter arrays. The cable parameter f_min
+# is fixed at the minimum frequency of each resonator, as in lmfit_models.GeneralCableModel.
+PARAMETER_NAMES = ('delay', 'phi', 'A_mag', 'A_slope', 'f_0', 'Q', 'Q_e_real', 'Q_e_imag')
+
+
+class BatchLinearResonatorWithCable(object):
+    """
+    Fit the general cable times linear resonator model to many resonators at once.
+
+    The value of each parameter for all resonators is available as an array attribute with the name of the parameter,
+    and its standard error as the name followed by '_error', like the attributes of a fitted BaseResonator.
+    """
+
+    def __init__(self, frequency, s21, errors=None, params=None, max_iterations=200, tolerance=1e-10):
+        """
+        Fit the given data. Every resonator must have the same number of data points.
+
+        Parameters
+        ----------
+        frequency : numpy.ndarray(float)
+            The frequencies, with shape (number of resonators, number of points).
+        s21 : numpy.ndarray(complex)
+            The s21 data, with the same shape.
+        errors : numpy.ndarray(complex) or None
+            The errors on the real and imaginary parts of s21, with the same shape; None means use no errors.
+        params : numpy.ndarray(float) or None
+            Initial parameter values with shape (number of resonators, len(PARAMETER_NAMES)); None means use guess().
+        max_iterations : int
+            The maximum number of iterations.
+        tolerance : float
+            A resonator has converged when an iteration decreases its chi-squared by less than this fraction.
+        """
+        self.frequency = np.atleast_2d(np.asarray(frequency, dtype=np.float))
+        self.s21 = np.atleast_2d(np.asarray(s21))
+        if not np.iscomplexobj(self.s21):
+            raise TypeError("Resonator s21 must be complex.")
+        if self.frequency.shape != self.s21.shape:
+            raise ValueError("Frequency and s21 shapes differ: {} {}".format(self.frequency.shape, self.s21.shape))
+        if errors is None:
+            self.errors = None
+            self.weights = np.ones(self.s21.shape, dtype=np.complex)
+        else:
+            self.errors = np.atleast_2d(np.asarray(errors))
+            if not np.iscomplexobj(self.errors):
+                raise TypeError("Resonator s21 errors must be complex.")
+            self.weights = 1 / self.errors.real + 1j / self.errors.imag
+        self.f_min = self.frequency.min(axis=1)
+        if params is None:
+            params = guess(self.frequency, self.s21)
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.fit(params)
+
+    def __len__(self):
+        return self.frequency.shape[0]
+
+    def __getitem__(self, number):
+        return ResonatorFromBatch(self, int(number))
+
+    def __getattr__(self, attr):
+        if attr.endswith('_error') and attr[:-len('_error')] in PARAMETER_NAMES:
+            return self.stderr[:, PARAMETER_NAMES.index(attr[:-len('_error')])]
+        elif attr in PARAMETER_NAMES:
+            return self.values[:, PARAMETER_NAMES.index(attr)]
+        else:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, attr))
+
+    @property
+    def Q_e(self):
+        return self.Q_e_real + 1j * self.Q_e_imag
+
+    @property
+    def Q_i(self):
+        return 1 / (1 / self.Q - np.real(1 / self.Q_e))
+
+    def fit(self, params):
+        """
+        Run the minimization starting from the given parameter array and store the results.
+
+        The attributes set are values and stderr, with shape (number of resonators, len(PARAMETER_NAMES)), and
+        chi_squared, redchi, success, and num_iterations, with one entry per resonator.
+        """
+        values = np.array(params, dtype=np.float)
+        residual, jacobian = self._residual_and_jacobian(values)
+        chi_squared = np.sum(residual ** 2, axis=1)
+        damping = np.full(len(self), 1e-3)
+        active = np.ones(len(self), dtype=np.bool)
+        num_iterations = np.zeros(len(self), dtype=np.int)
+        identity = np.eye(len(PARAMETER_NAMES))
+        for iteration in range(self.max_iterations):
+            # Scale the normal equations to unit diagonal so that parameters of very different sizes are comparable.
+            alpha = np.einsum('nmi,nmj->nij', jacobian, jacobian)
+            beta = np.einsum('nmi,nm->ni', jacobian, residual)
+            scale = np.sqrt(np.einsum('nii->ni', alpha))
+            scale[scale == 0] = 1
+            scaled = alpha / (scale[:, :, None] * scale[:, None, :]) + damping[:, None, None] * identity
+            try:
+                step = -np.linalg.solve(scaled, (beta / scale)[:, :, None])[:, :, 0] / scale
+            except np.linalg.LinAlgError:
+                step = -np.array([np.linalg.lstsq(a, b / s, rcond=-1)[0] / s
+                                  for a, b, s in zip(scaled, beta, scale)])
+            trial = np.where(active[:, None], values + step, values)
+            trial_residual, trial_jacobian = self._residual_and_jacobian(trial)
+            trial_chi_squared = np.sum(trial_residual ** 2, axis=1)
+            valid = (np.all(np.isfinite(trial), axis=1) & np.isfinite(trial_chi_squared) &
+                     (trial[:, PARAMETER_NAMES.index('A_mag')] > 0) & (trial[:, PARAMETER_NAMES.index('f_0')] > 0) &
+                     (trial[:, PARAMETER_NAMES.index('Q')] > 0))
+            improved = active & valid & (trial_chi_squared <= chi_squared)
+            converged = improved & (chi_squared - trial_chi_squared <= self.tolerance * chi_squared)
+            values[improved] = trial[improved]
+            residual[improved] = trial_residual[improved]
+            jacobian[improved] = trial_jacobian[improved]
+            chi_squared[improved] = trial_chi_squared[improved]
+            damping[improved] = np.maximum(damping[improved] / 10, 1e-12)
+            damping[active & ~improved] *= 10
+            num_iterations[active] += 1
+            # A resonator that cannot decrease chi-squared even with very small steps is at a minimum.
+            active &= ~converged & (damping < 1e12)
+            if not np.any(active):
+                break
+        values[:, PARAMETER_NAMES.index('phi')] = np.angle(np.exp(1j * values[:, PARAMETER_NAMES.index('phi')]))
+        self.values = values
+        self.chi_squared = chi_squared
+        self.num_iterations = num_iterations
+        self.success = ~active
+        num_free = 2 * self.frequency.shape[1] - len(PARAMETER_NAMES)
+        self.redchi = chi_squared / num_free
+        self.stderr = self._stderr(np.einsum('nmi,nmj->nij', jacobian, jacobian), self.redchi)
+
+    def eval(self, frequency=None, values=None):
+        """Return the model evaluated at the given frequencies, which default to the data frequencies."""
+        if frequency is None:
+            frequency = self.frequency
+        if values is None:
+            values = self.values
+        return _model(frequency, self.f_min[:, None], values)[0]
+
+    def to_params(self):
+        """Return a list containing an lmfit.Parameters for each resonator that can be used to start a fit with
+        lmfit_resonator.LinearResonatorWithCable."""
+        params_list = []
+        for number in range(len(self)):
+            params = lmfit_resonator._linear_resonator_with_cable.make_params(f_min=self.f_min[number])
+            for name, value in zip(PARAMETER_NAMES, self.values[number]):
+                params[name].value = value
+            params_list.append(params)
+        return params_list
+
+    # Private methods.
+
+    def _residual_and_jacobian(self, values):
+        """
+        Return the weighted residual and its Jacobian with the real and imaginary parts stacked along the data axis,
+        with shapes (resonators, 2 * points) and (resonators, 2 * points, parameters).
+        """
+        model, derivative = _model(self.frequency, self.f_min[:, None], values, jacobian=True)
+        difference = model - self.s21
+        residual = np.concatenate((self.weights.real * difference.real, self.weights.imag * difference.imag), axis=1)
+        jacobian = np.concatenate((self.weights.real[:, :, None] * derivative.real,
+                                   self.weights.imag[:, :, None] * derivative.imag), axis=1)
+        return residual, jacobian
+
+    @staticmethod
+    def _stderr(alpha, redchi):
+        try:
+            covariance = np.linalg.inv(alpha)
+        except np.linalg.LinAlgError:
+            covariance = np.array([np.linalg.pinv(a) for a in alpha])
+        # Like lmfit, scale the covariance by the reduced chi-squared.
+        return np.sqrt(np.abs(np.einsum('nii->ni', covariance)) * redchi[:, None])
+
+
+class ResonatorFromBatch(object):
+    """
+    A single resonator from a BatchLinearResonatorWithCable, with the same attributes and methods used for analysis of
+    a fitted lmfit_resonator.LinearResonatorWithCable.
+    """
+
+    def __init__(self, batch, number):
+        self.batch = batch
+        self.number = number
+
+    def __getattr__(self, attr):
+        if attr.endswith('_error') and attr[:-len('_error')] in PARAMETER_NAMES:
+            return self.batch.stderr[self.number, PARAMETER_NAMES.index(attr[:-len('_error')])]
+        elif attr in PARAMETER_NAMES:
+            return self.batch.values[self.number, PARAMETER_NAMES.index(attr)]
+        else:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, attr))
+
+    @property
+    def f_min(self):
+        return self.batch.f_min[self.number]
+
+    @property
+    def frequency(self):
+        return self.batch.frequency[self.number]
+
+    @property
+    def s21(self):
+        return self.batch.s21[self.number]
+
+    data = s21
+
+    @property
+    def errors(self):
+        if self.batch.errors is None:
+            return None
+        return self.batch.errors[self.number]
+
+    @property
+    def redchi(self):
+        return self.batch.redchi[self.number]
+
+    @property
+    def success(self):
+        return bool(self.batch.success[self.number])
+
+    @property
+    def Q_i(self):
+        return 1 / (1 / self.Q - np.real(1 / self.Q_e))
+
+    @property
+    def Q_e(self):
+        return self.Q_e_real + 1j * self.Q_e_imag
+
+    def eval(self, frequency=None):
+        if frequency is None:
+            frequency = self.frequency
+        return self.background_s21(frequency) * self.target_s21(frequency)
+
+    def target_s21(self, frequency=None):
+        if frequency is None:
+            frequency = self.frequency
+        return equations.linear_resonator(frequency, self.f_0, self.Q, self.Q_e_real, self.Q_e_imag)
+
+    def background_s21(self, frequency=None):
+        if frequency is None:
+            frequency = self.frequency
+        return equations.general_cable(frequency, self.delay, self.phi, self.f_min, self.A_mag, self.A_slope)
+
+    def remove_background(self, frequency, s21_raw):
+        return s21_raw / self.background_s21(frequency)
+
+    def approximate_target_gradient(self, frequency, delta_f=1.0):
+        return (self.target_s21(frequency + delta_f) - self.target_s21(frequency)) / delta_f
+
+    def invert_raw(self, frequency, s21_raw):
+        return self.invert(self.remove_background(frequency=frequency, s21_raw=s21_raw))
+
+    def invert(self, s21_normalized):
+        c = 1 / self.Q_e
+        z = c / (1 - s21_normalized)
+        q = z.real - c.real
+        x = z.imag / 2
+        return x, q
+
+
+def guess(frequency, s21):
+    """
+    Return an array of initial parameter values with shape (number of resonators, len(PARAMETER_NAMES)), computed for
+    all resonators at once in the same way as the guess of lmfit_resonator.LinearResonatorWithCable: the estimates of
+    circle.estimate() are used where they are finite and within the limits that lmfit_models sets, and the heuristic
+    guesses of lmfit_models.GeneralCableModel and lmfit_models.LinearResonatorModel are used elsewhere.
+    """
+    values = heuristic_guess(frequency, s21)
+    estimate = np.column_stack(circle.estimate(frequency, s21))
+    f_0_index = PARAMETER_NAMES.index('f_0')
+    Q_index = PARAMETER_NAMES.index('Q')
+    # These are the limits set by the lmfit guesses, which depend on the heuristic f_0.
+    Q_min = 0.1 * (values[:, f_0_index] / (frequency.max(axis=1) - frequency.min(axis=1)))
+    delta_f = np.diff(frequency, axis=1)
+    Q_max = values[:, f_0_index] / np.where(delta_f > 0, delta_f, np.inf).min(axis=1)
+    lower = np.tile([-np.inf, -np.pi, 0, -np.inf, 0, 0, 1, -1e7], (values.shape[0], 1))
+    lower[:, f_0_index] = frequency.min(axis=1)
+    lower[:, Q_index] = Q_min
+    upper = np.tile([np.inf, np.pi, np.inf, np.inf, 0, 0, 1e7, 1e7], (values.shape[0], 1))
+    upper[:, f_0_index] = frequency.max(axis=1)
+    upper[:, Q_index] = Q_max
+    with np.errstate(invalid='ignore'):
+        usable = np.all(np.isfinite(estimate) & (lower <= estimate) & (estimate <= upper), axis=1)
+    values[usable] = estimate[usable]
+    return values
+
+
+def heuristic_guess(frequency, s21):
+    """
+    Return an array of initial parameter values with shape (number of resonators, len(PARAMETER_NAMES)), computed for
+    all resonators at once in the same way as the guesses of lmfit_models.GeneralCableModel and
+    lmfit_models.LinearResonatorModel.
+    """
+    offset = frequency - frequency.min(axis=1)[:, None]
+    A_slope, A_mag = _linear_fit(offset, np.abs(s21))
+    phi_slope, phi = _linear_fit(offset, np.unwrap(np.angle(s21), axis=1))
+    rows = np.arange(frequency.shape[0])
+    argmin_s21 = np.abs(s21).argmin(axis=1)
+    f_0 = frequency[rows, argmin_s21]
+    Q_min = 0.1 * (f_0 / (frequency.max(axis=1) - frequency.min(axis=1)))
+    delta_f = np.diff(frequency, axis=1)
+    Q_max = f_0 / np.where(delta_f > 0, delta_f, np.inf).min(axis=1)
+    Q = np.sqrt(Q_min * Q_max)
+    Q_e_real = Q / (1 - np.abs(s21[rows, argmin_s21]) / np.abs(s21).max(axis=1))
+    return np.column_stack((-phi_slope / (2 * np.pi), np.angle(np.exp(1j * phi)), A_mag, A_slope / A_mag,
+                            f_0, Q, Q_e_real, np.zeros_like(Q)))
+
+
+def _linear_fit(x, y):
+    """Return the slope and intercept of the least-squares line through each row of x and y."""
+    x_mean = x.mean(axis=1)[:, None]
+    y_mean = y.mean(axis=1)[:, None]
+    slope = np.sum((x - x_mean) * (y - y_mean), axis=1) / np.sum((x - x_mean) ** 2, axis=1)
+    return slope, y_mean[:, 0] - slope * x_mean[:, 0]
+
+
+def _model(f, f_min, values, jacobian=False):
+    """
+    Return the model s21 for the given frequencies and parameter values and, if jacobian is True, its derivatives with
+    respect to each parameter along a new last axis; otherwise the second return value is None.
+    """
+    delay, phi, A_mag, A_slope, f_0, Q, Q_e_real, Q_e_imag = [values[:, k, None] for k in range(len(PARAMETER_NAMES))]
+    offset = f - f_min
+    phase = np.exp(1j * (-2 * np.pi * offset * delay + phi))
+    cable = A_mag * (1 + A_slope * offset) * phase
+    inverse_Q_e = 1 / (Q_e_real + 1j * Q_e_imag)
+    denominator = 1 + 2j * Q * (f - f_0) / f_0
+    coupling = Q * inverse_Q_e / denominator
+    s21 = cable * (1 - coupling)
+    if not jacobian:
+        return s21, None
+    derivative = np.empty(s21.shape + (len(PARAMETER_NAMES),), dtype=np.complex)
+    derivative[..., 0] = -2j * np.pi * offset * s21
+    derivative[..., 1] = 1j * s21
+    derivative[..., 2] = s21 / A_mag
+    derivative[..., 3] = A_mag * offset * phase * (1 - coupling)
+    derivative[..., 4] = -cable * coupling * 2j * Q * f / (f_0 ** 2 * denominator)
+    derivative[..., 5] = -cable * coupling / (Q * denominator)
+    derivative[..., 6] = cable * coupling * inverse_Q_e
+    derivative[..., 7] = 1j * cable * coupling * inverse_Q_e
+    return s21, derivative
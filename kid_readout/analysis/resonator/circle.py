@@ -0,0 +1,220 @@
+"""
+This module estimates the parameters of the model equations.general_cable * equations.linear_resonator without
+iteration, using the geometry of the resonance circle in the complex plane:
+
+1. a circle is fit to the data by algebraic least squares;
+2. the position of each point on the circle is a Mobius transformation of the detuning, which is linear in frequency,
+   so f_0, Q, and the off-resonance point come from a weighted linear least-squares fit;
+3. the off-resonance point gives the cable amplitude and phase, and the resonance point gives Q_e;
+4. the cable delay and amplitude slope come from the data divided by the estimated resonator response, and the first
+   three steps are repeated with the cable response removed; an estimated delay is kept only if it reduces the
+   residuals.
+
+All functions operate along the last axis, so an array of sweeps with shape (number of resonators, number of points)
+is processed at once. The estimates are accurate for data with good signal-to-noise that span the resonance, and
+serve as initial values for a fit otherwise.
+"""
+from __future__ import division
+from collections import namedtuple
+
+import numpy as np
+
+from kid_readout.analysis.resonator import equations
+
+# The parameter names match those of lmfit_models.GeneralCableModel and lmfit_models.LinearResonatorModel.
+CircleEstimate = namedtuple('CircleEstimate', field_names=['delay', 'phi', 'A_mag', 'A_slope', 'f_0', 'Q',
+                                                           'Q_e_real', 'Q_e_imag'])
+
+
+def fit_circle(s21):
+    """
+    Fit a circle to complex data by minimizing the algebraic distance (the Kasa fit).
+
+    Parameters
+    ----------
+    s21 : numpy.ndarray(complex)
+        The data; circles are fit along the last axis.
+
+    Returns
+    -------
+    numpy.ndarray(complex)
+        The center of each circle.
+    numpy.ndarray(float)
+        The radius of each circle.
+    """
+    # Center the data first to improve the conditioning of the normal equations.
+    mean = s21.mean(axis=-1)
+    z = s21 - mean[..., None]
+    x = z.real
+    y = z.imag
+    w = x ** 2 + y ** 2
+    # Minimize sum((w + a * x + b * y + c) ** 2); since x and y have zero mean, the equations for a and b decouple from
+    # the one for c, which is -mean(w).
+    xx = np.mean(x * x, axis=-1)
+    xy = np.mean(x * y, axis=-1)
+    yy = np.mean(y * y, axis=-1)
+    xw = np.mean(x * w, axis=-1)
+    yw = np.mean(y * w, axis=-1)
+    determinant = xx * yy - xy ** 2
+    a = -(yy * xw - xy * yw) / determinant
+    b = -(xx * yw - xy * xw) / determinant
+    c = -np.mean(w, axis=-1)
+    center = -(a + 1j * b) / 2
+    radius = np.sqrt(np.abs(center) ** 2 - c)
+    return center + mean, radius
+
+
+def estimate(frequency, s21, delay=None, passes=2):
+    """
+    Estimate the resonator and cable parameters using a fixed number of linear least-squares fits.
+
+    The resonator parameters are first estimated with zero delay and amplitude slope. The data are then divided by the
+    estimated resonator response, and the amplitude slope and, if it is not given, the delay are found from linear fits
+    to the magnitude and phase of the result, which is the cable response; the resonator parameters are then estimated
+    again with this cable response removed. If the delay is estimated, for each resonator the final estimate is returned
+    only if its residuals are smaller than those of the zero-delay estimate, since the delay estimate is poor when the
+    noise is large.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray(float)
+        The frequencies, increasing along the last axis.
+    s21 : numpy.ndarray(complex)
+        The s21 data, with the same shape.
+    delay : float, numpy.ndarray, or None
+        The cable delay, if known; None means estimate it from the data.
+    passes : int
+        The number of times to estimate the cable response and repeat the resonator estimate.
+
+    Returns
+    -------
+    CircleEstimate
+        A namedtuple of the parameter values, each a float for 1-D input or an array with one value per resonator.
+        Values may be non-finite or unphysical if the data do not contain a resonance.
+    """
+    single = np.ndim(frequency) == 1
+    frequency = np.atleast_2d(np.asarray(frequency, dtype=np.float))
+    s21 = np.atleast_2d(np.asarray(s21))
+    zero = np.zeros(frequency.shape[0])
+    if delay is None:
+        first = _with_slope(frequency, s21, _estimate(frequency, s21, zero, zero))
+        result = first
+        for n in range(passes):
+            phase_slope, phase_offset = _cable_fit(frequency, s21, result, phase=True)
+            result = _with_slope(frequency, s21, _estimate(frequency, s21, -phase_slope / (2 * np.pi), result.A_slope))
+        better = _residual(frequency, s21, result) < _residual(frequency, s21, first)
+        result = CircleEstimate(*[np.where(better, b, a) for a, b in zip(first, result)])
+    else:
+        delay = zero + delay
+        result = _with_slope(frequency, s21, _estimate(frequency, s21, delay, zero))
+        for n in range(passes):
+            result = _with_slope(frequency, s21, _estimate(frequency, s21, delay, result.A_slope))
+    if single:
+        return CircleEstimate(*[float(value[0]) for value in result])
+    return result
+
+
+def _cable_fit(frequency, s21, result, phase=False):
+    """
+    Divide the data by the estimated resonator response and return the slope and intercept of a weighted linear fit to
+    the phase or the magnitude of the quotient, which is the cable response.
+    """
+    resonator = equations.linear_resonator(frequency, result.f_0[:, None], result.Q[:, None],
+                                           result.Q_e_real[:, None], result.Q_e_imag[:, None])
+    # The noise in the quotient is inversely proportional to the magnitude of the resonator response.
+    weight = np.abs(resonator) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cable = s21 / resonator
+    weight[~np.isfinite(cable)] = 0
+    cable[~np.isfinite(cable)] = 1
+    offset = frequency - frequency.min(axis=1)[:, None]
+    if phase:
+        return _linear_fit(offset, np.unwrap(np.angle(cable), axis=1), weight)
+    else:
+        return _linear_fit(offset, np.abs(cable), weight)
+
+
+def _with_slope(frequency, s21, result):
+    """Return the given CircleEstimate with A_slope estimated from the magnitude of the cable response."""
+    magnitude_slope, magnitude_offset = _cable_fit(frequency, s21, result)
+    return result._replace(A_slope=magnitude_slope / magnitude_offset)
+
+
+def _residual(frequency, s21, result):
+    """Return the sum of the squared residuals of the model with the given parameters; non-finite values are inf."""
+    model = (equations.general_cable(frequency, result.delay[:, None], result.phi[:, None],
+                                     frequency.min(axis=1)[:, None], result.A_mag[:, None], result.A_slope[:, None]) *
+             equations.linear_resonator(frequency, result.f_0[:, None], result.Q[:, None], result.Q_e_real[:, None],
+                                        result.Q_e_imag[:, None]))
+    residual = np.sum(np.abs(s21 - model) ** 2, axis=1)
+    residual[~np.isfinite(residual)] = np.inf
+    return residual
+
+
+def _estimate(frequency, s21, delay, A_slope):
+    """
+    Return a CircleEstimate with arrays of values, removing the given delay and amplitude slope from the data; the
+    returned A_slope is not estimated and is the given value.
+    """
+    f_min = frequency.min(axis=1)[:, None]
+    z = s21 * np.exp(2j * np.pi * (frequency - f_min) * delay[:, None]) / (1 + A_slope[:, None] * (frequency - f_min))
+    center, radius = fit_circle(z)
+    # On the unit circle, a point w and its detuning y = 2 * Q * (f - f_0) / f_0 are related by
+    # w = -E * (1 - i * y) / (1 + i * y), where E is the unknown off-resonance point. Since y = p * x + q is linear in
+    # the scaled frequency x, this can be rewritten as p * x * w + q * w - u * x + K = i * w, which is linear in the
+    # real unknowns p and q and the complex unknowns u = E * p and K.
+    span = frequency.max(axis=1) - f_min[:, 0]
+    x = (frequency - f_min) / span[:, None]
+    w = (z - center[:, None]) / radius[:, None]
+    zero = np.zeros_like(x)
+    one = np.ones_like(x)
+    design = np.concatenate((np.stack((x * w.real, w.real, -x, zero, one, zero), axis=-1),
+                             np.stack((x * w.imag, w.imag, zero, -x, zero, one), axis=-1)), axis=1)
+    target = np.concatenate((-w.imag, w.real), axis=1)
+    solution = _linear_least_squares(design, target, np.ones(target.shape))
+    # The variance of each equation is proportional to 1 + y ** 2, so fit again with weights from the first estimate;
+    # these depend only on frequency, so they do not bias the result.
+    y = solution[:, 0, None] * x + solution[:, 1, None]
+    weight = np.tile(1 / (1 + y ** 2), 2)
+    solution = _linear_least_squares(design, target, weight)
+    p, q = solution[:, 0], solution[:, 1]
+    off_resonance_direction = np.exp(1j * np.angle((solution[:, 2] + 1j * solution[:, 3]) / p))
+    # Relative to the off-resonance direction, the angle of each point is pi - 2 * arctan(y), so y = cot(angle / 2).
+    # The noise in w enters the equations above multiplied by the unknowns, which biases the estimate of p toward
+    # zero when the noise is large, so p and q are estimated again from a weighted linear fit of this y, with weights
+    # that depend only on the frequency through the previous estimate.
+    angle = np.mod(np.angle(w / off_resonance_direction[:, None]), 2 * np.pi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y_data = 1 / np.tan(angle / 2)
+    finite = np.isfinite(y_data)
+    y_data[~finite] = 0
+    p, q = _linear_fit(x, y_data, finite / (1 + y ** 2) ** 2)
+    off_resonance = center + radius * off_resonance_direction
+    resonance = center - radius * off_resonance_direction
+    f_0 = f_min[:, 0] - q * span / p
+    Q = p * f_0 / (2 * span)
+    Q_e = Q / (1 - resonance / off_resonance)
+    return CircleEstimate(delay=delay, phi=np.angle(off_resonance), A_mag=np.abs(off_resonance),
+                          A_slope=A_slope, f_0=f_0, Q=Q, Q_e_real=Q_e.real, Q_e_imag=Q_e.imag)
+
+
+def _linear_least_squares(design, target, weight):
+    """
+    Solve the weighted linear least-squares problems with design matrices of shape (problems, equations, unknowns) and
+    targets and weights of shape (problems, equations), and return the solutions with shape (problems, unknowns).
+    """
+    weighted = design * weight[:, :, None]
+    normal = np.einsum('nei,nej->nij', weighted, design)
+    projection = np.einsum('nei,ne->ni', weighted, target)
+    return np.linalg.solve(normal, projection[:, :, None])[:, :, 0]
+
+
+def _linear_fit(x, y, weight=1):
+    """Return the slope and intercept of the weighted least-squares line through x and y along the last axis."""
+    weight = weight * np.ones(x.shape)
+    total = weight.sum(axis=-1)
+    x_mean = (weight * x).sum(axis=-1) / total
+    y_mean = (weight * y).sum(axis=-1) / total
+    dx = x - x_mean[..., None]
+    slope = (weight * dx * (y - y_mean[..., None])).sum(axis=-1) / (weight * dx ** 2).sum(axis=-1)
+    return slope, y_mean - slope * x_mean
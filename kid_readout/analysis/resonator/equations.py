@@ -47,30 +47,64 @@ def inverse_linear_resonator(f, f_0, iQ, iQ_e_real, iQ_e_imag):
 # Non-linear model from Swenson et al.
 ######################################
 
+def nonlinear_detuning(y_0, a, increasing=True):
+    """
+    Return the detuning y that solves y = y_0 + a / (1 + 4 * y ** 2), where y_0 = Q * (f - f_0) / f_0 is the
+    detuning at low power and a is the nonlinearity parameter (Swenson et al., 2013).
+
+    This is a cubic in y, which has one real root for a < 4 * sqrt(3) / 9, and three real roots for some y_0 when a is
+    larger. The resonator stays on the branch it occupies until that branch ends, so in the bistable region the smallest
+    root is returned for a sweep with increasing frequency and the largest root for a sweep with decreasing frequency.
+    The roots are computed in closed form, so scalars and arrays of any shape are evaluated exactly.
+    """
+    # With y = t + y_0 / 3, the cubic is t ** 3 - 3 * m * t - 2 * n = 0.
+    m = y_0 ** 2 / 9 - 1 / 12
+    n = y_0 ** 3 / 27 + y_0 / 12 + a / 8
+    discriminant = n ** 2 - m ** 3
+    one_root = discriminant >= 0
+    # Where there is one real root, use Cardano's formula with the sign that avoids cancellation; the product of the
+    # two cube roots is m.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u = cbrt(n + np.where(n < 0, -1, 1) * np.sqrt(np.where(one_root, discriminant, 0)))
+        single = np.where(u == 0, 0, u + m / u)
+        # Where there are three real roots, m > 0 and the roots are 2 * sqrt(m) * cos((theta + 2 * pi * k) / 3).
+        theta = np.arccos(np.clip(n / np.sqrt(np.where(one_root, 1, m)) ** 3, -1, 1))
+    if increasing:
+        multiple = 2 * np.sqrt(np.abs(m)) * np.cos((theta + 2 * np.pi) / 3)
+    else:
+        multiple = 2 * np.sqrt(np.abs(m)) * np.cos(theta / 3)
+    return y_0 / 3 + np.where(one_root, single, multiple)
+
+
 def nonlinear_resonator(f,f_0,Q,Q_e_real,Q_e_imag,a):
+    """
+    The nonlinear resonator model of Swenson et al. (2013), for a sweep with increasing frequency; see
+    nonlinear_detuning(). For a = 0 this equals linear_resonator().
+    """
     Q_e = Q_e_real + 1j*Q_e_imag
-    if np.isscalar(f):
-        fmodel = np.linspace(f * 0.9999, f * 1.0001, 1000)
-        scalar = True
-    else:
-        fmodel = f
-        scalar = False
-    y_0 = ((fmodel - f_0) / f_0) * Q
-    y = (y_0 / 3. +
-         (y_0 ** 2 / 9 - 1 / 12) / cbrt(a / 8 + y_0 / 12 + np.sqrt(
-             (y_0 ** 3 / 27 + y_0 / 12 + a / 8) ** 2 - (y_0 ** 2 / 9 - 1 / 12) ** 3) + y_0 ** 3 / 27) +
-         cbrt(a / 8 + y_0 / 12 + np.sqrt(
-             (y_0 ** 3 / 27 + y_0 / 12 + a / 8) ** 2 - (y_0 ** 2 / 9 - 1 / 12) ** 3) + y_0 ** 3 / 27))
-    x = y / Q
-    s21 = (1 - (Q / Q_e) / (1 + 2j * Q * x))
-    mask = np.isfinite(s21)
-    if scalar or not np.all(mask):
-        s21_interp_real = np.interp(f, fmodel[mask], s21[mask].real)
-        s21_interp_imag = np.interp(f, fmodel[mask], s21[mask].imag)
-        s21new = s21_interp_real + 1j * s21_interp_imag
-    else:
-        s21new = s21
-    return s21new
+    y = nonlinear_detuning(Q * (f - f_0) / f_0, a)
+    return 1 - (Q / Q_e) / (1 + 2j * y)
+
+
+def nonlinear_resonator_derivatives(f, f_0, Q, Q_e_real, Q_e_imag, a):
+    """
+    Return a dict with keys that are the parameter names of nonlinear_resonator() and values that are its partial
+    derivatives with respect to each parameter, evaluated at f.
+    """
+    Q_e = Q_e_real + 1j * Q_e_imag
+    y_0 = Q * (f - f_0) / f_0
+    y = nonlinear_detuning(y_0, a)
+    # Differentiate y - y_0 = a / (1 + 4 * y ** 2) implicitly.
+    lorentzian = 1 / (1 + 4 * y ** 2)
+    dy_dy_0 = 1 / (1 + 8 * a * y * lorentzian ** 2)
+    denominator = 1 + 2j * y
+    coupling = (Q / Q_e) / denominator
+    ds21_dy = 2j * coupling / denominator
+    return {'f_0': ds21_dy * dy_dy_0 * (-Q * f / f_0 ** 2),
+            'Q': -coupling / Q + ds21_dy * dy_dy_0 * (f - f_0) / f_0,
+            'Q_e_real': coupling / Q_e,
+            'Q_e_imag': 1j * coupling / Q_e,
+            'a': ds21_dy * dy_dy_0 * lorentzian}
 
 
 def inverse_nonlinear_resonator(f, f_0, iQ, iQ_e_real, iQ_e_imag,a):
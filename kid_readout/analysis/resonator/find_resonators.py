@@ -5,12 +5,12 @@ from matplotlib import pyplot as plt
 import logging
 
 from kid_readout.analysis import detect_peaks
-from kid_readout.analysis.resonator import lmfit_resonator
+from kid_readout.analysis.resonator import joint, lmfit_resonator
 
 logger = logging.getLogger(__name__)
 
 def find_resonators(frequency, s21, s21_error, frequency_span=1e6, detect_peaks_threshold=3, detect_peaks_kwargs=dict(),
-                    make_plot=False,annotate=False):
+                    make_plot=False,annotate=False,joint_fit=False,workers=1):
     unique_mask = np.flatnonzero(np.diff(frequency)!=0)
     frequency = frequency[unique_mask]
     s21 = s21[unique_mask]
@@ -21,10 +21,21 @@ def find_resonators(frequency, s21, s21_error, frequency_span=1e6, detect_peaks_
     peak_indexes = np.sort(np.array(list(set(peak_indexes) | set(peak_indexes2*2))))
     logger.debug("Found %d peaks",peak_indexes.shape[0])
     return fit_candidates(peak_indexes,frequency, s21, s21_error, frequency_span=frequency_span,
-                    make_plot=make_plot,annotate=annotate)
+                    make_plot=make_plot,annotate=annotate,joint_fit=joint_fit,workers=workers)
 
 def fit_candidates(peak_indexes,frequency, s21, s21_error, frequency_span=1e6,
-                    make_plot=False,annotate=False):
+                    make_plot=False,annotate=False,joint_fit=False,workers=1):
+    """
+    Fit a resonator at each peak. If joint_fit is False, each peak is fit independently with a LinearResonatorWithCable
+    using the data within frequency_span; otherwise, nearby peaks are fit together with joint.fit_segments(), which
+    handles colliding resonators and can use several worker processes.
+    """
+    if joint_fit:
+        resonators = joint.fit_segments(frequency, s21, s21_error, peak_indexes, frequency_span=frequency_span,
+                                        workers=workers)
+        if make_plot:
+            plot_results(frequency,s21,resonators,peak_indexes,frequency_span,annotate=annotate)
+        return resonators
     resonators = []
     for peak_index in peak_indexes:
         peak_f = frequency[peak_index]
@@ -56,14 +67,19 @@ def plot_results(frequency, s21, resonators, peak_indexes=[], frequency_span=250
             color='m'
         else:
             color='r'
-        dB_s21_at_f_0 = 20*np.log10(np.abs(res.model.eval(params=res.current_params,f=res.f_0)))
+        dB_s21_at_f_0 = 20*np.log10(np.abs(res.eval(frequency=res.f_0)))
         sub_mask = np.abs(res.f_0-frequency) < frequency_span
-        plt.plot(frequency[sub_mask]/1e6,20*np.log10(np.abs(res.model.eval(params=res.current_params,f=frequency[sub_mask]))))
+        plt.plot(frequency[sub_mask]/1e6,20*np.log10(np.abs(res.eval(frequency=frequency[sub_mask]))))
         plt.plot(res.f_0/1e6,dB_s21_at_f_0,'o')
         if annotate:
-            plt.annotate(xy=(res.f_0/1e6, dB_s21_at_f_0), s=('Q: %.1f\nQc: %.1f\nQi: %.1f\nchi2: %.1f' % (res.Q,1/np.real(1/res.Q_e),res.Q_i,res.current_result.redchi)),
+            plt.annotate(xy=(res.f_0/1e6, dB_s21_at_f_0), s=('Q: %.1f\nQc: %.1f\nQi: %.1f\nchi2: %.1f' % (res.Q,1/np.real(1/res.Q_e),res.Q_i,_redchi(res))),
             size=8,textcoords='offset points',xytext=(10,-10),color=color)
 
+def _redchi(res):
+    if isinstance(res, joint.ResonatorFromSegment):
+        return res.redchi
+    return res.current_result.redchi
+
 def remove_duplicates(resonators,tolerance=50e3):
     clean = []
     f0s = []
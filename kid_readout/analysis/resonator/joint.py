@@ -0,0 +1,460 @@
+"""
+This module fits wide sweeps that contain many resonators, some of which may be close enough together that their
+responses overlap. The detected peaks are grouped into segments of nearby peaks, and each segment is fit with the model
+equations.general_cable times the product of one equations.linear_resonator for each peak in the segment, so the
+resonators in a segment share one cable background and a collision is fit by a single model instead of one fit per
+resonator that treats the other as background. Each segment fit is a Levenberg-Marquardt minimization that uses the
+analytic Jacobian of the model by default, and segments are independent so they can be fit in parallel.
+
+The object for a single resonator returned by fit_segments() supports the same attributes as a fitted
+lmfit_resonator.LinearResonatorWithCable, such as f_0, Q_i, Q_e, remove_background(), and invert(); its background is
+the cable times the responses of the other resonators in its segment.
+"""
+from __future__ import division
+
+import logging
+import multiprocessing
+
+import numpy as np
+import scipy.optimize
+
+from kid_readout.analysis.resonator import circle, equations
+
+logger = logging.getLogger(__name__)
+
+# The cable parameters are shared by all resonators in a segment, and the columns of the resonator parameter arrays are
+# in the order of RESONATOR_PARAMETER_NAMES. The cable parameter f_min is fixed at the minimum frequency of the segment,
+# as in lmfit_models.GeneralCableModel.
+CABLE_PARAMETER_NAMES = ('delay', 'phi', 'A_mag', 'A_slope')
+RESONATOR_PARAMETER_NAMES = ('f_0', 'Q', 'Q_e_real', 'Q_e_imag')
+
+
+def segment_peaks(peak_frequencies, frequency_span, max_resonators=None):
+    """
+    Group peaks into segments of nearby peaks.
+
+    Two adjacent peaks are in the same segment if the windows of +/- frequency_span around them overlap. A segment with
+    more than max_resonators peaks is split at its widest gaps until every segment is small enough.
+
+    Parameters
+    ----------
+    peak_frequencies : numpy.ndarray(float)
+        The increasing peak frequencies.
+    frequency_span : float
+        The half-width of the window around each peak.
+    max_resonators : int or None
+        The maximum number of peaks in a segment; None means no limit.
+
+    Returns
+    -------
+    list of numpy.ndarray(int)
+        The indices of the peaks in each segment, in increasing order.
+    """
+    peak_frequencies = np.asarray(peak_frequencies, dtype=np.float)
+    if not peak_frequencies.size:
+        return []
+    breaks = np.flatnonzero(np.diff(peak_frequencies) >= 2 * frequency_span) + 1
+    segments = np.split(np.arange(peak_frequencies.size), breaks)
+    if max_resonators is None:
+        return segments
+    split = []
+    while segments:
+        segment = segments.pop(0)
+        if segment.size <= max_resonators:
+            split.append(segment)
+        else:
+            widest = np.argmax(np.diff(peak_frequencies[segment])) + 1
+            segments[:0] = [segment[:widest], segment[widest:]]
+    return split
+
+
+def fit_segments(frequency, s21, errors, peak_indexes, frequency_span=1e6, max_resonators=8,
+                 minimum_separation=None, workers=1, **kwargs):
+    """
+    Fit the resonators at the given peaks using one joint fit for each segment of nearby peaks.
+
+    The data for a segment extend from frequency_span below its first peak to frequency_span above its last peak, or
+    to halfway to the nearest peak of the adjacent segment, if that is closer.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray(float)
+        The increasing frequencies of the sweep.
+    s21 : numpy.ndarray(complex)
+        The s21 data.
+    errors : numpy.ndarray(complex) or None
+        The errors on the real and imaginary parts of s21; None means use no errors.
+    peak_indexes : numpy.ndarray(int)
+        The indices of the detected peaks.
+    frequency_span : float
+        The half-width of the window around each peak; see segment_peaks().
+    max_resonators : int or None
+        The maximum number of resonators in a segment; see segment_peaks().
+    minimum_separation : float or None
+        Peaks closer together than this are merged, keeping the one with the smallest s21 magnitude, since the joint fit
+        cannot separate two resonators at the same frequency; None means twice the median frequency step, which merges
+        peaks detected at adjacent points.
+    workers : int
+        The number of processes to use to fit the segments; the default of 1 fits them in this process.
+    kwargs
+        Keyword arguments passed to SegmentFit.
+
+    Returns
+    -------
+    list of ResonatorFromSegment
+        One for each peak that remains after merging, in order of increasing frequency.
+    """
+    frequency = np.asarray(frequency, dtype=np.float)
+    s21 = np.asarray(s21)
+    if minimum_separation is None:
+        minimum_separation = 2 * np.median(np.diff(frequency))
+    peak_indexes = _merge_peaks(np.sort(peak_indexes), frequency, s21, minimum_separation)
+    peak_frequencies = frequency[peak_indexes]
+    segments = segment_peaks(peak_frequencies, frequency_span, max_resonators)
+    tasks = []
+    for number, segment in enumerate(segments):
+        start = peak_frequencies[segment[0]] - frequency_span
+        if number > 0:
+            start = max(start, (peak_frequencies[segments[number - 1][-1]] + peak_frequencies[segment[0]]) / 2)
+        stop = peak_frequencies[segment[-1]] + frequency_span
+        if number < len(segments) - 1:
+            stop = min(stop, (peak_frequencies[segment[-1]] + peak_frequencies[segments[number + 1][0]]) / 2)
+        mask = (start <= frequency) & (frequency <= stop)
+        tasks.append((frequency[mask], s21[mask], None if errors is None else errors[mask],
+                      peak_frequencies[segment], kwargs))
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            fits = pool.map(_fit_segment_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fits = [_fit_segment_task(task) for task in tasks]
+    resonators = []
+    for fit in fits:
+        if not fit.success:
+            logger.warning("Segment fit from %.1f to %.1f did not converge", fit.frequency[0], fit.frequency[-1])
+        resonators.extend(fit[number] for number in range(len(fit)))
+    return resonators
+
+
+class SegmentFit(object):
+    """
+    Fit the general cable times a product of linear resonators to one segment of a sweep.
+
+    The cable parameter values are available as attributes with the names in CABLE_PARAMETER_NAMES, and the resonator
+    parameter values as array attributes with one entry per resonator and the names in RESONATOR_PARAMETER_NAMES; the
+    standard error of each is available as the name followed by '_error'.
+    """
+
+    def __init__(self, frequency, s21, errors, f_0, params=None, jacobian=True, max_iterations=200):
+        """
+        Fit the given data.
+
+        Parameters
+        ----------
+        frequency : numpy.ndarray(float)
+            The frequencies of the segment.
+        s21 : numpy.ndarray(complex)
+            The s21 data.
+        errors : numpy.ndarray(complex) or None
+            The errors on the real and imaginary parts of s21; None means use no errors.
+        f_0 : numpy.ndarray(float)
+            The approximate resonance frequencies, which determine the number of resonators; usually peak frequencies.
+        params : numpy.ndarray(float) or None
+            Initial parameter values with length len(CABLE_PARAMETER_NAMES) + len(RESONATOR_PARAMETER_NAMES) * len(f_0),
+            ordered like the values attribute; None means use guess().
+        jacobian : bool
+            If True, use the analytic Jacobian of the model; otherwise, use derivatives from finite differences.
+        max_iterations : int
+            The maximum number of iterations, in units of the number of parameters.
+        """
+        self.frequency = np.asarray(frequency, dtype=np.float)
+        self.s21 = np.asarray(s21)
+        if not np.iscomplexobj(self.s21):
+            raise TypeError("Resonator s21 must be complex.")
+        if errors is None:
+            self.errors = None
+            self.weights = np.ones(self.s21.shape, dtype=np.complex)
+        else:
+            self.errors = np.asarray(errors)
+            if not np.iscomplexobj(self.errors):
+                raise TypeError("Resonator s21 errors must be complex.")
+            self.weights = 1 / self.errors.real + 1j / self.errors.imag
+        self.f_min = self.frequency.min()
+        if params is None:
+            params = guess(self.frequency, self.s21, f_0)
+        self.jacobian = jacobian
+        self.max_iterations = max_iterations
+        self.fit(params)
+
+    def __len__(self):
+        return (self.values.size - len(CABLE_PARAMETER_NAMES)) // len(RESONATOR_PARAMETER_NAMES)
+
+    def __getitem__(self, number):
+        return ResonatorFromSegment(self, int(number))
+
+    def __getattr__(self, attr):
+        if attr.endswith('_error'):
+            source = 'stderr'
+            name = attr[:-len('_error')]
+        else:
+            source = 'values'
+            name = attr
+        if name in CABLE_PARAMETER_NAMES and source in self.__dict__:
+            return self.__dict__[source][CABLE_PARAMETER_NAMES.index(name)]
+        elif name in RESONATOR_PARAMETER_NAMES and source in self.__dict__:
+            return self.__dict__[source][len(CABLE_PARAMETER_NAMES):].reshape(
+                -1, len(RESONATOR_PARAMETER_NAMES))[:, RESONATOR_PARAMETER_NAMES.index(name)]
+        else:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, attr))
+
+    @property
+    def Q_e(self):
+        return self.Q_e_real + 1j * self.Q_e_imag
+
+    @property
+    def Q_i(self):
+        return 1 / (1 / self.Q - np.real(1 / self.Q_e))
+
+    def fit(self, params):
+        """
+        Run the minimization starting from the given parameter array and store the results.
+
+        The attributes set are values and stderr, with the cable parameters followed by the parameters of each
+        resonator, and chi_squared, redchi, success, and nfev.
+        """
+        params = np.array(params, dtype=np.float)
+        if self.jacobian:
+            Dfun = self._jacobian
+        else:
+            Dfun = None
+        values, covariance, info, message, ier = scipy.optimize.leastsq(
+            self._residual, params, Dfun=Dfun, full_output=True, maxfev=self.max_iterations * (params.size + 1))
+        values[CABLE_PARAMETER_NAMES.index('phi')] = np.angle(np.exp(1j * values[CABLE_PARAMETER_NAMES.index('phi')]))
+        self.values = values
+        self.success = ier in (1, 2, 3, 4)
+        self.message = message
+        self.nfev = info['nfev']
+        self.chi_squared = np.sum(info['fvec'] ** 2)
+        self.redchi = self.chi_squared / (2 * self.frequency.size - values.size)
+        if covariance is None:
+            self.stderr = np.full(values.size, np.nan)
+        else:
+            # Like lmfit, scale the covariance by the reduced chi-squared.
+            self.stderr = np.sqrt(np.abs(np.diag(covariance)) * self.redchi)
+
+    def eval(self, frequency=None, values=None):
+        """Return the model evaluated at the given frequencies, which default to the data frequencies."""
+        if frequency is None:
+            frequency = self.frequency
+        if values is None:
+            values = self.values
+        return _model(frequency, self.f_min, values)[0]
+
+    # Private methods.
+
+    def _residual(self, values):
+        """Return the weighted residual with the real and imaginary parts stacked."""
+        difference = _model(self.frequency, self.f_min, values)[0] - self.s21
+        return np.concatenate((self.weights.real * difference.real, self.weights.imag * difference.imag))
+
+    def _jacobian(self, values):
+        """Return the Jacobian of the weighted residual, with shape (2 * points, parameters)."""
+        derivative = _model(self.frequency, self.f_min, values, jacobian=True)[1]
+        return np.concatenate((self.weights.real[:, None] * derivative.real,
+                               self.weights.imag[:, None] * derivative.imag))
+
+
+class ResonatorFromSegment(object):
+    """
+    A single resonator from a SegmentFit, with the same attributes and methods used for analysis of a fitted
+    lmfit_resonator.LinearResonatorWithCable. The background is the cable times the responses of the other resonators.
+    """
+
+    def __init__(self, segment, number):
+        self.segment = segment
+        self.number = number
+
+    def __getattr__(self, attr):
+        name = attr[:-len('_error')] if attr.endswith('_error') else attr
+        if name in CABLE_PARAMETER_NAMES:
+            return getattr(self.segment, attr)
+        elif name in RESONATOR_PARAMETER_NAMES:
+            return getattr(self.segment, attr)[self.number]
+        else:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, attr))
+
+    @property
+    def f_min(self):
+        return self.segment.f_min
+
+    @property
+    def frequency(self):
+        return self.segment.frequency
+
+    @property
+    def s21(self):
+        return self.segment.s21
+
+    data = s21
+
+    @property
+    def errors(self):
+        return self.segment.errors
+
+    @property
+    def redchi(self):
+        return self.segment.redchi
+
+    @property
+    def success(self):
+        return self.segment.success
+
+    @property
+    def Q_i(self):
+        return 1 / (1 / self.Q - np.real(1 / self.Q_e))
+
+    @property
+    def Q_e(self):
+        return self.Q_e_real + 1j * self.Q_e_imag
+
+    def eval(self, frequency=None):
+        if frequency is None:
+            frequency = self.frequency
+        return self.segment.eval(frequency)
+
+    def target_s21(self, frequency=None):
+        if frequency is None:
+            frequency = self.frequency
+        return equations.linear_resonator(frequency, self.f_0, self.Q, self.Q_e_real, self.Q_e_imag)
+
+    def background_s21(self, frequency=None):
+        if frequency is None:
+            frequency = self.frequency
+        background = equations.general_cable(frequency, self.delay, self.phi, self.f_min, self.A_mag, self.A_slope)
+        for other in range(len(self.segment)):
+            if other != self.number:
+                background = background * equations.linear_resonator(
+                    frequency, self.segment.f_0[other], self.segment.Q[other], self.segment.Q_e_real[other],
+                    self.segment.Q_e_imag[other])
+        return background
+
+    def remove_background(self, frequency, s21_raw):
+        return s21_raw / self.background_s21(frequency)
+
+    def approximate_target_gradient(self, frequency, delta_f=1.0):
+        return (self.target_s21(frequency + delta_f) - self.target_s21(frequency)) / delta_f
+
+    def invert_raw(self, frequency, s21_raw):
+        return self.invert(self.remove_background(frequency=frequency, s21_raw=s21_raw))
+
+    def invert(self, s21_normalized):
+        c = 1 / self.Q_e
+        z = c / (1 - s21_normalized)
+        q = z.real - c.real
+        x = z.imag / 2
+        return x, q
+
+
+def guess(frequency, s21, f_0):
+    """
+    Return an array of initial parameter values for a SegmentFit of the given data with resonators near the given
+    frequencies.
+
+    The cable delay, phase, and amplitude come from linear fits to the phase and magnitude of the data, weighted by the
+    squared magnitude so that the resonances contribute little. The data are divided by this cable response, and the
+    width of each resonance is estimated from the points where the distance of the normalized data from 1 falls to half
+    its value at the peak, without crossing halfway to the adjacent peaks. The parameters of each resonator come from
+    circle.estimate() applied to the points within five widths of its peak; if there are too few such points or the
+    estimate is not finite or not within these points, Q comes from the width and Q_e from the depth of the resonance.
+    """
+    f_0 = np.sort(np.atleast_1d(np.asarray(f_0, dtype=np.float)))
+    offset = frequency - frequency.min()
+    weight = np.abs(s21)
+    phase_slope, phi = np.polyfit(offset, np.unwrap(np.angle(s21)), 1, w=weight)
+    magnitude_slope, A_mag = np.polyfit(offset, np.abs(s21), 1, w=weight ** 2)
+    cable = [-phase_slope / (2 * np.pi), np.angle(np.exp(1j * phi)), A_mag, magnitude_slope / A_mag]
+    normalized = s21 / equations.general_cable(frequency, *cable[:2] + [frequency.min()] + cable[2:])
+    distance = np.abs(1 - normalized)
+    boundaries = np.concatenate(([-np.inf], (f_0[1:] + f_0[:-1]) / 2, [np.inf]))
+    delta_f = np.diff(frequency)
+    delta_f = delta_f[delta_f > 0].min()
+    resonators = []
+    for number, peak in enumerate(f_0):
+        inside = np.flatnonzero((boundaries[number] <= frequency) & (frequency < boundaries[number + 1]))
+        if not inside.size:
+            inside = np.array([np.argmin(np.abs(frequency - peak))])
+        center = inside[np.argmin(np.abs(frequency[inside] - peak))]
+        below = inside[(inside < center) & (distance[inside] < distance[center] / 2)]
+        above = inside[(inside > center) & (distance[inside] < distance[center] / 2)]
+        low = frequency[below.max()] if below.size else frequency[inside[0]]
+        high = frequency[above.min()] if above.size else frequency[inside[-1]]
+        width = max(high - low, delta_f)
+        local = inside[np.abs(frequency[inside] - peak) <= 5 * width]
+        if local.size >= 8:
+            estimate = circle.estimate(frequency[local], normalized[local], delay=0)
+            values = [estimate.f_0, estimate.Q, estimate.Q_e_real, estimate.Q_e_imag]
+            if (np.all(np.isfinite(values)) and frequency[local].min() <= estimate.f_0 <= frequency[local].max() and
+                    0 < estimate.Q < estimate.f_0 / delta_f and estimate.Q_e_real > 0):
+                resonators.append(values)
+                continue
+        # For a linear resonator the distance from 1 is Q / |Q_e| at resonance and half that at a detuning of
+        # sqrt(3) / 2 linewidths on each side.
+        Q = np.sqrt(3) * peak / width
+        resonators.append([peak, Q, Q / max(distance[center], 0.01), 0])
+    return np.concatenate((cable, np.ravel(resonators)))
+
+
+def _merge_peaks(peak_indexes, frequency, s21, minimum_separation):
+    """Return the given increasing peak indexes with each group of peaks closer together than minimum_separation
+    replaced by the peak with the smallest s21 magnitude."""
+    if not len(peak_indexes):
+        return np.asarray(peak_indexes, dtype=np.int)
+    groups = np.split(peak_indexes, np.flatnonzero(np.diff(frequency[peak_indexes]) >= minimum_separation) + 1)
+    return np.array([group[np.argmin(np.abs(s21[group]))] for group in groups])
+
+
+def _fit_segment_task(args):
+    frequency, s21, errors, f_0, kwargs = args
+    return SegmentFit(frequency, s21, errors, f_0, **kwargs)
+
+
+def _model(f, f_min, values, jacobian=False):
+    """
+    Return the model s21 for the given frequencies and parameter values and, if jacobian is True, its derivatives with
+    respect to each parameter along a new last axis; otherwise the second return value is None.
+    """
+    delay, phi, A_mag, A_slope = values[:len(CABLE_PARAMETER_NAMES)]
+    resonator_values = values[len(CABLE_PARAMETER_NAMES):].reshape(-1, len(RESONATOR_PARAMETER_NAMES))
+    f_0, Q, Q_e_real, Q_e_imag = [resonator_values[:, k, None] for k in range(len(RESONATOR_PARAMETER_NAMES))]
+    offset = f - f_min
+    phase = np.exp(1j * (-2 * np.pi * offset * delay + phi))
+    cable = A_mag * (1 + A_slope * offset) * phase
+    inverse_Q_e = 1 / (Q_e_real + 1j * Q_e_imag)
+    denominator = 1 + 2j * Q * (f - f_0) / f_0
+    coupling = Q * inverse_Q_e / denominator
+    resonators = 1 - coupling
+    product = np.prod(resonators, axis=0)
+    s21 = cable * product
+    if not jacobian:
+        return s21, None
+    # The product of the responses of all resonators except each one, computed without division since a response can
+    # be zero at resonance.
+    ones = np.ones((1,) + np.shape(f), dtype=np.complex)
+    before = np.cumprod(np.concatenate((ones, resonators[:-1])), axis=0)
+    after = np.cumprod(np.concatenate((ones, resonators[:0:-1])), axis=0)[::-1]
+    others = cable * before * after
+    derivative = np.empty(np.shape(f) + (values.size,), dtype=np.complex)
+    derivative[..., 0] = -2j * np.pi * offset * s21
+    derivative[..., 1] = 1j * s21
+    derivative[..., 2] = s21 / A_mag
+    derivative[..., 3] = A_mag * offset * phase * product
+    resonator_derivative = np.empty(np.shape(f) + resonator_values.shape, dtype=np.complex)
+    resonator_derivative[..., 0] = (-others * coupling * 2j * Q * f / (f_0 ** 2 * denominator)).T
+    resonator_derivative[..., 1] = (-others * coupling / (Q * denominator)).T
+    resonator_derivative[..., 2] = (others * coupling * inverse_Q_e).T
+    resonator_derivative[..., 3] = (1j * others * coupling * inverse_Q_e).T
+    derivative[..., len(CABLE_PARAMETER_NAMES):] = resonator_derivative.reshape(np.shape(f) + (-1,))
+    return s21, derivative
@@ -4,9 +4,10 @@ This module uses models from the Khalil paper.
 from __future__ import division
 
 import numpy as np
-from scipy.special import cbrt
 from lmfit import Parameters
 
+from kid_readout.analysis.resonator import equations
+
 
 def qi_error(Q, Q_err, Q_e_real, Q_e_real_err, Q_e_imag, Q_e_imag_err):
     """
@@ -130,6 +131,7 @@ def bifurcation_s21(params, f):
     """
     Swenson paper:
         Equation: y = yo + A/(1+4*y**2)
+    See equations.nonlinear_detuning() for the choice of root in the bistable region.
     """
     A = (params['A_mag'].value *
          np.exp(1j * params['A_phase'].value))
@@ -137,31 +139,32 @@ def bifurcation_s21(params, f):
     Q = params['Q'].value
     Q_e = (params['Q_e_real'].value +
            1j * params['Q_e_imag'].value)
-
     a = params['a'].value
+    y = equations.nonlinear_detuning(Q * (f - f_0) / f_0, a)
+    return A * (1 - (Q / Q_e) / (1 + 2j * y)) * cable_delay(params, f)
 
-    if np.isscalar(f):
-        fmodel = np.linspace(f * 0.9999, f * 1.0001, 1000)
-        scalar = True
-    else:
-        fmodel = f
-        scalar = False
-    y_0 = ((fmodel - f_0) / f_0) * Q
-    y = (y_0 / 3. +
-         (y_0 ** 2 / 9 - 1 / 12) / cbrt(a / 8 + y_0 / 12 + np.sqrt(
-             (y_0 ** 3 / 27 + y_0 / 12 + a / 8) ** 2 - (y_0 ** 2 / 9 - 1 / 12) ** 3) + y_0 ** 3 / 27) +
-         cbrt(a / 8 + y_0 / 12 + np.sqrt(
-             (y_0 ** 3 / 27 + y_0 / 12 + a / 8) ** 2 - (y_0 ** 2 / 9 - 1 / 12) ** 3) + y_0 ** 3 / 27))
-    x = y / Q
-    s21 = A * (1 - (Q / Q_e) / (1 + 2j * Q * x))
-    mask = np.isfinite(s21)
-    if scalar or not np.all(mask):
-        s21_interp_real = np.interp(f, fmodel[mask], s21[mask].real)
-        s21_interp_imag = np.interp(f, fmodel[mask], s21[mask].imag)
-        s21new = s21_interp_real + 1j * s21_interp_imag
-    else:
-        s21new = s21
-    return s21new * cable_delay(params, f)
+
+def bifurcation_s21_jacobian(params, f):
+    """
+    Return a dict with keys that are the names of the parameters used by bifurcation_s21 and values that are the
+    partial derivatives of the model with respect to each parameter, evaluated at f.
+    """
+    A = (params['A_mag'].value *
+         np.exp(1j * params['A_phase'].value))
+    values = dict((name, params[name].value) for name in ['f_0', 'Q', 'Q_e_real', 'Q_e_imag', 'a'])
+    cable = cable_delay(params, f)
+    resonator = equations.nonlinear_resonator(f, **values)
+    prefactor = A * cable
+    s21 = prefactor * resonator
+    jacobian = dict((name, prefactor * derivative)
+                    for name, derivative in equations.nonlinear_resonator_derivatives(f, **values).items())
+    # This is computed directly, rather than as s21 / A_mag, because A_mag can be 0 at its lower bound.
+    jacobian['A_mag'] = np.exp(1j * params['A_phase'].value) * cable * resonator
+    jacobian['A_phase'] = 1j * s21
+    jacobian['phi'] = 1j * s21
+    jacobian['delay'] = -2j * np.pi * (f - params['f_phi'].value) * s21
+    jacobian['f_phi'] = 2j * np.pi * params['delay'].value * s21
+    return jacobian
 
 
 def delayed_generic_s21(params, f):
@@ -10,11 +10,11 @@ from kid_readout.analysis.resonator.khalil import delayed_generic_guess as defau
 from kid_readout.analysis.resonator.khalil import generic_functions as default_functions
 
 # todo: move this elsewhere
-from kid_readout.analysis.resonator.khalil import bifurcation_s21, bifurcation_guess
+from kid_readout.analysis.resonator.khalil import bifurcation_s21, bifurcation_guess, bifurcation_s21_jacobian
 
 # todo: move this elsewhere
 def fit_resonator(freq, s21, mask=None, errors=None, min_a=0.08, fstat_thresh=0.999,
-                  delay_estimate=None, verbose=False):
+                  delay_estimate=None, verbose=False, initial_a=0.1):
     if delay_estimate is not None:
         def my_default_guess(f, data):
             params = default_guess(f, data)
@@ -31,24 +31,23 @@ def fit_resonator(freq, s21, mask=None, errors=None, min_a=0.08, fstat_thresh=0.
 
     rr = Resonator(freq, s21, mask=mask, errors=errors, guess=my_default_guess)
 
-    if delay_estimate is not None:
-        def my_bifurcation_guess(freq, data):
-            params = bifurcation_guess(freq, data)
-            params['delay'].value = delay_estimate
-            return params
-    else:
-        my_bifurcation_guess = bifurcation_guess
+    # The bifurcation model equals the linear model when a = 0, so its fit starts from the linear fit; it uses the
+    # analytic derivatives of the model, which vanish for a parameter at a limit, so a starts inside its limits.
+    def my_bifurcation_guess(freq, data):
+        params = rr.result.params.copy()
+        params.add('a', value=initial_a, min=0, max=0.8)
+        return params
 
     bif = Resonator(freq, s21, mask=mask, errors=errors,
-                    guess=my_bifurcation_guess, model=bifurcation_s21)
-    fval = scipy.stats.f_value(np.sum(np.abs(rr.residual())**2),
-                               np.sum(np.abs(bif.residual())**2),
-                               rr.result.nfree, bif.result.nfree)
+                    guess=my_bifurcation_guess, model=bifurcation_s21, jacobian=bifurcation_s21_jacobian)
+    bif_residual = np.sum(np.abs(bif.residual())**2)
+    rr_residual = np.sum(np.abs(rr.residual())**2)
+    # This is the F statistic for the nested models, which scipy.stats.f_value computed before it was removed.
+    fval = (((rr_residual - bif_residual) / (rr.result.nfree - bif.result.nfree)) /
+            (bif_residual / bif.result.nfree))
     fstat = scipy.stats.distributions.f.cdf(fval, rr.result.nfree, bif.result.nfree)
     aval = bif.result.params['a'].value
     aerr = bif.result.params['a'].stderr
-    bif_residual = np.sum(np.abs(bif.residual())**2)
-    rr_residual = np.sum(np.abs(rr.residual())**2)
     reasons = []
     prefer_bif = True
     if rr_residual < bif_residual:
@@ -100,7 +99,7 @@ class Resonator(fitter.Fitter):
 
     def __init__(self, freq, s21,
                  model=default_model, guess=default_guess, functions=default_functions,
-                 mask=None, errors=None):
+                 mask=None, errors=None, jacobian=None):
         """
         Fit a resonator using the given model.
 
@@ -117,13 +116,17 @@ class Resonator(fitter.Fitter):
 
         mask: a boolean array of the same length as f and s21; only points f[mask] and s21[mask] are used to fit the
         data and the default is to use all data; use this to exclude glitches or resonances other than the desired one.
+
+        jacobian: a function jacobian(params, f) that returns a dictionary of the partial derivatives of the model with
+        respect to each parameter; if given, the fit uses these instead of finite differences.
         """
         if not np.iscomplexobj(s21):
             raise TypeError("Resonator s21 must be complex.")
         if errors is not None and not np.iscomplexobj(errors):
             raise TypeError("Resonator s21 errors must be complex.")
         super(Resonator, self).__init__(freq, s21,
-                                        model=model, guess=guess, functions=functions, mask=mask, errors=errors)
+                                        model=model, guess=guess, functions=functions, mask=mask, errors=errors,
+                                        jacobian=jacobian)
         self.freq_data = self.x_data
         self.s21_data = self.y_data
         self.freq_units_MHz = self.freq_data.max() < 1e6
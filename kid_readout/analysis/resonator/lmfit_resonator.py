@@ -1,12 +1,14 @@
 from __future__ import division
 from collections import namedtuple
+import logging
 
 import lmfit
 import numpy as np
 
 from kid_readout.analysis.lmfit_fitter import FitterWithAttributeAccess
-from kid_readout.analysis.resonator import lmfit_models
+from kid_readout.analysis.resonator import circle, lmfit_models
 
+logger = logging.getLogger(__name__)
 
 # This is a simple format for extracted resonator data, useful for plotting.
 # The _data arrays are the raw frequency and s21 data;
@@ -16,10 +18,15 @@ ResonatorData = namedtuple('ResonatorData', field_names=['f_data', 's21_data',
                                                          'f_model', 's21_model',
                                                          'f_0', 's21_0'])
 
+# These attributes of an lmfit.model.ModelResult are returned by BaseResonator.fit_summary().
+FIT_SUMMARY_ATTRIBUTES = ('method', 'nfev', 'success', 'errorbars', 'message', 'ier', 'lmdif_message', 'ndata',
+                          'nvarys', 'nfree', 'chisqr', 'redchi', 'aic', 'bic', 'covar', 'var_names', 'init_values')
+
 
 class BaseResonator(FitterWithAttributeAccess):
 
-    def __init__(self, frequency, s21, errors, model, **kwargs):
+    def __init__(self, frequency, s21, errors, model, params=None, cache=None, cache_key=None, summary=None,
+                 **kwargs):
         """
         General resonator fitting class.
 
@@ -35,6 +42,18 @@ class BaseResonator(FitterWithAttributeAccess):
             the model for the resonator. Common models are provided in lmfit_models. If the model is composite,
             it is assumed to be of the form background * target, where target is the model of the target resonator
             itself, and background represents any other nuisance effects (cable delay, other adjacent resonators etc.)
+        params: None or lmfit.Parameters
+            initial values and limits for the fit that is done on creation; None means use the guess from the model.
+            Passing the result of an earlier fit of the same resonator makes the fit converge in a few iterations. If
+            the fit from these values fails, the resonator is fit again starting from the guess.
+        cache: None or ParameterCache
+            if params is None, start from the parameters of a matching earlier fit in this cache, if there is one;
+            after the fit, store the result in the cache.
+        cache_key: hashable
+            a key, such as a tone index, that identifies the resonator in the cache together with its frequency.
+        summary: None or tuple
+            the result of fit_summary() for a resonator of the same class fit to the same data, usually in another
+            process; if given, the fit result is restored from it instead of being fit again.
         kwargs:
             passed on to model.fit
         """
@@ -63,8 +82,57 @@ class BaseResonator(FitterWithAttributeAccess):
         #self.frequency = frequency
         self.errors = errors
         #self.weights = weights
+        if summary is not None:
+            self._restore(*summary)
+        else:
+            if params is None and cache is not None:
+                params = cache.get(self, key=cache_key)
+            if params is None:
+                self.fit()
+            else:
+                self._warm_fit(params)
+        if cache is not None:
+            cache.put(self, key=cache_key)
+
+    def _warm_fit(self, params):
+        """
+        Fit starting from the given parameters and, if that fails, fit again starting from the guess.
+
+        Note that the parameters have to be set as the current parameters instead of being passed to fit(), because
+        Fitter.fit() passes the current parameters to the model as keywords, which take precedence.
+        """
+        self.current_params = params
+        try:
+            self.fit()
+            if np.isfinite(self.current_result.redchi):
+                return
+        except Exception as e:
+            logger.debug("Fit from initial parameters raised {!r}".format(e))
+        logger.debug("Fit from initial parameters failed; fitting from the guess.")
+        self.guess()
         self.fit()
 
+    def fit_summary(self):
+        """
+        Return the fitted parameters, including their errors, and a dict of the fit statistics. Unlike the resonator
+        and its fit result, these can be pickled, so a resonator fit in another process can be restored by passing them
+        as the summary argument of the constructor.
+        """
+        statistics = dict((name, getattr(self.current_result, name, None)) for name in FIT_SUMMARY_ATTRIBUTES)
+        return self.current_result.params, statistics
+
+    def _restore(self, params, statistics):
+        """Set the current parameters and a fit result with the given parameters and statistics, without fitting."""
+        result = lmfit.model.ModelResult(self.model, params, data=self._data, weights=self.weights,
+                                         fcn_kws={'f': self.frequency})
+        result.params = params
+        for name, value in statistics.items():
+            setattr(result, name, value)
+        result.best_fit = self.model.eval(params, f=self.frequency)
+        result.residual = self.model._residual(params, self._data, self.weights, f=self.frequency)
+        self.current_result = result
+        self.current_params = params
+
     # To reduce confusion, let's store these in only one place; see lmfit.ui.basefitter.BaseFitter
 
     @property
@@ -296,9 +364,30 @@ def _linear_resonator_with_cable_guess(data, f=None, **kwargs):
     cable_params = _general_cable_model.guess(data=data, f=f, **kwargs)
     resonator_params = _linear_resonator_model.guess(data=data, f=f, **kwargs)
     cable_params.update(resonator_params)
+    if f is not None:
+        _update_from_circle(cable_params, f, data, kwargs)
     return cable_params
 
 
+def _update_from_circle(params, f, data, fixed, prefix=''):
+    """
+    Replace the heuristic values in params with the estimates from circle.estimate() if every estimate is finite and
+    within the limits of its parameter; values of parameters that appear in fixed, the guess keywords, are kept. The
+    given prefix is added to the names of the resonator parameters, so that the estimate can be used for one of several
+    resonators in a model.
+    """
+    estimate = dict((prefix + name if name in _linear_resonator_model.param_names else name, value)
+                    for name, value in circle.estimate(f, data)._asdict().items())
+    for name, value in estimate.items():
+        if not (np.isfinite(value) and params[name].min <= value <= params[name].max):
+            logger.debug("Circle estimate {} = {} is not usable; using heuristic guess.".format(name, value))
+            return params
+    for name, value in estimate.items():
+        if name not in fixed:
+            params[name].value = value
+    return params
+
+
 _linear_resonator_with_cable.guess = _linear_resonator_with_cable_guess
 
 
@@ -327,6 +416,9 @@ def _colliding_linear_resonators_with_cable_guess(data, f=None, **kwargs):
     bg_resonator_params = _background_resonator_model.guess(data=data, f=f, **kwargs)
     cable_params.update(resonator_params)
     cable_params.update(bg_resonator_params)
+    # The circle estimate describes the deepest resonance, which is the foreground resonator.
+    if f is not None:
+        _update_from_circle(cable_params, f, data, kwargs, prefix=_foreground_resonator_model.prefix)
     return cable_params
 
 
@@ -417,3 +509,73 @@ class LinearLossResonatorWithCable(BaseResonator):
     @property
     def Q_i(self):
         return 1 / self.loss_i
+
+
+class ParameterCache(object):
+    """
+    Store the best-fit parameter values of resonator fits so that later fits of the same resonators, such as the
+    repeated sweeps in a temperature or power series, can start from them instead of from the guess.
+
+    Entries are grouped by resonator class and by an optional key, such as a tone index, and are identified within a
+    group by their resonance frequency. The entry used to start a fit is the one whose f_0 lies within the frequency
+    range of the new data and is closest to its center; a new result replaces that entry.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return sum(len(group) for group in self._entries.values())
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, resonator, key=None):
+        """
+        Return lmfit.Parameters for the given resonator with values from the matching entry and limits from its current
+        parameters, widened if necessary to include the values, or return None if there is no matching entry. Fixed
+        parameters, such as the reference frequency of the cable model, keep their current values because they depend
+        on the new data.
+        """
+        f_0 = self._find(type(resonator), resonator.frequency, key)
+        if f_0 is None:
+            return None
+        params = resonator.current_params.copy()
+        for name, value in self._entries[(type(resonator), key)][f_0].items():
+            if name in params and params[name].vary and params[name].expr is None:
+                param = params[name]
+                if param.min is not None and value < param.min:
+                    param.min = value
+                if param.max is not None and value > param.max:
+                    param.max = value
+                param.value = value
+        return params
+
+    def put(self, resonator, key=None):
+        """Store the current parameter values of the given fitted resonator, replacing the matching entry."""
+        f_0 = self._find(type(resonator), resonator.frequency, key)
+        group = self._entries.setdefault((type(resonator), key), {})
+        if f_0 is not None:
+            del group[f_0]
+        group[resonator.f_0] = dict((name, param.value) for name, param in resonator.current_params.items())
+
+    def select(self, model, frequency, key=None):
+        """
+        Return a new ParameterCache that contains only the entry that matches a fit of the given data with the given
+        resonator class, if there is one. This is much smaller to send to another process than the whole cache.
+        """
+        selected = ParameterCache()
+        f_0 = self._find(model, frequency, key)
+        if f_0 is not None:
+            selected._entries[(model, key)] = {f_0: self._entries[(model, key)][f_0]}
+        return selected
+
+    def _find(self, model, frequency, key):
+        group = self._entries.get((model, key), {})
+        f_min = np.min(frequency)
+        f_max = np.max(frequency)
+        within = [f_0 for f_0 in group if f_min <= f_0 <= f_max]
+        if not within:
+            return None
+        center = (f_min + f_max) / 2
+        return min(within, key=lambda f_0: abs(f_0 - center))
@@ -0,0 +1,229 @@
+"""
+This module finds resonances in scans with many points in a single pass over the data, which can arrive in chunks while
+the scan is being acquired.
+
+The s21 magnitude is divided by a running mean over a window much wider than a resonance, which removes the scale of
+the cable response; points in deep dips below a first running mean are excluded from a second one, so that the
+resonances do not affect the background. The fractional dip is correlated with a Lorentzian of the expected linewidth
+minus its mean. Because this kernel has zero mean and is symmetric, the correlation ignores any remaining constant or linear trend in
+the background, and at a resonance of the expected linewidth it equals the depth of the dip. The noise is estimated
+from the median absolute difference between adjacent points, which is insensitive to the resonances. Candidates are the
+local maxima of the correlation that exceed a threshold in units of its noise.
+
+Each point is processed once, the cost is linear in the number of points, and the memory used depends only on the
+window widths and the chunk size, so scans with millions of points can be searched as they are acquired. The points
+should be approximately evenly spaced in frequency, since the windows are fixed numbers of points.
+"""
+from __future__ import division
+from collections import namedtuple
+
+import numpy as np
+from scipy import ndimage
+
+# The index is the position of the point in the data given to the finder, counting from zero.
+PeakCandidate = namedtuple('PeakCandidate', field_names=['index', 'frequency', 'depth', 'snr'])
+
+
+class StreamingPeakFinder(object):
+    """
+    Find resonances in data given in chunks of increasing frequency.
+
+    Call update() with each chunk of data, in order; it returns the candidates that are final, which are those far
+    enough from the end of the data received so far that later data cannot change them. Call finish() after the last
+    chunk to return the remaining candidates.
+    """
+
+    def __init__(self, linewidth, frequency_step, background_linewidths=50, kernel_linewidths=3, threshold=5,
+                 separation_linewidths=1, clip=3):
+        """
+        Parameters
+        ----------
+        linewidth : float
+            The expected full width at half maximum of the resonances, f_0 / Q, in the same units as the frequencies.
+        frequency_step : float
+            The spacing of the points.
+        background_linewidths : float
+            The width of the running mean used for the background, in linewidths.
+        kernel_linewidths : float
+            The half-width of the matched filter kernel, in linewidths.
+        threshold : float
+            The minimum ratio of the matched filter output to its noise for a candidate.
+        separation_linewidths : float
+            A candidate must be the largest output within this many linewidths on either side.
+        clip : float
+            Points with a fractional dip below a first estimate of the background larger than this many standard
+            deviations of the noise are excluded from the final background estimate.
+        """
+        self.linewidth = linewidth
+        self.frequency_step = frequency_step
+        self.threshold = threshold
+        self.clip = clip
+        width = linewidth / frequency_step  # in points
+        self.background_half_width = max(int(round(background_linewidths * width / 2)), 1)
+        self.kernel_half_width = max(int(round(kernel_linewidths * width)), 1)
+        self.separation = max(int(round(separation_linewidths * width)), 1)
+        x = np.arange(-self.kernel_half_width, self.kernel_half_width + 1)
+        lorentzian = 1 / (1 + (2 * x / width) ** 2)
+        kernel = lorentzian - lorentzian.mean()
+        # Dividing by this normalization makes the output equal to the depth of a matched dip.
+        normalization = np.sum(lorentzian * kernel)
+        self.kernel = kernel / normalization
+        self.kernel_norm = np.sqrt(np.sum(self.kernel ** 2))
+        self.num_points = 0
+        self.finished = False
+        self._magnitude = np.empty(0)
+        self._frequency = np.empty(0)
+        self._offset = 0  # The index of the first point in the buffers, which is negative while the padding remains.
+        self._noise_sum = 0.
+        self._noise_count = 0
+        self._noise_stop = 0  # The index after the last point used for the noise estimate.
+        self._pending = np.empty(0, dtype=[('index', np.int), ('frequency', np.float), ('depth', np.float),
+                                           ('snr', np.float)])
+        self._decided = 0  # The number of pending outputs already checked for candidates.
+
+    @property
+    def noise(self):
+        """float: the current estimate of the standard deviation of the fractional s21 magnitude of one point."""
+        if not self._noise_count:
+            return np.nan
+        return np.sqrt(self._noise_sum / self._noise_count)
+
+    def update(self, frequency, s21):
+        """
+        Process a chunk of data and return a list of the new final PeakCandidates.
+
+        Parameters
+        ----------
+        frequency : numpy.ndarray(float)
+            The frequencies of the chunk, which must be larger than those of the previous chunk.
+        s21 : numpy.ndarray(complex or float)
+            The s21 data or its magnitude.
+        """
+        if self.finished:
+            raise ValueError("This finder has already finished.")
+        frequency = np.asarray(frequency, dtype=np.float)
+        magnitude = np.abs(s21).astype(np.float)
+        if not frequency.size:
+            return []
+        if not self.num_points:
+            # Pad the start by repeating the first point so that points near the edge are processed.
+            pad = self._padding
+            self._magnitude = np.full(pad, magnitude[0])
+            self._frequency = frequency[0] - self.frequency_step * np.arange(pad, 0, -1)
+            self._offset = -pad
+        self.num_points += frequency.size
+        self._magnitude = np.concatenate((self._magnitude, magnitude))
+        self._frequency = np.concatenate((self._frequency, frequency))
+        return self._process(final=False)
+
+    def finish(self):
+        """Process the end of the data and return a list of the remaining PeakCandidates."""
+        if self.finished:
+            return []
+        self.finished = True
+        if not self.num_points:
+            return []
+        pad = self._padding
+        self._magnitude = np.concatenate((self._magnitude, np.full(pad, self._magnitude[-1])))
+        self._frequency = np.concatenate((self._frequency,
+                                          self._frequency[-1] + self.frequency_step * np.arange(1, pad + 1)))
+        return self._process(final=True)
+
+    # Private methods.
+
+    @property
+    def _padding(self):
+        return 2 * self.background_half_width + self.kernel_half_width
+
+    def _process(self, final):
+        h = self._padding
+        n = self._magnitude.size
+        if n <= 2 * h:
+            new = self._pending[:0]
+        else:
+            # The first running mean is valid from b to n - b. Points that are clearly in a dip are excluded from the
+            # second running mean, which is valid from 2 * b to n - 2 * b, so that a deep resonance does not lower the
+            # background around it; the filter output is then valid from h to n - h.
+            b = self.background_half_width
+            first = _running_mean(self._magnitude, b)
+            first_dip = 1 - self._magnitude[b:n - b] / first
+            self._update_noise(first_dip, self._offset + b)
+            if np.isfinite(self.noise):
+                weight = (first_dip <= self.clip * self.noise).astype(np.float)
+            else:
+                weight = np.ones(first_dip.size)
+            total = _running_mean(weight * self._magnitude[b:n - b], b)
+            count = _running_mean(weight, b)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                background = np.where(count > 0, total / count, first[b:first.size - b])
+            dip = 1 - self._magnitude[2 * b:n - 2 * b] / background
+            depth = np.correlate(dip, self.kernel, mode='valid')
+            new = np.empty(depth.size, dtype=self._pending.dtype)
+            new['index'] = self._offset + np.arange(h, n - h)
+            new['frequency'] = self._frequency[h:n - h]
+            new['depth'] = depth
+            new['snr'] = depth / (self.noise * self.kernel_norm)
+            # Keep the data needed for the next output point, which is n - h.
+            self._magnitude = self._magnitude[n - 2 * h:]
+            self._frequency = self._frequency[n - 2 * h:]
+            self._offset += n - 2 * h
+        pending = np.concatenate((self._pending, new))
+        if final:
+            stop = pending.size
+        else:
+            stop = max(pending.size - self.separation, self._decided)
+        maximum = ndimage.maximum_filter1d(pending['snr'], size=2 * self.separation + 1, mode='constant',
+                                           cval=-np.inf)
+        checked = np.arange(self._decided, stop)
+        peaks = checked[(pending['snr'][checked] > self.threshold) &
+                        (pending['snr'][checked] == maximum[checked])]
+        candidates = [PeakCandidate(*[p.item() for p in pending[k]]) for k in peaks]
+        # Keep the outputs that are not yet checked and the ones before them that affect their local maxima.
+        keep = max(stop - self.separation, 0)
+        self._pending = pending[keep:]
+        self._decided = stop - keep
+        return candidates
+
+    def _update_noise(self, dip, start):
+        # Use each point once, and not the padding.
+        index = start + np.arange(dip.size)
+        dip = dip[(index >= self._noise_stop) & (index >= 0) & (index < self.num_points)]
+        if dip.size < 2:
+            return
+        self._noise_stop = index[-1] + 1
+        # For Gaussian noise, the median absolute difference of adjacent points is 0.954 standard deviations.
+        sigma = np.median(np.abs(np.diff(dip))) / (np.sqrt(2) * 0.6745)
+        self._noise_sum += dip.size * sigma ** 2
+        self._noise_count += dip.size
+
+
+def _running_mean(x, half_width):
+    """Return the means of the windows of 2 * half_width + 1 points that fit entirely within x."""
+    cumulative = np.concatenate(([0], np.cumsum(x)))
+    return (cumulative[2 * half_width + 1:] - cumulative[:-2 * half_width - 1]) / (2 * half_width + 1)
+
+
+def find_peaks(frequency, s21, linewidth, chunk_size=2 ** 16, **kwargs):
+    """
+    Return a list of the PeakCandidates in the given data, processing them in chunks with a StreamingPeakFinder.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray(float)
+        The increasing, approximately evenly spaced frequencies.
+    s21 : numpy.ndarray(complex or float)
+        The s21 data or its magnitude.
+    linewidth : float
+        The expected full width at half maximum of the resonances.
+    chunk_size : int
+        The number of points processed at once.
+    kwargs
+        Keyword arguments passed to StreamingPeakFinder.
+    """
+    frequency = np.asarray(frequency)
+    finder = StreamingPeakFinder(linewidth=linewidth, frequency_step=np.median(np.diff(frequency)), **kwargs)
+    candidates = []
+    for start in range(0, frequency.size, chunk_size):
+        candidates.extend(finder.update(frequency[start:start + chunk_size], s21[start:start + chunk_size]))
+    candidates.extend(finder.finish())
+    return candidates
@@ -0,0 +1,62 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import batch, lmfit_resonator
+from kid_readout.analysis.resonator.test.utilities import fake_resonators
+
+
+def test_guess_matches_lmfit_models():
+    f, s21, errors, f_0, Q, Q_e = fake_resonators()
+    values = batch.guess(f, s21)
+    for number in range(f.shape[0]):
+        params = lmfit_resonator._linear_resonator_with_cable.guess(data=s21[number], f=f[number])
+        np.testing.assert_allclose(values[number], [params[name].value for name in batch.PARAMETER_NAMES],
+                                   rtol=1e-9)
+
+
+def test_fit_matches_lmfit():
+    f, s21, errors, f_0, Q, Q_e = fake_resonators()
+    b = batch.BatchLinearResonatorWithCable(f, s21, errors)
+    assert np.all(b.success)
+    assert np.all(np.abs(b.f_0 - f_0) < 5 * b.f_0_error)
+    assert np.all(np.abs(b.Q - Q) < 5 * b.Q_error)
+    for number in range(f.shape[0]):
+        r = lmfit_resonator.LinearResonatorWithCable(f[number], s21[number], errors[number])
+        np.testing.assert_allclose(b.redchi[number], r.current_result.redchi, rtol=1e-4)
+        np.testing.assert_allclose(b.f_0[number], r.f_0, rtol=1e-8)
+        np.testing.assert_allclose(b.Q[number], r.Q, rtol=1e-3)
+        single = b[number]
+        np.testing.assert_allclose(single.Q_i, r.Q_i, rtol=1e-3)
+        np.testing.assert_allclose(single.eval(), r.eval(), atol=1e-3)
+        x, q = single.invert_raw(f[number], s21[number])
+        x_lmfit, q_lmfit = r.invert_raw(f[number], s21[number])
+        np.testing.assert_allclose(x, x_lmfit, atol=1e-6)
+
+
+def test_fit_off_center():
+    # The circle guess is accurate enough that sweeps centered on f_0 and sweeps detuned from it should both converge.
+    for center in (1, -2):
+        f, s21, errors, f_0, Q, Q_e = fake_resonators(center=center)
+        b = batch.BatchLinearResonatorWithCable(f, s21, errors)
+        assert np.all(b.success)
+        assert np.all(np.abs(b.f_0 - f_0) < 5 * b.f_0_error)
+        assert np.all(np.abs(b.Q - Q) < 5 * b.Q_error)
+        for number in range(f.shape[0]):
+            r = lmfit_resonator.LinearResonatorWithCable(f[number], s21[number], errors[number])
+            np.testing.assert_allclose(b.f_0[number], r.f_0, rtol=1e-8)
+            np.testing.assert_allclose(b.Q[number], r.Q, rtol=1e-3)
+
+
+def test_analytic_jacobian():
+    f, s21, errors, f_0, Q, Q_e = fake_resonators(num_resonators=2)
+    values = batch.guess(f, s21)
+    values[:, batch.PARAMETER_NAMES.index('Q_e_imag')] = 1e4  # The guess is zero.
+    f_min = f.min(axis=1)[:, None]
+    model, derivative = batch._model(f, f_min, values, jacobian=True)
+    for k in range(len(batch.PARAMETER_NAMES)):
+        step = 1e-9 * np.maximum(np.abs(values[:, k]), 1e-9)
+        plus = values.copy()
+        plus[:, k] += step
+        minus = values.copy()
+        minus[:, k] -= step
+        numerical = (batch._model(f, f_min, plus)[0] - batch._model(f, f_min, minus)[0]) / (2 * step[:, None])
+        np.testing.assert_allclose(derivative[..., k], numerical, rtol=1e-3, atol=1e-3 * np.abs(numerical).max())
@@ -0,0 +1,41 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import circle
+from kid_readout.analysis.resonator.test.utilities import fake_resonators
+
+
+def test_fit_circle():
+    angle = np.linspace(0, 5, 50)
+    center = np.array([1 + 2j, -0.3 + 0.1j])
+    radius = np.array([0.5, 0.01])
+    s21 = center[:, None] + radius[:, None] * np.exp(1j * angle)
+    fit_center, fit_radius = circle.fit_circle(s21)
+    np.testing.assert_allclose(fit_center, center, rtol=1e-10)
+    np.testing.assert_allclose(fit_radius, radius, rtol=1e-10)
+    single_center, single_radius = circle.fit_circle(s21[1])
+    np.testing.assert_allclose(single_center, center[1], rtol=1e-10)
+
+
+def test_estimate_without_noise():
+    f, s21, errors, f_0, Q, Q_e = fake_resonators(num_points=200, noise=0, center=1)
+    # Each pass reduces the error of the cable estimate, so the estimate converges to the exact values.
+    estimate = circle.estimate(f, s21, passes=10)
+    np.testing.assert_allclose(estimate.f_0, f_0, rtol=1e-10)
+    np.testing.assert_allclose(estimate.Q, Q, rtol=1e-6)
+    np.testing.assert_allclose(estimate.Q_e_real + 1j * estimate.Q_e_imag, Q_e, rtol=1e-6)
+    np.testing.assert_allclose(estimate.A_mag, 0.8, rtol=1e-6)
+    np.testing.assert_allclose(estimate.phi, 0.5, rtol=1e-6)
+    np.testing.assert_allclose(estimate.A_slope, 1e-7, rtol=1e-4)
+    np.testing.assert_allclose(estimate.delay, 30e-9, rtol=1e-4)
+
+
+def test_estimate():
+    f, s21, errors, f_0, Q, Q_e = fake_resonators(num_points=200, noise=0.002, center=1)
+    estimate = circle.estimate(f, s21)
+    assert np.all(np.abs(estimate.f_0 / f_0 - 1) < 0.1 / Q)
+    assert np.all(np.abs(estimate.Q / Q - 1) < 0.05)
+    np.testing.assert_allclose(estimate.delay, 30e-9, rtol=0.3)
+    np.testing.assert_allclose(estimate.A_mag, 0.8, rtol=0.01)
+    single = circle.estimate(f[0], s21[0])
+    assert isinstance(single.Q, float)
+    np.testing.assert_allclose(np.array(single), np.column_stack(estimate)[0], rtol=1e-12)
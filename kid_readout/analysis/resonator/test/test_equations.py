@@ -0,0 +1,70 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import equations, khalil
+
+
+def test_nonlinear_detuning():
+    y_0 = np.linspace(-5, 5, 10001)
+    for a in [0, 0.3, 0.7, 1.5, 3]:
+        for increasing in [True, False]:
+            y = equations.nonlinear_detuning(y_0, a, increasing=increasing)
+            np.testing.assert_allclose(y - y_0, a / (1 + 4 * y ** 2), atol=1e-12)
+            # The detuning is continuous except for a single jump in the bistable region.
+            assert np.sum(np.abs(np.diff(y)) > 0.05) == (a > 4 * np.sqrt(3) / 9)
+    up = equations.nonlinear_detuning(y_0, 3)
+    down = equations.nonlinear_detuning(y_0, 3, increasing=False)
+    assert np.all(up <= down)
+    assert np.any(up < down)
+
+
+def test_nonlinear_resonator():
+    f = np.linspace(99.99, 100.01, 101)
+    params = dict(f_0=100.0002, Q=2e4, Q_e_real=3e4, Q_e_imag=5e3)
+    np.testing.assert_allclose(equations.nonlinear_resonator(f, a=0, **params),
+                               equations.linear_resonator(f, **params), atol=1e-12)
+    s21 = equations.nonlinear_resonator(f, a=0.5, **params)
+    np.testing.assert_allclose([equations.nonlinear_resonator(f[k], a=0.5, **params) for k in range(f.size)], s21,
+                               atol=1e-14)
+
+
+def test_nonlinear_resonator_derivatives():
+    f = np.linspace(99.99, 100.01, 51)
+    params = dict(f_0=100.0002, Q=2e4, Q_e_real=3e4, Q_e_imag=5e3, a=0.5)
+    derivatives = equations.nonlinear_resonator_derivatives(f, **params)
+    for name, value in params.items():
+        step = 1e-9 * value
+        plus = dict(params, **{name: value + step})
+        minus = dict(params, **{name: value - step})
+        numerical = ((equations.nonlinear_resonator(f, **plus) - equations.nonlinear_resonator(f, **minus)) /
+                     (2 * step))
+        np.testing.assert_allclose(derivatives[name], numerical, rtol=1e-4, atol=1e-6 * np.abs(numerical).max())
+
+
+def test_bifurcation_s21_jacobian():
+    f = np.linspace(99.99, 100.01, 51)
+    params = khalil.create_model(f_0=100.0002, Q=2e4, Q_e=3e4 + 5e3j, A=0.5 * np.exp(1j), delay=0.05, a=0.5)
+    params['f_phi'].value = f[0]
+    params['A_phase'].value = 0.2
+    jacobian = khalil.bifurcation_s21_jacobian(params, f)
+    assert set(jacobian) == set(params)
+    for name in params:
+        step = 1e-9 * max(abs(params[name].value), 1)
+        plus = params.copy()
+        plus[name].value += step
+        minus = params.copy()
+        minus[name].value -= step
+        numerical = (khalil.bifurcation_s21(plus, f) - khalil.bifurcation_s21(minus, f)) / (2 * step)
+        np.testing.assert_allclose(jacobian[name], numerical, rtol=1e-4, atol=1e-6 * np.abs(numerical).max())
+
+
+def test_bifurcation_s21_jacobian_zero_amplitude():
+    f = np.linspace(99.99, 100.01, 51)
+    params = khalil.create_model(f_0=100.0002, Q=2e4, Q_e=3e4 + 5e3j, A=0, delay=0.05, a=0.5)
+    params['f_phi'].value = f[0]
+    params['A_phase'].value = 0.2
+    jacobian = khalil.bifurcation_s21_jacobian(params, f)
+    for name in params:
+        assert np.all(np.isfinite(jacobian[name]))
+    plus = params.copy()
+    plus['A_mag'].value = 1
+    np.testing.assert_allclose(jacobian['A_mag'], khalil.bifurcation_s21(plus, f), rtol=1e-12)
@@ -0,0 +1,64 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import equations, joint
+
+
+def fake_scan(noise=0.001, seed=123):
+    np.random.seed(seed)
+    # The second and third resonators overlap.
+    f_0 = np.array([99.6e6, 102.1e6, 102.104e6, 104.5e6, 105.2e6])
+    Q = np.array([2e4, 3e4, 2.5e4, 1.5e4, 4e4])
+    Q_e = np.array([4e4, 5e4, 4e4, 3e4, 6e4]) * (1 + 0.1j)
+    f = np.linspace(98.5e6, 106.5e6, 16000)
+    s21 = equations.general_cable(f, 30e-9, 0.5, f.min(), 0.8, 1e-9)
+    for parameters in zip(f_0, Q, Q_e.real, Q_e.imag):
+        s21 = s21 * equations.linear_resonator(f, *parameters)
+    s21 += noise * (np.random.randn(f.size) + 1j * np.random.randn(f.size))
+    errors = noise * (1 + 1j) * np.ones(f.size)
+    return f, s21, errors, f_0, Q, Q_e
+
+
+def test_segment_peaks():
+    peaks = np.array([1., 2., 10., 10.5, 11., 20.])
+    segments = joint.segment_peaks(peaks, 1)
+    assert [list(s) for s in segments] == [[0, 1], [2, 3, 4], [5]]
+    segments = joint.segment_peaks(peaks, 1, max_resonators=2)
+    assert [list(s) for s in segments] == [[0, 1], [2], [3, 4], [5]]
+
+
+def test_model_jacobian():
+    f = np.linspace(99.9, 100.1, 101)
+    values = np.array([0.3, 0.5, 0.8, 0.01, 99.98, 2e3, 4e3, 500, 100.0, 3e3, 5e3, -200, 100.05, 1e3, 2e3, 0])
+    # The resonance frequencies need much smaller steps relative to their values than the other parameters.
+    steps = 1e-6 * np.maximum(np.abs(values), 1)
+    steps[4::4] = 1e-9 * values[4::4]
+    s21, derivative = joint._model(f, f.min(), values, jacobian=True)
+    for k, step in enumerate(steps):
+        plus = values.copy()
+        plus[k] += step
+        minus = values.copy()
+        minus[k] -= step
+        numerical = (joint._model(f, f.min(), plus)[0] - joint._model(f, f.min(), minus)[0]) / (2 * step)
+        np.testing.assert_allclose(derivative[:, k], numerical, rtol=1e-5, atol=1e-7 * np.abs(numerical).max())
+
+
+def test_fit_segments():
+    f, s21, errors, f_0, Q, Q_e = fake_scan()
+    peak_indexes = np.searchsorted(f, f_0)
+    serial = joint.fit_segments(f, s21, errors, peak_indexes)
+    assert len(serial) == f_0.size
+    assert len(set(id(r.segment) for r in serial)) == 3
+    fit_f_0 = np.array([r.f_0 for r in serial])
+    fit_Q = np.array([r.Q for r in serial])
+    fit_Q_e = np.array([r.Q_e for r in serial])
+    assert np.all([r.success for r in serial])
+    assert np.all(np.abs(fit_f_0 / f_0 - 1) < 0.01 / Q)
+    np.testing.assert_allclose(fit_Q, Q, rtol=0.01)
+    np.testing.assert_allclose(fit_Q_e, Q_e, rtol=0.02)
+    np.testing.assert_allclose([r.redchi for r in serial], 1, rtol=0.1)
+    resonator = serial[1]
+    np.testing.assert_allclose(resonator.background_s21() * resonator.target_s21(), resonator.eval(), rtol=1e-12)
+    numerical = joint.fit_segments(f, s21, errors, peak_indexes, jacobian=False)
+    np.testing.assert_allclose([r.f_0 for r in numerical], fit_f_0, rtol=1e-9)
+    parallel = joint.fit_segments(f, s21, errors, peak_indexes, workers=2)
+    np.testing.assert_array_equal([r.f_0 for r in parallel], fit_f_0)
@@ -13,4 +13,71 @@ def test_resonator():
     assert(np.allclose(s21_meas,lr.s21))
     assert(np.abs(lr.Q-1e4) < 3*lr.Q_error)
     assert(np.abs(lr.f_0 - 100) < 3*lr.f_0_error)
-    assert(lr.f_0_error < 1e-4)
\ No newline at end of file
+    assert(lr.f_0_error < 1e-4)
+
+def fake_resonator_with_cable(f_0=100e6, Q=2e4, Q_e_real=3e4, Q_e_imag=5e3, noise=0.005, seed=123):
+    np.random.seed(seed)
+    f = f_0 * (1 + np.linspace(-5, 5, 100) / Q)
+    model = lmfit_resonator._linear_resonator_with_cable
+    s21 = model.eval(f=f, delay=30e-9, phi=0.5, f_min=f.min(), A_mag=0.8, A_slope=1e-7, f_0=f_0, Q=Q,
+                     Q_e_real=Q_e_real, Q_e_imag=Q_e_imag)
+    s21 += noise * (np.random.randn(f.size) + 1j * np.random.randn(f.size))
+    return f, s21, noise * (1 + 1j) * np.ones_like(s21)
+
+
+def test_warm_start():
+    f, s21, errors = fake_resonator_with_cable()
+    cold = lmfit_resonator.LinearResonatorWithCable(f, s21, errors)
+    warm = lmfit_resonator.LinearResonatorWithCable(f, s21, errors, params=cold.current_params)
+    assert warm.current_result.nfev < cold.current_result.nfev
+    np.testing.assert_allclose(warm.f_0, cold.f_0, rtol=1e-9)
+
+
+def test_warm_start_fallback():
+    f, s21, errors = fake_resonator_with_cable()
+    cold = lmfit_resonator.LinearResonatorWithCable(f, s21, errors)
+    bad = cold.current_params.copy()
+    bad['Q'].set(value=np.nan)
+    fallback = lmfit_resonator.LinearResonatorWithCable(f, s21, errors, params=bad)
+    np.testing.assert_allclose(fallback.f_0, cold.f_0, rtol=1e-9)
+
+
+def test_parameter_cache():
+    cache = lmfit_resonator.ParameterCache()
+    f, s21, errors = fake_resonator_with_cable()
+    first = lmfit_resonator.LinearResonatorWithCable(f, s21, errors, cache=cache, cache_key=3)
+    assert len(cache) == 1
+    # A fit of the same data starts from the cached result, which is already the best fit.
+    again = lmfit_resonator.LinearResonatorWithCable(f, s21, errors, cache=cache, cache_key=3)
+    assert again.current_result.nfev < first.current_result.nfev
+    np.testing.assert_allclose(again.f_0, first.f_0, rtol=1e-9)
+    # The same resonator, shifted slightly and measured again, starts from the cached result.
+    f, s21, errors = fake_resonator_with_cable(f_0=100.001e6, seed=456)
+    second = lmfit_resonator.LinearResonatorWithCable(f, s21, errors, cache=cache, cache_key=3)
+    assert abs(second.f_0 - 100.001e6) < 5 * second.f_0_error
+    assert len(cache) == 1
+    # A different key does not match.
+    assert cache.get(second, key=4) is None
+    assert len(cache.select(lmfit_resonator.LinearResonatorWithCable, f, key=3)) == 1
+    assert len(cache.select(lmfit_resonator.LinearResonatorWithCable, f + 1e6, key=3)) == 0
+
+
+def test_parameter_cache_keeps_fixed_parameters():
+    cache = lmfit_resonator.ParameterCache()
+    f, s21, errors = fake_resonator_with_cable()
+    lmfit_resonator.LinearResonatorWithCable(f, s21, errors, cache=cache)
+    f, s21, errors = fake_resonator_with_cable(f_0=100.001e6, seed=456)
+    second = lmfit_resonator.LinearResonatorWithCable(f, s21, errors, cache=cache)
+    # The reference frequency of the cable model is fixed by the new data.
+    assert second.current_result.init_params['f_min'].value == f.min()
+    assert second.f_min == f.min()
+
+
+def test_colliding_resonators_guess_uses_circle_estimate():
+    f, s21, errors = fake_resonator_with_cable()
+    single = lmfit_resonator._linear_resonator_with_cable.guess(data=s21, f=f)
+    colliding = lmfit_resonator._colliding_linear_resonators_with_cable.guess(data=s21, f=f)
+    for name in ['f_0', 'Q', 'Q_e_real', 'Q_e_imag']:
+        assert colliding['fg_' + name].value == single[name].value
+    for name in ['delay', 'phi', 'A_mag', 'A_slope']:
+        assert colliding[name].value == single[name].value
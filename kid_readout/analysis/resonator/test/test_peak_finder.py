@@ -0,0 +1,46 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import equations, peak_finder
+
+
+def fake_scan(num_points=400000, noise=0.003, seed=123):
+    np.random.seed(seed)
+    f = np.linspace(1e9, 1.1e9, num_points)
+    f_0 = np.array([1.002e9, 1.013e9, 1.0301e9, 1.0302e9, 1.05e9, 1.0771e9, 1.099e9])
+    Q = np.array([2e4, 3e4, 3e4, 2.5e4, 5e4, 1e4, 3e4])
+    Q_e = np.array([4e4, 1e5, 5e4, 6e4, 2e5, 1.5e4, 3e4])
+    # The background has a cable delay, a slope, and a ripple.
+    s21 = equations.general_cable(f, 30e-9, 0.5, f.min(), 0.8, 2e-9) * (1 + 0.1 * np.sin(f / 3e6))
+    for parameters in zip(f_0, Q, Q_e, np.zeros(f_0.size)):
+        s21 *= equations.linear_resonator(f, *parameters)
+    s21 += noise * (np.random.randn(f.size) + 1j * np.random.randn(f.size))
+    return f, s21, f_0, Q
+
+
+def test_find_peaks():
+    f, s21, f_0, Q = fake_scan()
+    candidates = peak_finder.find_peaks(f, s21, linewidth=1.05e9 / 3e4)
+    found = np.array([c.frequency for c in candidates])
+    assert found.size == f_0.size
+    assert np.all(np.abs(found - f_0) < 0.2 * f_0 / Q)
+    np.testing.assert_array_equal([c.index for c in candidates], np.searchsorted(f, found))
+    assert np.all(np.array([c.snr for c in candidates]) > 20)
+
+
+def test_chunks():
+    f, s21, f_0, Q = fake_scan(num_points=100000)
+    whole = peak_finder.find_peaks(f, s21, linewidth=1.05e9 / 3e4, chunk_size=f.size)
+    finder = peak_finder.StreamingPeakFinder(linewidth=1.05e9 / 3e4, frequency_step=f[1] - f[0])
+    chunked = []
+    # The first chunk is shorter than the windows, so it produces no output.
+    boundaries = [0, 10, 3000, 3001, 50000, 77777, f.size]
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        new = finder.update(f[start:stop], s21[start:stop])
+        # A candidate is final only when the data extend beyond it by at least the filter and background windows.
+        assert all(c.index < stop - 2 * finder.background_half_width - finder.kernel_half_width for c in new)
+        chunked.extend(new)
+    chunked.extend(finder.finish())
+    assert finder.finish() == []
+    # The noise estimate depends on the chunks, so only the positions must agree.
+    assert [c.index for c in chunked] == [c.index for c in whole]
+    np.testing.assert_allclose([c.depth for c in chunked], [c.depth for c in whole], rtol=1e-4)
@@ -0,0 +1,24 @@
+"""
+This module contains helper functions for the resonator tests.
+"""
+import numpy as np
+
+from kid_readout.analysis.resonator import equations
+
+
+def fake_resonators(num_resonators=8, num_points=100, noise=0.005, delay=30e-9, center=0, seed=123):
+    """
+    Return fake sweeps of linear resonators behind the same cable, as (f, s21, errors, f_0, Q, Q_e).
+
+    Each sweep spans ten linewidths; center is the detuning of its middle from f_0 in linewidths.
+    """
+    np.random.seed(seed)
+    f_0 = np.random.uniform(80e6, 120e6, num_resonators)
+    Q = np.random.uniform(1e4, 5e4, num_resonators)
+    Q_e = Q * np.random.uniform(1.2, 3, num_resonators) * (1 + 0.2j * np.random.uniform(-1, 1, num_resonators))
+    f = f_0[:, None] * (1 + (np.linspace(-5, 5, num_points) + center) / Q[:, None])
+    s21 = (equations.general_cable(f, delay, 0.5, f.min(axis=1)[:, None], 0.8, 1e-7) *
+           equations.linear_resonator(f, f_0[:, None], Q[:, None], Q_e.real[:, None], Q_e.imag[:, None]))
+    s21 += noise * (np.random.randn(*f.shape) + 1j * np.random.randn(*f.shape))
+    errors = noise * (1 + 1j) * np.ones_like(s21)
+    return f, s21, errors, f_0, Q, Q_e
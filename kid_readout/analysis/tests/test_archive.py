@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from kid_readout.analysis import archive, kid_response
+from kid_readout.analysis.timeseries import noise_fit
+
+
+def fake_response_archive(break_points, scales, num_points=20, noise=0.01, seed=123):
+    np.random.seed(seed)
+    dfs = []
+    for resonator_id, (break_point, scale) in enumerate(zip(break_points, scales)):
+        # The first point has no power and sets the maximum f_0.
+        frac_f0 = np.concatenate(([0], np.logspace(-6, -4, num_points)))
+        zbd_power = kid_response.fractional_freq_to_power(frac_f0, break_point, scale)
+        zbd_power *= 1 + noise * np.random.randn(frac_f0.size)
+        dfs.append(pd.DataFrame({'resonator_id': resonator_id, 'f_0': 100e6 * (1 - frac_f0), 'zbd_power': zbd_power,
+                                 'sweep_primary_load_temperature': 4.}))
+    return pd.concat(dfs, ignore_index=True)
+
+
+def test_fit_responses_mcmc():
+    break_points = np.array([3e-5, 5e-5])
+    scales = np.array([1e-5, 2e-5])
+    df = fake_response_archive(break_points, scales)
+    fit = archive.fit_responses_mcmc(df, seed=1)
+    assert len(fit) == len(df)
+    for resonator_id, x in fit.groupby('resonator_id'):
+        row = x.iloc[0]
+        assert abs(row.response_break_point - break_points[resonator_id]) < 5 * row.response_break_point_err
+        assert abs(row.response_scale - scales[resonator_id]) < 5 * row.response_scale_err
+        np.testing.assert_allclose(x.reconstructed_power,
+                                   kid_response.fractional_freq_to_power(x.frac_f0, row.response_break_point,
+                                                                         row.response_scale))
+    # The same seed gives the same result.
+    again = archive.fit_responses_mcmc(df, seed=1)
+    np.testing.assert_array_equal(again.response_break_point, fit.response_break_point)
+
+
+def test_add_noise_fits():
+    np.random.seed(123)
+    frequency = np.logspace(0, 4, 60)
+    S = 10 / (1 + (frequency / 300) ** 2) + 0.5
+    eigvals = np.vstack((S, S * (1 + 0.05 * np.random.randn(frequency.size))))
+    # The third row has no spectrum and the fourth has an eigenvalue array with the wrong shape.
+    df = pd.DataFrame({'pca_freq': [frequency, frequency, np.nan, frequency],
+                       'pca_eigvals': [eigvals, eigvals, np.nan, eigvals[1]]})
+    fits = archive.add_noise_fits(df)
+    expected = noise_fit.fit_single_pole_noise_batch(frequency, eigvals[1], max_num_masked=8)
+    np.testing.assert_allclose(fits.noise_fit_fc[:2], expected.fc[0])
+    np.testing.assert_allclose(fits.noise_fit_device_noise_err[:2], expected.A_err[0])
+    assert fits.noise_fit_fc[2:].isnull().all()
+    assert 'noise_fit_fc' not in df
@@ -49,6 +49,50 @@ def test_dtype_agreement():
                 except TypeError:
                     pass
 
+def test_inverse():
+    x_data = np.linspace(100, 110, 50)
+    y_data = 2 * x_data + 1 + 0.01 * np.random.randn(x_data.size)
+    fitter = kid_readout.analysis.fitter.Fitter(x_data=x_data, y_data=y_data)
+    x = np.random.uniform(100, 110, (3, 100))
+    y = kid_readout.analysis.fitter.line_model(fitter.result.params, x)
+    np.testing.assert_allclose(fitter.inverse(y), x, rtol=1e-10)
+    assert np.isscalar(fitter.inverse(y[0, 0]))
+    np.testing.assert_allclose(fitter.inverse(y, guess=105), x, rtol=1e-10)
+
+
+def test_inverse_extrapolate():
+    x_data = np.linspace(100, 110, 50)
+    fitter = kid_readout.analysis.fitter.Fitter(x_data=x_data, y_data=2 * x_data + 1)
+    # Values beyond the ends of the x-data start from fsolve(), and values inside from the table.
+    x = np.array([[80, 99.5, 100, 100.1], [105, 109.9, 110, 125]])
+    y = kid_readout.analysis.fitter.line_model(fitter.result.params, x)
+    np.testing.assert_allclose(fitter.inverse(y), x, rtol=1e-10)
+    np.testing.assert_allclose(fitter.inverse(y[0, 0]), x[0, 0], rtol=1e-10)
+
+
+def phase_model(params, x):
+    return params['amplitude'].value * np.exp(1j * params['rate'].value * x)
+
+
+def phase_guess(x, y):
+    params = lmfit.Parameters()
+    params.add('amplitude', value=np.abs(y).mean())
+    params.add('rate', value=np.polyfit(x, np.unwrap(np.angle(y)), 1)[0])
+    return params
+
+
+def test_inverse_complex():
+    x_data = np.linspace(-1, 1, 50)
+    fitter = kid_readout.analysis.fitter.Fitter(x_data=x_data, y_data=np.exp(1j * x_data), model=phase_model,
+                                                guess=phase_guess)
+    x = np.random.uniform(-1, 1, 100)
+    # Points off the curve are mapped to the closest point on the curve.
+    y = 1.01 * fitter.model(x=x)
+    np.testing.assert_allclose(fitter.inverse(y), x, atol=1e-8)
+    x_outside = np.array([-1.5, 1.2])
+    np.testing.assert_allclose(fitter.inverse(fitter.model(x=x_outside)), x_outside, atol=1e-8)
+
+
 if __name__ == "__main__":
     test_dtype_agreement()
 
@@ -2,7 +2,7 @@ import numpy as np
 from matplotlib import mlab
 import warnings
 
-from kid_readout.analysis.timeseries.iqnoise import full_spectral_helper
+from kid_readout.analysis.timeseries.iqnoise import calculate_pca_noise, full_spectral_helper
 
 __author__ = 'gjones'
 
@@ -18,4 +18,26 @@ def test_full_spectral_helper():
         fullPxx, fullPyy, fullPxy, freqs, t = full_spectral_helper(x, y, NFFT=2 ** 16, Fs=512e6 / 2 ** 14)
     assert (np.allclose(mlabPxx, fullPxx.mean(1)))
     assert (np.allclose(mlabPyy, fullPyy.mean(1)))
-    assert (np.allclose(mlabPxy, fullPxy.mean(1)))
\ No newline at end of file
+    assert (np.allclose(mlabPxy, fullPxy.mean(1)))
+
+def test_calculate_pca_noise():
+    np.random.seed(0)
+    nf = 100
+    pii = np.random.rand(nf)
+    pqq = np.random.rand(nf)
+    piq = (np.random.rand(nf) - 0.5) * np.sqrt(pii * pqq) + 0.1j * np.random.randn(nf)
+    S, evals, evects, angles = calculate_pca_noise(pii, pqq, piq)
+    v = evects[:, :, 0]
+    for k in range(nf):
+        m = np.array([[pii[k], piq[k].real],
+                      [piq[k].real, pqq[k]]])
+        w, eigh_v = np.linalg.eigh(m)
+        np.testing.assert_allclose(evals[:, k], w, rtol=1e-12)
+        # The signs of the eigenvectors are arbitrary.
+        np.testing.assert_allclose(np.abs(np.sum(evects[:, :, k] * eigh_v, axis=0)), 1, rtol=1e-12)
+        np.testing.assert_allclose(np.dot(m, evects[:, :, k].real), evects[:, :, k].real * w, atol=1e-12)
+        full = np.array([[pii[k], piq[k]],
+                         [np.conj(piq[k]), pqq[k]]])
+        np.testing.assert_allclose(S[:, k], np.diag(np.dot(np.dot(np.linalg.inv(v), full), v)).real, rtol=1e-12)
+    assert np.all((angles >= 0) & (angles < np.pi))
+    np.testing.assert_allclose(np.mod(angles[1] - angles[0], np.pi), np.pi / 2, rtol=1e-12)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from kid_readout.analysis import kid_response, mcfit
+
+
+def gaussian_log_probability(positions, mean, std):
+    return -0.5 * np.sum(((positions - mean) / std) ** 2, axis=1)
+
+
+def test_autocorrelation_time():
+    np.random.seed(123)
+    correlation = 0.9
+    chain = np.empty((20000, 8, 1))
+    chain[0] = np.random.randn(8, 1)
+    for step in range(1, chain.shape[0]):
+        chain[step] = correlation * chain[step - 1] + np.random.randn(8, 1)
+    expected = (1 + correlation) / (1 - correlation)
+    np.testing.assert_allclose(mcfit.autocorrelation_time(chain), expected, rtol=0.1)
+
+
+def test_ensemble_sample():
+    mean = np.array([1., -2.])
+    std = np.array([0.5, 3.])
+    initial = mean + 0.01 * np.random.randn(32, 2)
+    directory = tempfile.mkdtemp()
+    try:
+        chain_filename = os.path.join(directory, 'chain.npy')
+        result = mcfit.ensemble_sample(gaussian_log_probability, initial, args=(mean, std), max_steps=10000,
+                                       chain_filename=chain_filename, seed=1)
+        assert result.converged
+        steps = result.chain.shape[0]
+        assert steps < 10000
+        np.testing.assert_allclose(result.mean, mean, atol=0.1 * std.max())
+        np.testing.assert_allclose(result.std, std, rtol=0.1)
+        assert np.all((result.acceptance_fraction > 0.2) & (result.acceptance_fraction < 0.9))
+        written = np.load(chain_filename)
+        np.testing.assert_array_equal(written[:steps], result.chain)
+        assert np.all(np.isnan(written[steps:]))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_sample_batch():
+    means = [np.array([0., 1.]), np.array([5., -5.])]
+    std = np.ones(2)
+    initials = [mean + 0.01 * np.random.randn(16, 2) for mean in means]
+    args_list = [(mean, std) for mean in means]
+    serial = mcfit.sample_batch(gaussian_log_probability, initials, args_list, seed=2, max_steps=3000)
+    parallel = mcfit.sample_batch(gaussian_log_probability, initials, args_list, workers=2, seed=2, max_steps=3000)
+    for mean, s, p in zip(means, serial, parallel):
+        np.testing.assert_allclose(s.mean, mean, atol=0.2)
+        np.testing.assert_array_equal(s.chain, p.chain)
+
+
+def test_response_log_probability():
+    np.random.seed(123)
+    x = np.logspace(-6, -4, 20)
+    y = kid_response.fractional_freq_to_power(x, 3e-5, 1e-5) * (1 + 0.01 * np.random.randn(x.size))
+    errors = 0.01 * y
+    fit = kid_response.MCMCKidResponseFitter(x, y, errors=errors)
+    minimum = np.array([fit.result.params[name].min for name in fit.parameter_list])
+    maximum = np.array([fit.result.params[name].max for name in fit.parameter_list])
+    # The last two positions are outside the prior.
+    positions = np.array([[3e-5, 1e-5], [2e-5, 1.2e-5], [1e-6, 0.5], [2e-4, 1e-5], [3e-5, -1e-3]])
+    log_probability = kid_response.response_log_probability(positions, x, y, errors, minimum, maximum)
+    expected = [fit.basic_logprob(position) for position in positions]
+    np.testing.assert_allclose(log_probability, expected, rtol=1e-12)
+    assert np.all(np.isinf(log_probability[-2:]))
@@ -1,10 +1,25 @@
 """
 This module contains functions for binning spectral densities.
+
+The frequencies are assigned to bins once, with a single call to np.digitize(), and all data arrays are reduced with
+np.add.reduceat(), so the cost is linear in the number of frequencies instead of proportional to the number of bins
+times the number of frequencies. The bins for a frequency grid are cached, so binning many spectra that share a grid,
+such as the spectra of every channel of a stream, computes them once. The data arrays may be real or complex, and may
+have any number of dimensions with frequency on the last axis.
+
+A boolean mask, such as one from the spectral_masks module, excludes frequencies from the bins: the edges are those of
+the full frequency grid, so the bins do not depend on the mask, but the masked frequencies are not counted and bins that
+contain only masked frequencies are omitted.
 """
 from __future__ import division
+from collections import OrderedDict
 
 import numpy as np
 
+# The maximum number of frequency grids for which bins are cached.
+BINS_CACHE_SIZE = 32
+_bins_cache = OrderedDict()
+
 
 def log_bin_edges(frequency, bins_per_decade, ensure_none_empty):
     """
@@ -48,7 +63,7 @@ def log_bin_edges(frequency, bins_per_decade, ensure_none_empty):
         return log_bins
 
 
-def log_bin(frequency, bins_per_decade, *data):
+def log_bin(frequency, bins_per_decade, *data, **kwargs):
     """
     Return the results of binning the given data arrays in frequency bins with widths that increase approximately
     exponentially, intended for plotting on a logarithmic axis.
@@ -69,7 +84,9 @@ def log_bin(frequency, bins_per_decade, *data):
     bins_per_decade : int
         The number of histogram bins per decade of frequency.
     data : ndarrays
-        The data arrays.
+        The real or complex data arrays, with frequency on the last axis.
+    mask : ndarray(bool)
+        This optional keyword argument excludes the frequencies where it is False from the bins; see log_bins().
 
     Returns
     -------
@@ -90,16 +107,12 @@ def log_bin(frequency, bins_per_decade, *data):
     Unpacking multiple data arrays:
     edges, counts, f_mean, [binned_data1, binned_data2] = log_bin(f, 10, data1, data2)
     """
-    edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
-    bin_indices = np.digitize(frequency, edges)
-    indices_used = np.unique(bin_indices)
-    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
-    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
-    binned_data = [np.array([np.mean(d[bin_indices == n]) for n in indices_used]) for d in data]
-    return edges, counts, mean_frequency, binned_data
+    bins = log_bins(frequency, bins_per_decade, mask=_pop_mask(kwargs))
+    # The Bins are cached, so return copies of their arrays.
+    return bins.edges.copy(), bins.counts.copy(), bins.mean_frequency.copy(), [bins.mean(d) for d in data]
 
 
-def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
+def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance, **kwargs):
     """
     Return the results of binning the given data arrays and variances in frequency bins with widths that increase
     approximately exponentially, intended for plotting on a logarithmic axis.
@@ -114,7 +127,9 @@ def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
     bins_per_decade : int
         The number of histogram bins per decade of frequency.
     data_and_variance : (ndarray, ndarray)
-        Tuples containing arrays of the data and corresponding variance.
+        Tuples containing arrays of the data and corresponding variance, with frequency on the last axis.
+    mask : ndarray(bool)
+        This optional keyword argument excludes the frequencies where it is False from the bins; see log_bins().
 
     Returns
     -------
@@ -135,16 +150,17 @@ def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
     Unpacking multiple pairs:
     edges, counts, f_mean, [(bd1, bv1), (bd2, bv2)] = log_bin_with_variance(f, 10, (d1, v1), (d2, v2))
     """
-    edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
-    bin_indices = np.digitize(frequency, edges)
-    indices_used = np.unique(bin_indices)
-    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
-    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
-    binned_dv = []
-    for d, v in data_and_variance:
-        binned_dv.append((np.array([np.mean(d[bin_indices == n]) for n in indices_used]),
-                          np.array([np.mean(v[bin_indices == n]) / c for n, c in zip(indices_used, counts)])))
-    return edges, counts, mean_frequency, binned_dv
+    bins = log_bins(frequency, bins_per_decade, mask=_pop_mask(kwargs))
+    binned_dv = [(bins.mean(d), bins.variance_of_mean(v)) for d, v in data_and_variance]
+    return bins.edges.copy(), bins.counts.copy(), bins.mean_frequency.copy(), binned_dv
+
+
+def _pop_mask(kwargs):
+    """Return the mask keyword argument, or None, and raise a TypeError if there are other keyword arguments."""
+    mask = kwargs.pop('mask', None)
+    if kwargs:
+        raise TypeError("Unexpected keyword arguments: {}".format(', '.join(sorted(kwargs))))
+    return mask
 
 
 # These are the left bin edges: they stop before the highest frequency.
@@ -192,15 +208,140 @@ def make_freq_bins(fr):
 
 
 def log_bin_old(freqs, data):
-    # Need to work out
+    """
+    Legacy function that returns the mean frequencies and the binned data, which is either an array or a list of
+    arrays. The bins are those between consecutive edges returned by make_freq_bins(), so frequencies below the first
+    edge or above the last edge are not used, and empty bins contain NaN.
+    """
     freq_bins = make_freq_bins(freqs)
-    bin_idxs = np.digitize(freqs, freq_bins)
+    bins = _cached_bins(freqs, freq_bins)
+    # Bin k lies between edges k - 1 and k, so these positions skip the bins outside the edges.
+    positions = bins.indices_used - 1
+    used = (positions >= 0) & (positions < len(freq_bins) - 1)
+
+    def bin_means(d):
+        means = bins.mean(d)
+        binned = np.full(means.shape[:-1] + (len(freq_bins) - 1,), np.nan, dtype=means.dtype)
+        binned[..., positions[used]] = means[..., used]
+        return binned
+
     if type(data) is list:
-        binned_data = []
-        for dunit in data:
-            binned_data.append(np.array([dunit[bin_idxs == k].mean() for k in range(1, len(freq_bins))]))
+        binned_data = [bin_means(dunit) for dunit in data]
+    else:
+        binned_data = bin_means(data)
+    return bin_means(freqs), binned_data
+
+
+class Bins(object):
+    """
+    The assignment of a grid of frequencies to bins, used to compute the means of data in each bin.
+
+    Attributes
+    ----------
+    edges : numpy.ndarray(float)
+        The bin edges.
+    indices_used : numpy.ndarray(int)
+        The indices returned by np.digitize() for the bins that contain at least one frequency, in increasing order.
+    counts : numpy.ndarray(int)
+        The number of frequencies in each of these bins.
+    mean_frequency : numpy.ndarray(float)
+        The mean of the frequencies in each of these bins.
+    mask : numpy.ndarray(bool) or None
+        If not None, only the frequencies where the mask is True are counted.
+    """
+
+    def __init__(self, frequency, edges, mask=None):
+        frequency = np.asarray(frequency)
+        self.frequency = frequency.copy()
+        self.edges = edges
+        if mask is None:
+            self.mask = None
+        else:
+            self.mask = np.array(mask, dtype='bool')
+            if self.mask.shape != frequency.shape:
+                raise ValueError("The mask shape {} does not match the frequency shape {}.".format(self.mask.shape,
+                                                                                                   frequency.shape))
+            frequency = frequency[self.mask]
+        bin_indices = np.digitize(frequency, edges)
+        # If the frequencies increase then each bin is a contiguous range of them; otherwise, sort them by bin.
+        if np.all(np.diff(bin_indices) >= 0):
+            self.order = None
+        else:
+            self.order = np.argsort(bin_indices, kind='mergesort')
+            bin_indices = bin_indices[self.order]
+        self.indices_used, self.starts, self.counts = np.unique(bin_indices, return_index=True, return_counts=True)
+        self.mean_frequency = self.mean(self.frequency)
+
+    def sum(self, data):
+        """Return the sums of the given real or complex data in each bin, with frequency on the last axis."""
+        data = np.asarray(data)
+        if data.shape[-1] != self.frequency.size:
+            raise ValueError("The data have {} frequencies instead of {}.".format(data.shape[-1], self.frequency.size))
+        if self.mask is not None:
+            data = data[..., self.mask]
+        if self.order is not None:
+            data = data[..., self.order]
+        return np.add.reduceat(data, self.starts, axis=-1)
+
+    def mean(self, data):
+        """Return the means of the given real or complex data in each bin, with frequency on the last axis."""
+        return self.sum(data) / self.counts
+
+    def variance_of_mean(self, variance):
+        """Return the variance of the mean in each bin, which is the mean of the given variances divided by N."""
+        return self.sum(variance) / self.counts ** 2
+
+
+def log_bins(frequency, bins_per_decade, mask=None):
+    """
+    Return the Bins for the given frequencies with the edges of log_bin_edges(), using the cached result if these
+    frequencies have been binned before with the same number of bins per decade and the same mask. The returned Bins
+    may be shared with other callers, so its arrays should not be modified.
+
+    Parameters
+    ----------
+    frequency : ndarray(float)
+        The equally-spaced, non-negative frequencies.
+    bins_per_decade : int
+        The number of histogram bins per decade of frequency.
+    mask : ndarray(bool) or None
+        If not None, only the frequencies where the mask is True are counted; the edges do not depend on the mask.
+
+    Returns
+    -------
+    Bins
+    """
+    return _cached_bins(frequency, bins_per_decade, mask)
+
+
+def _cached_bins(frequency, edges_or_bins_per_decade, mask=None):
+    """
+    Return the cached Bins for the given frequencies, mask, and either an array of edges or a number of bins per decade
+    for log_bin_edges(), creating them if necessary.
+    """
+    frequency = np.asarray(frequency)
+    if np.isscalar(edges_or_bins_per_decade):
+        edges_key = edges_or_bins_per_decade
+    else:
+        edges_key = (edges_or_bins_per_decade.size, edges_or_bins_per_decade[0], edges_or_bins_per_decade[-1])
+    if mask is None:
+        mask_key = None
+    else:
+        mask = np.asarray(mask, dtype='bool')
+        mask_key = hash(np.packbits(mask).tobytes())
+    key = (frequency.size, frequency[0], frequency[-1], edges_key, mask_key)
+    bins = _bins_cache.get(key)
+    if (bins is None or not np.array_equal(bins.frequency, frequency) or
+            (not np.isscalar(edges_or_bins_per_decade) and not np.array_equal(bins.edges, edges_or_bins_per_decade)) or
+            (mask is not None and not np.array_equal(bins.mask, mask))):
+        if np.isscalar(edges_or_bins_per_decade):
+            edges = log_bin_edges(frequency, bins_per_decade=edges_or_bins_per_decade, ensure_none_empty=True)
+        else:
+            edges = edges_or_bins_per_decade
+        bins = Bins(frequency, edges, mask=mask)
     else:
-        binned_data = np.array([data[bin_idxs == k].mean() for k in
-                                range(1, len(freq_bins))])  # skip the zeroth bin since it has nothing in it
-    binned_freqs = np.array([freqs[bin_idxs == k].mean() for k in range(1, len(freq_bins))])
-    return binned_freqs, binned_data
+        del _bins_cache[key]
+    _bins_cache[key] = bins  # The most recently used entry is last.
+    while len(_bins_cache) > BINS_CACHE_SIZE:
+        _bins_cache.popitem(last=False)
+    return bins
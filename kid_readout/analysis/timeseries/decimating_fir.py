@@ -1,3 +1,17 @@
+"""
+This module contains FIR filters that decimate multi-channel time series.
+
+PolyphaseDecimator and MultistageDecimator are the filters intended for use: they process blocks of data with shape
+(samples, channels), keep their state between blocks so that a stream can be filtered in pieces of any size, and
+compute only the output samples that are kept. The other classes are experimental.
+
+A decimator with factor D computes the output samples y[phase + m * D] of the convolution
+y[n] = sum_k h[k] x[n - k], where x[n] = 0 for n < 0. In polyphase form, each output is the sum over the D phases of
+the products of every D-th coefficient with every D-th input, so the cost per input sample is the number of taps
+divided by D instead of the number of taps.
+"""
+from __future__ import division
+
 import numpy as np
 import scipy.signal
 from kid_readout.analysis.timeseries import fftfilt
@@ -10,7 +24,7 @@ class DecimatingFIR(object):
 
     def prepare(self):
         self.coefficients = scipy.signal.firwin(self.num_taps,cutoff=1./self.downsample_factor).reshape((
-            self.num_taps/self.downsample_factor,self.downsample_factor))[:,::-1]
+            self.num_taps//self.downsample_factor,self.downsample_factor))[:,::-1]
 
     def process(self,data,continuation=True, use_fft=True):
         data = data.reshape((data.shape[0]//self.downsample_factor,self.downsample_factor))
@@ -93,4 +107,184 @@ class MultistageHalfBandDecimationFilter(object):
     def polyphase(self,data):
         for filter_ in self.filters:
             data = filter_.polyphase(data)
-        return data
\ No newline at end of file
+        return data
+
+
+class PolyphaseDecimator(object):
+    """
+    Filter and decimate blocks of multi-channel data with an FIR filter, keeping the state between blocks.
+    """
+
+    def __init__(self, coefficients, factor, phase=0, block_size=2 ** 12):
+        """
+        Parameters
+        ----------
+        coefficients : numpy.ndarray(float)
+            The filter coefficients; their dtype and that of the data determine the dtype of the output, so float32
+            coefficients keep complex64 data in single precision.
+        factor : int
+            The decimation factor.
+        phase : int
+            The output samples are those of the full-rate filter output at indices phase + m * factor.
+        block_size : int
+            The number of output samples computed at once.
+        """
+        if factor < 1 or not 0 <= phase < factor:
+            raise ValueError("The factor must be positive and the phase must satisfy 0 <= phase < factor.")
+        self.coefficients = np.asarray(coefficients)
+        self.factor = int(factor)
+        self.phase = int(phase)
+        self.block_size = block_size
+        num_rows = -(-self.coefficients.size // self.factor)
+        padded = np.zeros(num_rows * self.factor, dtype=self.coefficients.dtype)
+        padded[:self.coefficients.size] = self.coefficients
+        # Row j contains the coefficients h[j * factor + p] for p = 0, ..., factor - 1.
+        self._polyphase_coefficients = padded.reshape((num_rows, self.factor))
+        self._nonzero = zip(*np.nonzero(self._polyphase_coefficients))
+        self.reset()
+
+    @property
+    def num_taps(self):
+        return self.coefficients.size
+
+    @property
+    def delay(self):
+        """float: the group delay of a symmetric filter, in input samples."""
+        return (self.num_taps - 1) / 2
+
+    def reset(self):
+        """Clear the state, so that the next block is treated as the start of the data."""
+        self._pending = None
+        self._history = None
+
+    def process(self, data):
+        """
+        Filter and decimate the next block of data.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The next block, with shape (samples, channels); a 1-D array is treated as one channel.
+
+        Returns
+        -------
+        numpy.ndarray
+            The output samples that can be computed from the data so far, with shape (samples, channels), or 1-D if
+            the data is 1-D.
+        """
+        data = np.asarray(data)
+        one_dimensional = data.ndim == 1
+        if one_dimensional:
+            data = data[:, np.newaxis]
+        dtype = np.result_type(data, self.coefficients)
+        num_rows = self._polyphase_coefficients.shape[0]
+        if self._pending is None:
+            # Pad the start with zeros so that the last sample of each group of factor samples is an output sample.
+            self._pending = np.zeros((self.factor - 1 - self.phase, data.shape[1]), dtype=dtype)
+            self._history = np.zeros((num_rows - 1, self.factor, data.shape[1]), dtype=dtype)
+        elif data.shape[1] != self._pending.shape[1]:
+            raise ValueError("Expected {} channels, not {}.".format(self._pending.shape[1], data.shape[1]))
+        pending = np.concatenate((self._pending, data.astype(dtype, copy=False)))
+        num_groups = pending.shape[0] // self.factor
+        # Group g, reversed, contains the input samples x[n - p] for p = 0, ..., factor - 1, where n is its output.
+        groups = pending[:num_groups * self.factor].reshape((num_groups, self.factor, data.shape[1]))[:, ::-1, :]
+        self._pending = pending[num_groups * self.factor:]
+        groups = np.concatenate((self._history, groups))
+        # Output m is the sum over j and p of H[j, p] times sample p of group num_rows - 1 - j + m. The samples of each
+        # phase p are made contiguous, complex samples are treated as pairs of real samples when the coefficients are
+        # real, the products are accumulated in blocks of outputs that fit in the cache, and the zero coefficients of
+        # half-band filters are skipped.
+        phases = np.ascontiguousarray(np.rollaxis(groups, 1))
+        if np.iscomplexobj(phases) and not np.iscomplexobj(self.coefficients):
+            phases = phases.view(phases.real.dtype)
+        coefficients = self._polyphase_coefficients.astype(phases.dtype)
+        result = np.zeros((num_groups, phases.shape[2]), dtype=phases.dtype)
+        product = np.empty((min(self.block_size, num_groups), phases.shape[2]), dtype=phases.dtype)
+        for block_start in range(0, num_groups, self.block_size):
+            block_stop = min(block_start + self.block_size, num_groups)
+            block = result[block_start:block_stop]
+            block_product = product[:block_stop - block_start]
+            for j, p in self._nonzero:
+                start = block_start + num_rows - 1 - j
+                np.multiply(coefficients[j, p], phases[p, start:start + block_stop - block_start], out=block_product)
+                block += block_product
+        result = result.view(dtype)
+        self._history = groups[groups.shape[0] - (num_rows - 1):].copy()
+        if one_dimensional:
+            return result[:, 0]
+        return result
+
+
+def half_band_coefficients(num_taps=33, window=('chebwin', 80), dtype=np.float32):
+    """
+    Return the coefficients of a symmetric half-band low-pass filter with cutoff at half of the Nyquist frequency.
+
+    Every second coefficient except the center one is zero, and these are set exactly to zero so that a
+    PolyphaseDecimator skips them. The number of taps should be 1 more than a multiple of 4, since otherwise the first
+    and last coefficients are zero.
+    """
+    coefficients = scipy.signal.firwin(num_taps, 0.5, window=window)
+    coefficients[np.abs(coefficients) < 1e-12 * np.abs(coefficients).max()] = 0
+    return coefficients.astype(dtype)
+
+
+class MultistageDecimator(object):
+    """
+    Decimate blocks of multi-channel data by an integer factor with a chain of PolyphaseDecimators.
+
+    The factor is split into factors of 2, each done by a half-band filter, and the remaining odd factor, if any, which
+    is done last by a low-pass filter with cutoff at the final Nyquist frequency. Each stage runs at the output rate of
+    the previous one, so most of the work is done by the short half-band filters.
+    """
+
+    def __init__(self, factor, half_band_taps=33, final_taps_per_factor=16, window=('chebwin', 80),
+                 dtype=np.float32):
+        """
+        Parameters
+        ----------
+        factor : int
+            The total decimation factor.
+        half_band_taps : int
+            The number of taps in each half-band filter; see half_band_coefficients().
+        final_taps_per_factor : int
+            The number of taps of the final filter, if there is one, is this times its factor.
+        window : str or tuple
+            The window used to design the filters; see scipy.signal.firwin().
+        dtype : numpy.dtype
+            The dtype of the filter coefficients.
+        """
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError("The decimation factor must be positive.")
+        self.factor = factor
+        self.stages = []
+        while factor % 2 == 0:
+            self.stages.append(PolyphaseDecimator(half_band_coefficients(half_band_taps, window=window, dtype=dtype),
+                                                  2))
+            factor //= 2
+        if factor > 1:
+            coefficients = scipy.signal.firwin(final_taps_per_factor * factor, 1 / factor, window=window)
+            self.stages.append(PolyphaseDecimator(coefficients.astype(dtype), factor))
+
+    @property
+    def delay(self):
+        """float: the total group delay, in input samples."""
+        delay = 0
+        rate = 1
+        for stage in self.stages:
+            delay += stage.delay * rate
+            rate *= stage.factor
+        return delay
+
+    def reset(self):
+        """Clear the state of every stage."""
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, data):
+        """
+        Filter and decimate the next block of data, with shape (samples, channels); see PolyphaseDecimator.process().
+        """
+        for stage in self.stages:
+            data = stage.process(data)
+        return data
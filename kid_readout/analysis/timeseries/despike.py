@@ -1,13 +1,16 @@
 import random
 import numpy as np
 from matplotlib import pyplot as plt
+from scipy import ndimage
 from scipy.ndimage import filters
 import scipy.signal
-from kid_readout.analysis.timeseries.fftfilt import fftfilt
+from kid_readout.analysis.timeseries.fftfilt import fftfilt, OverlapSaveFilter
+
+_lpf256_filter = OverlapSaveFilter(scipy.signal.firwin(256,1/256.))
 
 
 def lpf256(ts):
-    return fftfilt(scipy.signal.firwin(256,1/256.),ts)
+    return _lpf256_filter.filter(ts).astype(np.asarray(ts).dtype, copy=False)
 
 
 def medmadmask(ts,thresh=8,axis=0):
@@ -65,69 +68,150 @@ def despike_full(data, window_length, rejection_threshold=7, preprocess_function
 
 def deglitch_mask_block_mad(ts,thresh=5,mask_extend=50,debug=False):
     """
+    Return a mask that is True where the deviation of ts from its median is larger than thresh times the median
+    absolute deviation, extended by mask_extend - 1 samples on each side.
 
     Parameters
     ----------
-    ts
-    thresh
-    mask_extend
-    debug
+    ts : numpy.ndarray(float)
+        The data; if it has more than one dimension, each block along the last axis is treated separately.
+    thresh : float
+        The threshold in units of the median absolute deviation.
+    mask_extend : int
+        The extension of the mask around each sample above the threshold is one less than this.
+    debug : bool
+        If True, plot the deviations and masks.
 
     Returns
     -------
-
+    numpy.ndarray(bool)
+        The mask, with the same shape as ts.
     """
-    median = np.median(ts)
+    median = np.median(ts, axis=-1)[..., np.newaxis]
     deviations = np.abs(ts-median)
-    mad = np.median(deviations)
+    mad = np.median(deviations, axis=-1)[..., np.newaxis]
     mask = deviations > (mad*thresh)
     if debug:
         plt.plot(deviations)
         plt.plot(mask*deviations.max(),'o')
-    new_mask = mask.copy()
-    for offset in range(1,mask_extend):
-        new_mask[:-offset] |= mask[offset:]
-        new_mask[offset:] |= mask[:-offset]
-    mask = new_mask
-#    mask[:-mask_extend] = (~mask[:-mask_extend] | ~mask[mask_extend:])
-#    mask[mask_extend:] = mask[mask_extend:] | mask[:-mask_extend]
+    if mask_extend > 1:
+        # A single dilation along the last axis replaces shifting the mask by each offset up to mask_extend - 1; the
+        # running maximum of a boolean array is a binary dilation, and it is much faster than binary_dilation().
+        mask = ndimage.maximum_filter1d(mask, size=2 * mask_extend - 1, axis=-1, mode='constant', cval=0)
     if debug:
         plt.plot(mask*deviations.max(),'x',mew=2)
     return mask
 
 
 def deglitch_mask_mad(ts,thresh=5,mask_extend=50,window_length=2**8):
-    full_mask = np.zeros(ts.shape,dtype='bool')
-    step = window_length//2
-    if step > ts.shape[0]:
-        step = ts.shape[0]
-    nstep = ts.shape[0]//step
-    for k in xrange(nstep):
-        start = k-1
-        if start < 0:
-            start = 0
-        chunk = ts[start*step:(k+1)*step]
-        mask = deglitch_mask_block_mad(chunk,thresh=thresh,mask_extend=mask_extend)
-        full_mask[start*step:((start+1)*step)] |= mask[:step]
-    full_mask[start*step:start*step+len(mask)] |= mask
+    """
+    Return a mask that is True for samples of ts that are glitches, using medians and median absolute deviations
+    calculated in blocks of window_length samples that overlap by half.
+
+    Block 0 contains the first half window, and block k > 0 contains the samples from (k - 1) * step to (k + 1) * step,
+    where step = window_length // 2; each block is masked by deglitch_mask_block_mad(), and the first half of each
+    block's mask is used, except for the last block, whose whole mask is used. Any samples after the last full step
+    are not masked. All blocks, and all channels if ts has more than one dimension, are processed at once using a
+    strided view of the data.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray(float)
+        The data, with time on the last axis; for example, an array with shape (channels, samples).
+    thresh : float
+        The threshold in units of the median absolute deviation.
+    mask_extend : int
+        The extension of the mask around each glitch is one less than this.
+    window_length : int
+        The number of samples in each block.
+
+    Returns
+    -------
+    numpy.ndarray(bool)
+        The mask, with the same shape as ts.
+    """
+    ts = np.asarray(ts)
+    num_samples = ts.shape[-1]
+    step = min(window_length//2, num_samples)
+    nstep = num_samples//step
+    full_mask = np.zeros(ts.shape, dtype='bool')
+    full_mask[..., :step] = deglitch_mask_block_mad(ts[..., :step], thresh=thresh, mask_extend=mask_extend)
+    if nstep > 1:
+        blocks = np.lib.stride_tricks.as_strided(ts, shape=ts.shape[:-1] + (nstep - 1, 2 * step),
+                                                 strides=ts.strides[:-1] + (step * ts.strides[-1], ts.strides[-1]))
+        masks = deglitch_mask_block_mad(blocks, thresh=thresh, mask_extend=mask_extend)
+        full_mask[..., :(nstep - 1) * step] |= masks[..., :step].reshape(ts.shape[:-1] + ((nstep - 1) * step,))
+        full_mask[..., (nstep - 2) * step:nstep * step] |= masks[..., -1, :]
     return full_mask
 
-def mask_glitches(ts_list,mask,window_length):
+
+def mask_glitches(ts_list,mask,window_length,seed=None):
+    """
+    Return copies of the given time series in which each masked sample is replaced by an unmasked sample chosen at
+    random from the same window.
+
+    The window of a sample in half-window h, where step = window_length // 2, contains the samples from h * step to
+    (h + 2) * step, or the last full window if that would extend past the last full step. Any samples after the last
+    full step are not replaced. The same replacement samples are used for every time series, so that related series,
+    such as x and q, remain consistent. All masked samples in all channels are replaced at once.
+
+    Parameters
+    ----------
+    ts_list : numpy.ndarray or list of numpy.ndarray
+        The time series, each with the same shape as the mask.
+    mask : numpy.ndarray(bool)
+        The mask, with time on the last axis; for example, an array with shape (channels, samples).
+    window_length : int
+        The number of samples in each window.
+    seed : None, int, or numpy.random.RandomState
+        If None, use the global numpy random state; otherwise, use this seed or random state, so that the replacement
+        is reproducible.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        The time series with the masked samples replaced.
+
+    Raises
+    ------
+    ValueError
+        If every sample in the window of a masked sample is masked.
+    """
     if type(ts_list) is np.ndarray:
         ts_list = [ts_list]
+    mask = np.asarray(mask, dtype='bool')
+    num_samples = mask.shape[-1]
     step = window_length//2
-    nstep = ts_list[0].shape[0]//step
-    clean_ts = [ts.copy() for ts in ts_list]
-    for k in xrange(nstep):
-        start = k-1
-        if start < 0:
-            start = 0
-        local_mask = mask[start*step:(k+1)*step]
-        for clean in clean_ts:
-            chunk = clean[start*step:(k+1)*step]
-            nmask = local_mask.sum()
-            if nmask:
-                chunk[local_mask] = np.random.choice(chunk[~local_mask],nmask)
+    nstep = num_samples//step
+    # The copies are C-contiguous so that the flat views below write to them.
+    clean_ts = [np.array(ts, order='C') for ts in ts_list]
+    mask = mask.reshape(-1, num_samples)
+    replaced = np.flatnonzero(mask[:, :nstep * step])
+    if not replaced.size:
+        return clean_ts
+    channel, position = np.divmod(replaced, nstep * step)
+    start = np.clip(position // step, 0, max(nstep - 2, 0)) * step
+    stop = np.minimum(start + 2 * step, nstep * step)
+    good = ~mask
+    # Element [c, n] is the number of unmasked samples in channel c before sample n.
+    good_before = np.zeros((good.shape[0], num_samples + 1), dtype=int)
+    np.cumsum(good, axis=1, out=good_before[:, 1:])
+    available = good_before[channel, stop] - good_before[channel, start]
+    if np.any(available == 0):
+        raise ValueError("more masked values than samples to draw from!")
+    if seed is None:
+        random = np.random.random_sample(replaced.size)
+    elif isinstance(seed, np.random.RandomState):
+        random = seed.random_sample(replaced.size)
+    else:
+        random = np.random.RandomState(seed).random_sample(replaced.size)
+    rank = (np.concatenate(([0], np.cumsum(good_before[:, -1])[:-1]))[channel] + good_before[channel, start] +
+            np.minimum((random * available).astype(int), available - 1))
+    source = np.flatnonzero(good)[rank]
+    destination = channel * num_samples + position
+    for clean in clean_ts:
+        flat = clean.reshape(-1)
+        flat[destination] = flat[source]
     return clean_ts
 
 def deglitch_new(ts,thresh=6,mask_extend=50,window_length=2**16):
@@ -1,15 +1,24 @@
 """
-Filter data with an FIR filter using the overlap-add method.
+Filter data with an FIR filter using FFTs.
 
+fftfilt_nd() uses the overlap-add method, and this code is originally from here:
+https://github.com/scipy/scipy/issues/1364
 
-    This code is originally from here:
-    https://github.com/scipy/scipy/issues/1364
+OverlapSaveFilter uses the overlap-save method: it computes the spectrum of the filter once, uses real FFTs when both
+the filter and the data are real, transforms all of the blocks of a multi-channel array at once, and can keep its state
+between calls so that a stream can be filtered in pieces. fftfilt() uses a cached OverlapSaveFilter for each filter, so
+repeated calls with the same coefficients do not recompute the filter spectrum.
 """
+from collections import OrderedDict
 
+import numpy as np
 from numpy import abs, min, log2, ceil, floor, argmin, \
      zeros, arange, shape, float, zeros_like, atleast_2d
 from numpy.fft import fft, ifft
 
+FILTER_CACHE_SIZE = 16
+_filter_cache = OrderedDict()
+
 def nextpow2(x):
     """Return the first integer N such that 2**N >= abs(x)"""
     
@@ -17,67 +26,153 @@ def nextpow2(x):
 
 def fftfilt(b, x, *n):
     """Filter the signal x with the FIR filter described by the
-    coefficients in b using the overlap-add method. If the FFT
-    length n is not specified, it and the overlap-add block length
-    are selected so as to minimize the computational cost of
-    the filtering operation.
+    coefficients in b. If the FFT length n is not specified, it is
+    selected so as to minimize the computational cost of filtering
+    a long signal. If x is 2-D, each column is filtered.
 
-    """
-    
-    N_x = len(x)
-    N_b = len(b)
+    The output has the same length and dtype as x; the filter for
+    each b and n is cached, so its spectrum is computed only once.
 
-    # Determine the FFT length to use:
+    """
+    x = np.asarray(x)
     if len(n):
-
-        # Use the specified FFT length (rounded up to the nearest
-        # power of 2), provided that it is no less than the filter
-        # length:
         n = n[0]
         if n != int(n) or n <= 0:
             raise ValueError('n must be a nonnegative integer')
-        if n < N_b:
-            n = N_b
-        N_fft = 2**nextpow2(n)
+        nfft = n
     else:
+        nfft = None
+    return _cached_filter(b, nfft).filter(x).astype(x.dtype, copy=False)
 
-        if N_x > N_b:
 
-            # When the filter length is smaller than the signal,
-            # choose the FFT length and block size that minimize the
-            # FLOPS cost. Since the cost for a length-N FFT is
-            # (N/2)*log2(N) and the filtering operation of each block
-            # involves 2 FFT operations and N multiplications, the
-            # cost of the overlap-add method for 1 length-N block is
-            # N*(1+log2(N)). For the sake of efficiency, only FFT
-            # lengths that are powers of 2 are considered:
-            N = 2**arange(ceil(log2(N_b)),floor(log2(N_x)))
-            cost = ceil(N_x/(N-N_b+1))*N*(log2(N)+1)
-            N_fft = N[argmin(cost)]
-
-        else:
+class OverlapSaveFilter(object):
+    """
+    Filter data with an FIR filter using the overlap-save method.
 
-            # When the filter length is at least as long as the signal,
-            # filter the signal using a single block:
-            N_fft = 2**nextpow2(N_b+N_x-1)
+    The output sample y[n] is sum_k b[k] x[n - k], where the samples before the start of the data are zero, so the
+    output has the same length as the input and matches fftfilt(). Call filter() to filter independent arrays, or
+    process() to filter consecutive pieces of a stream, which gives the same result as filtering the whole stream at
+    once.
+    """
 
-    N_fft = int(N_fft)
-    
-    # Compute the block length:
-    L = int(N_fft - N_b + 1)
-    
-    # Compute the transform of the filter:
-    H = fft(b,N_fft)
+    def __init__(self, b, nfft=None, max_batch_size=2 ** 22):
+        """
+        Parameters
+        ----------
+        b : numpy.ndarray
+            The filter coefficients.
+        nfft : int
+            The FFT length, which is rounded up to a power of 2 larger than the number of coefficients; if None, it
+            is chosen to minimize the cost per sample of filtering a long signal.
+        max_batch_size : int
+            The approximate maximum number of values that are transformed at once; the channels are transformed in
+            groups.
+        """
+        self.b = np.array(b)
+        num_taps = self.b.size
+        if nfft is None:
+            # The cost of each block of length N is about N * (1 + log2(N)), and it produces N - num_taps + 1 samples.
+            N = 2 ** arange(nextpow2(num_taps + 1), nextpow2(num_taps + 1) + 10)
+            nfft = N[argmin(N * (log2(N) + 1) / (N - num_taps + 1.))]
+        else:
+            nfft = 2 ** nextpow2(max(nfft, num_taps + 1))
+        self.nfft = int(nfft)
+        self.block_length = self.nfft - num_taps + 1
+        self.max_batch_size = max_batch_size
+        self._spectra = {}
+        self.reset()
+
+    @property
+    def num_taps(self):
+        return self.b.size
+
+    def reset(self):
+        """Clear the state, so that the next call to process() is treated as the start of the stream."""
+        self._history = None
+
+    def filter(self, x):
+        """
+        Return the filtered data, with the same shape as x, treating it as the start of a stream; the state used by
+        process() is not changed.
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            The data, with shape (samples,) or (samples, channels).
+        """
+        return self._filter(x, history=None)[0]
+
+    def process(self, x):
+        """
+        Return the filtered data for the next piece of a stream, with the same shape as x.
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            The data, with shape (samples,) or (samples, channels); the number of channels must not change.
+        """
+        y, self._history = self._filter(x, history=self._history)
+        return y
+
+    def spectrum(self, real):
+        """Return the cached spectrum of the filter: the rfft if real is True, otherwise the fft."""
+        if real not in self._spectra:
+            if real:
+                self._spectra[real] = np.fft.rfft(self.b, self.nfft)
+            else:
+                self._spectra[real] = np.fft.fft(self.b, self.nfft)
+        return self._spectra[real]
+
+    def _filter(self, x, history):
+        x = np.asarray(x)
+        one_dimensional = x.ndim == 1
+        if one_dimensional:
+            x = x[:, np.newaxis]
+        num_samples, num_channels = x.shape
+        dtype = np.result_type(x, self.b, np.float32)
+        real = not np.iscomplexobj(np.empty(0, dtype=dtype))
+        if history is None:
+            history = np.zeros((self.num_taps - 1, num_channels), dtype=dtype)
+        elif history.shape[1] != num_channels:
+            raise ValueError("Expected {} channels, not {}.".format(history.shape[1], num_channels))
+        num_blocks = -(-num_samples // self.block_length)
+        # Each block of nfft samples overlaps the previous one by num_taps - 1 samples, and the last block is padded.
+        # The channels are the first axis so that the samples of each block are contiguous for the FFTs.
+        padded = np.zeros((num_channels, num_blocks * self.block_length + self.num_taps - 1), dtype=dtype)
+        padded[:, :history.shape[0]] = history.T
+        padded[:, history.shape[0]:history.shape[0] + num_samples] = x.T
+        new_history = padded[:, num_samples:num_samples + self.num_taps - 1].T.copy()
+        blocks = np.lib.stride_tricks.as_strided(padded, shape=(num_channels, num_blocks, self.nfft),
+                                                 strides=(padded.strides[0], self.block_length * padded.strides[1],
+                                                          padded.strides[1]))
+        H = self.spectrum(real)
+        y = np.empty((num_channels, num_blocks, self.block_length), dtype=dtype)
+        batch = max(1, self.max_batch_size // (self.nfft * num_blocks))
+        for start in range(0, num_channels, batch):
+            if real:
+                filtered = np.fft.irfft(np.fft.rfft(blocks[start:start + batch]) * H, self.nfft)
+            else:
+                filtered = np.fft.ifft(np.fft.fft(blocks[start:start + batch]) * H)
+            # The first num_taps - 1 samples of each block are corrupted by circular wrapping and are discarded.
+            y[start:start + batch] = filtered[..., self.num_taps - 1:]
+        y = y.reshape((num_channels, -1))[:, :num_samples].T
+        if one_dimensional:
+            y = y[:, 0]
+        return y, new_history
+
+
+def _cached_filter(b, nfft=None):
+    """Return the cached OverlapSaveFilter for the given coefficients and FFT length, creating it if necessary."""
+    b = np.asarray(b)
+    key = (b.dtype.str, b.tobytes(), nfft)
+    overlap_save_filter = _filter_cache.pop(key, None)
+    if overlap_save_filter is None:
+        overlap_save_filter = OverlapSaveFilter(b, nfft=nfft)
+    _filter_cache[key] = overlap_save_filter  # The most recently used entry is last.
+    while len(_filter_cache) > FILTER_CACHE_SIZE:
+        _filter_cache.popitem(last=False)
+    return overlap_save_filter
 
-    y = zeros_like(x)
-    i = 0
-    while i <= N_x:
-        il = min([i+L,N_x])
-        k = min([i+N_fft,N_x])
-        yt = ifft(fft(x[i:il],N_fft)*H,N_fft) # Overlap..
-        y[i:k] = y[i:k] + yt[:k-i]            # and add
-        i += L
-    return y
 
 def fftfilt_nd(b, x, *n):
     """Filter the signal x with the FIR filter described by the
@@ -1,13 +1,18 @@
 import scipy.signal
 
+from kid_readout.analysis.timeseries.decimating_fir import PolyphaseDecimator
 from kid_readout.analysis.timeseries.fftfilt import fftfilt
 
 
 def low_pass_fir(data, num_taps=256, cutoff=1/256.,nyquist_freq=1.0,decimate_by=1):
     taps = scipy.signal.firwin(num_taps,cutoff/nyquist_freq)
+    if decimate_by > 1:
+        # Compute only the output samples that are kept: these are samples num_taps + m * decimate_by of the full-rate
+        # output, so the phase is num_taps % decimate_by and the first num_taps // decimate_by outputs are dropped.
+        decimator = PolyphaseDecimator(taps, decimate_by, phase=num_taps % decimate_by)
+        return decimator.process(data)[num_taps // decimate_by:]
     result = fftfilt(taps,data)[num_taps:]
-    result = result[::decimate_by].copy()  # add .copy to ensure we separate this from the full sized original data
+    result = result.copy()  # add .copy to ensure we separate this from the full sized original data
     return result
 
 lpf = low_pass_fir
-
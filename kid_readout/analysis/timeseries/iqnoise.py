@@ -6,7 +6,7 @@ import numpy as np
 from matplotlib import mlab
 from matplotlib.mlab import cbook
 
-from kid_readout.analysis.timeseries import binning
+from kid_readout.analysis.timeseries import binning, welch
 
 
 AutoAutoCross = namedtuple('AutoAutoCross', field_names=['f', 'S_aa', 'S_bb', 'S_ab'])
@@ -41,7 +41,7 @@ def auto_auto_cross(a, b, sample_rate, NFFT=None, detrend=mlab.detrend_none, win
     bins_per_decade : int
         The number of bins per decade; used only if binned is True.
     kwds : dict
-        Additional keywords to pass to mlab.psd and mlab.csd.
+        Additional keywords to pass to welch.csd_matrix, which accepts the same keywords as mlab.psd and mlab.csd.
 
     Returns
     -------
@@ -58,9 +58,11 @@ def auto_auto_cross(a, b, sample_rate, NFFT=None, detrend=mlab.detrend_none, win
         NFFT = int(2 ** (np.floor(np.log2(a.size)) - 3))
     if noverlap is None:
         noverlap = NFFT // 2
-    S_aa, f = mlab.psd(a, Fs=sample_rate, NFFT=NFFT, detrend=detrend, window=window, noverlap=noverlap, **kwds)
-    S_bb, f = mlab.psd(b, Fs=sample_rate, NFFT=NFFT, detrend=detrend, window=window, noverlap=noverlap, **kwds)
-    S_ab, f = mlab.csd(a, b, Fs=sample_rate, NFFT=NFFT, window=window, detrend=detrend, noverlap=noverlap, **kwds)
+    S, f = welch.csd_matrix(np.vstack((a, b)), Fs=sample_rate, NFFT=NFFT, detrend=detrend, window=window,
+                            noverlap=noverlap, **kwds)
+    S_aa = S[0, 0].real
+    S_bb = S[1, 1].real
+    S_ab = S[0, 1]
     if binned:
         f = f[1:-1]
         S_aa = S_aa[1:-1]
@@ -75,9 +77,10 @@ def pca_noise_with_errors(d, NFFT, Fs, window=mlab.window_hanning, detrend=mlab.
     # Assume the rotation is small so that the variance can be approximated using the values in the pre-PCA spectra.
     # Take the variance to be the square of the power in each bin, divided by the number of averaged spectra.
     n_averaged = d.size / NFFT
-    pii, pf = mlab.psd(d.real, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
-    pqq, pf = mlab.psd(d.imag, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
-    piq, pf = mlab.csd(d.real, d.imag, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
+    S, pf = welch.csd_matrix(np.vstack((d.real, d.imag)), NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
+    pii = S[0, 0].real
+    pqq = S[1, 1].real
+    piq = S[0, 1]
     if use_log_bins:
         bf, bc_ii, (bp_ii, bvar_ii) = binning.log_bin_with_variance(pf, pii, pii ** 2 / n_averaged)
         bf, bc_qq, (bp_qq, bvar_qq) = binning.log_bin_with_variance(pf, pqq, pqq ** 2 / n_averaged)
@@ -96,11 +99,11 @@ def pca_noise(d, NFFT=None, Fs=256e6/2.**11, window=mlab.window_hanning, detrend
         NFFT = int(2 ** (np.floor(np.log2(d.shape[0])) - 3))
         #print "using NFFT: 2**", np.log2(NFFT)
     if use_full_spectral_helper:
-        pii, pqq, piq, fr_orig, t = full_spectral_helper(d.real, d.imag, NFFT=NFFT, Fs=Fs, window=window,
-                                                         detrend=detrend)
-        pii = pii.mean(1)
-        pqq = pqq.mean(1)
-        piq = piq.mean(1)
+        # This computes all three spectra from one set of FFTs.
+        S, fr_orig = welch.csd_matrix(np.vstack((d.real, d.imag)), NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
+        pii = S[0, 0].real
+        pqq = S[1, 1].real
+        piq = S[0, 1]
     else:
         pii, fr_orig = mlab.psd(d.real, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
         pqq, fr = mlab.psd(d.imag, NFFT=NFFT, Fs=Fs, window=window, detrend=detrend)
@@ -114,27 +117,56 @@ def pca_noise(d, NFFT=None, Fs=256e6/2.**11, window=mlab.window_hanning, detrend
 
 
 def calculate_pca_noise(pii, pqq, piq):
-    nf = pii.shape[0]
-    evals = np.zeros((2, nf))  # since the matrix is hermetian, eigvals are real
-    evects = np.zeros((2, 2, nf), dtype='complex')
-    for k in range(nf):
-        m = np.array([[pii[k], np.real(piq[k])],
-                      [np.conj(np.real(piq[k])), pqq[k]]])
-        w, v = np.linalg.eigh(m)
-        evals[:, k] = w
-        evects[:, :, k] = v
-    angles = np.zeros((2, nf))
+    """
+    Return the results of principal component analysis of the spectral density matrix at each frequency.
+
+    At each frequency, the real symmetric matrix [[pii, Re(piq)], [Re(piq), pqq]] is diagonalized in closed form, for
+    all frequencies at once. The eigenvalues are in increasing order, and the eigenvector of the smaller eigenvalue is
+    the larger one rotated by +90 degrees; the sign of the eigenvectors, which is arbitrary, may differ from that
+    returned by np.linalg.eigh(). The spectra S are the diagonal elements of the full spectral density matrix at each
+    frequency in the basis of the eigenvectors at the first frequency.
+
+    Parameters
+    ----------
+    pii : numpy.ndarray(float)
+        The spectral density of the real part.
+    pqq : numpy.ndarray(float)
+        The spectral density of the imaginary part.
+    piq : numpy.ndarray(complex)
+        The cross-spectral density of the real and imaginary parts.
+
+    Returns
+    -------
+    S : numpy.ndarray(float)
+        The spectral densities in the basis of the first eigenvectors, with shape (2, number of frequencies).
+    evals : numpy.ndarray(float)
+        The eigenvalues, with shape (2, number of frequencies).
+    evects : numpy.ndarray(complex)
+        The eigenvectors, with shape (2, 2, number of frequencies); evects[:, n, k] is eigenvector n at frequency k.
+    angles : numpy.ndarray(float)
+        The angles of the eigenvectors from the imaginary axis, in [0, pi), with shape (2, number of frequencies).
+    """
+    pii = np.real(pii)
+    pqq = np.real(pqq)
+    r = np.real(piq)
+    mean = (pii + pqq) / 2
+    half_difference = (pii - pqq) / 2
+    radius = np.hypot(half_difference, r)
+    evals = np.array([mean - radius, mean + radius])  # since the matrix is hermetian, eigvals are real
+    # The eigenvector of the larger eigenvalue is at this angle from the real axis.
+    theta = np.arctan2(r, half_difference) / 2
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    evects = np.array([[-sin, cos],
+                       [cos, sin]], dtype='complex')
+    angles = np.zeros((2, pii.shape[0]))
     angles[0, :] = np.mod(np.arctan2(evects[0, 0, :].real, evects[1, 0, :].real), np.pi)
     angles[1, :] = np.mod(np.arctan2(evects[0, 1, :].real, evects[1, 1, :].real), np.pi)
-    S = np.zeros((2, nf))
     v = evects[:, :, 0]
     invv = np.linalg.inv(v)
-    for k in range(nf):
-        m = np.array([[pii[k], piq[k]],
-                      [np.conj(piq[k]), pqq[k]]])
-        ss = np.dot(np.dot(invv, m), v)
-        S[0, k] = ss[0, 0]
-        S[1, k] = ss[1, 1]
+    m = np.array([[pii, piq],
+                  [np.conj(piq), pqq]])
+    S = np.einsum('ij,jlk,li->ik', invv, m, v).real
     return S, evals, evects, angles
 
 
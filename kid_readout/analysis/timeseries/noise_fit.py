@@ -1,6 +1,8 @@
+from __future__ import division
 import lmfit
 from kid_readout.analysis import fitter
 import numpy as np
+import pandas as pd
 from matplotlib import pyplot as plt
 
 def single_pole(f, fc):
@@ -102,11 +104,16 @@ class SinglePoleLogNoiseModel(fitter.Fitter):
                 np.log(errors.view('float')))
 
 def fit_single_pole_noise(fr,sxx,errors=None,max_num_masked=None,debug=False):
+    """
+    Fit a SinglePoleNoiseModel to one spectrum, masking the number of highest points that gives the lowest reduced
+    chi-squared. Each number of masked points is fit with lmfit; fit_single_pole_noise_batch() makes the same choice for
+    many spectra at once, but its fits can differ from these when the errors are the ad hoc default.
+    """
     if errors is None:
         errors = sxx/fr #ad hoc, but seems to work
     reduced_chi2 = []
     if max_num_masked is None:
-        max_num_masked = len(fr)/2
+        max_num_masked = len(fr)//2
     for nmask in range(max_num_masked):
         mask = np.ones(fr.shape,dtype=np.bool)
         if nmask > 0:
@@ -122,3 +129,174 @@ def fit_single_pole_noise(fr,sxx,errors=None,max_num_masked=None,debug=False):
     if debug:
         plt.semilogy(range(max_num_masked),reduced_chi2)
     return nf
+
+
+def fit_single_pole_noise_batch(frequency, S, errors=None, max_num_masked=None, fc_bounds=(10, 1e4),
+                                num_fc_guesses=32, max_iterations=100, tolerance=1e-10):
+    """
+    Fit the model S = A / (1 + (f / fc)**2) + nw, which is device noise with a single-pole roll-off plus white amplifier
+    noise, to many spectra at once and return a table of the parameters.
+
+    For each spectrum, the fits are repeated with its 0, 1, ..., max_num_masked - 1 highest points masked, and the fit
+    with the lowest reduced chi-squared is kept, as in fit_single_pole_noise(). The model is linear in A and nw, so the
+    initial values come from weighted linear least squares for a grid of values of fc; every spectrum is then refined
+    by Levenberg-Marquardt iterations with analytic derivatives, done for all spectra at once. The parameters are
+    limited to the same ranges as those of SinglePoleNoiseModel, and the errors are calculated as lmfit does, from the
+    covariance matrix scaled by the reduced chi-squared.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray(float)
+        The frequencies, with shape (frequencies,) if they are the same for all spectra or (spectra, frequencies).
+    S : numpy.ndarray(float)
+        The spectra, with shape (spectra, frequencies); a 1-D array is one spectrum.
+    errors : numpy.ndarray(float) or None
+        The errors of the spectra, with the same shape; if None, use S / frequency, like fit_single_pole_noise().
+        Points with infinite or NaN errors or data are not used.
+    max_num_masked : int or None
+        The number of masking choices to try; if None, use half the number of frequencies.
+    fc_bounds : (float, float)
+        The minimum and maximum values of fc.
+    num_fc_guesses : int
+        The number of values of fc, spaced logarithmically between the bounds, used to find the initial values.
+    max_iterations : int
+        The maximum number of Levenberg-Marquardt iterations.
+    tolerance : float
+        The iterations stop when the fractional decrease of chi-squared is less than this for every spectrum.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A table with one row per spectrum and the columns fc, fc_err, A, A_err, nw, nw_err, redchi, and num_masked.
+    """
+    S = np.atleast_2d(np.asarray(S, dtype=np.float))
+    frequency = np.asarray(frequency, dtype=np.float) * np.ones(S.shape)
+    if errors is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            errors = S / frequency
+    errors = np.asarray(errors, dtype=np.float) * np.ones(S.shape)
+    if max_num_masked is None:
+        max_num_masked = S.shape[1] // 2
+    values, stderr, redchi = _fit_masked(frequency, S, errors, max(max_num_masked, 1), fc_bounds=fc_bounds,
+                                         num_fc_guesses=num_fc_guesses, max_iterations=max_iterations,
+                                         tolerance=tolerance)
+    # Like argmin(), this chooses the smallest number of masked points if there are equal values, and NaN is last.
+    num_masked = np.argmin(np.where(np.isnan(redchi), np.inf, redchi), axis=0)
+    spectra = np.arange(S.shape[0])
+    best_values = values[num_masked, spectra]
+    best_stderr = stderr[num_masked, spectra]
+    return pd.DataFrame({'A': best_values[:, 0], 'A_err': best_stderr[:, 0],
+                         'nw': best_values[:, 1], 'nw_err': best_stderr[:, 1],
+                         'fc': best_values[:, 2], 'fc_err': best_stderr[:, 2],
+                         'redchi': redchi[num_masked, spectra], 'num_masked': num_masked},
+                        columns=['fc', 'fc_err', 'A', 'A_err', 'nw', 'nw_err', 'redchi', 'num_masked'])
+
+
+def _fit_masked(frequency, S, errors, num_masking_choices, fc_bounds=(10, 1e4), num_fc_guesses=32,
+                max_iterations=100, tolerance=1e-10):
+    """
+    Fit the spectra with shape (spectra, frequencies) with 0, 1, ..., num_masking_choices - 1 of their highest points
+    masked and return the arrays of parameter values (A, nw, fc) and their errors, each with shape
+    (num_masking_choices, spectra, 3), and of the reduced chi-squared, with shape (num_masking_choices, spectra).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(np.isfinite(S) & np.isfinite(errors) & (errors != 0), 1 / errors, 0)
+    highest_first = np.argsort(np.abs(S), axis=1)[:, ::-1]
+    spectra = np.arange(S.shape[0])[:, np.newaxis]
+    results = []
+    for num_masked in range(num_masking_choices):
+        masked_weight = weight.copy()
+        masked_weight[spectra, highest_first[:, :num_masked]] = 0
+        results.append(_fit_weighted(frequency, S, masked_weight, fc_bounds, num_fc_guesses, max_iterations,
+                                     tolerance))
+    return [np.array(r) for r in zip(*results)]
+
+
+def _fit_weighted(f, S, weight, fc_bounds, num_fc_guesses, max_iterations, tolerance):
+    used = weight > 0
+    S = np.where(used, S, 0)
+    num_used = used.sum(axis=1)
+    # These are the limits used by single_pole_noise_guess().
+    with np.errstate(invalid='ignore'):
+        S_max = np.where(used, S, -np.inf).max(axis=1)
+        S_min = np.where(used, S, np.inf).min(axis=1)
+    lower = np.column_stack((np.zeros(S.shape[0]), S_min / 2, np.full(S.shape[0], fc_bounds[0])))
+    upper = np.column_stack((S_max, S_max, np.full(S.shape[0], fc_bounds[1])))
+    w2 = weight ** 2
+
+    def chi_squared_rows(values, rows):
+        A, nw, fc = [v[:, np.newaxis] for v in values.T]
+        return np.sum(w2[rows] * (A / (1 + (f[rows] / fc) ** 2) + nw - S[rows]) ** 2, axis=1)
+
+    # For fixed fc, the weighted least-squares values of A and nw solve a 2 x 2 linear system.
+    all_rows = np.arange(S.shape[0])
+    values = np.full((S.shape[0], 3), np.nan)
+    best = np.full(S.shape[0], np.inf)
+    for fc in np.logspace(np.log10(fc_bounds[0]), np.log10(fc_bounds[1]), num_fc_guesses):
+        L = 1 / (1 + (f / fc) ** 2)
+        a = np.sum(w2 * L ** 2, axis=1)
+        b = np.sum(w2 * L, axis=1)
+        c = np.sum(w2, axis=1)
+        d = np.sum(w2 * L * S, axis=1)
+        e = np.sum(w2 * S, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            determinant = a * c - b ** 2
+            trial = np.column_stack(((c * d - b * e) / determinant, (a * e - b * d) / determinant,
+                                     np.full(S.shape[0], fc)))
+        trial = np.clip(np.nan_to_num(trial), lower, upper)
+        with np.errstate(invalid='ignore'):
+            trial_chi_squared = chi_squared_rows(trial, all_rows)
+            better = trial_chi_squared < best
+        values[better] = trial[better]
+        best[better] = trial_chi_squared[better]
+
+    # Refine the spectra with Levenberg-Marquardt steps, keeping the parameters within their limits. A spectrum is done
+    # when a step decreases chi-squared by less than the tolerance or when no step decreases it.
+    damping = np.full(S.shape[0], 1e-3)
+    active = np.isfinite(best)
+    for iteration in range(max_iterations):
+        if not np.any(active):
+            break
+        rows = np.flatnonzero(active)
+        jacobian, residual = _weighted_jacobian_and_residual(f[rows], S[rows], weight[rows], values[rows])
+        curvature = np.einsum('snj,snk->sjk', jacobian, jacobian)
+        gradient = np.einsum('snj,sn->sj', jacobian, residual)
+        diagonal = np.einsum('sjj->sj', curvature)
+        # The damping is proportional to the curvature of each parameter, so the steps do not depend on the scales of
+        # the parameters; a parameter with no effect, such as fc when A is zero, is damped with unit scale.
+        scale = np.where(diagonal > 0, diagonal, 1)
+        damped = curvature + (damping[rows, np.newaxis] * scale)[:, :, np.newaxis] * np.eye(3)
+        step = -np.linalg.solve(damped, gradient[:, :, np.newaxis])[:, :, 0]
+        trial = np.clip(values[rows] + step, lower[rows], upper[rows])
+        trial_chi_squared = chi_squared_rows(trial, rows)
+        accept = trial_chi_squared < best[rows]
+        small = accept & (best[rows] - trial_chi_squared <= tolerance * best[rows])
+        values[rows[accept]] = trial[accept]
+        best[rows[accept]] = trial_chi_squared[accept]
+        damping[rows] = np.where(accept, damping[rows] / 10, damping[rows] * 10)
+        active[rows[small | (damping[rows] > 1e10)]] = False
+    redchi = np.where(np.isfinite(best) & (num_used > 3), best / np.maximum(num_used - 3, 1), np.nan)
+    jacobian = np.nan_to_num(_weighted_jacobian_and_residual(f, S, weight, values)[0])
+    # The columns are normalized before the inversion because the parameters can have very different scales.
+    norm = np.sqrt(np.sum(jacobian ** 2, axis=1))
+    norm[norm == 0] = 1
+    normalized = np.linalg.pinv(np.einsum('snj,snk->sjk', jacobian / norm[:, np.newaxis, :],
+                                          jacobian / norm[:, np.newaxis, :]))
+    with np.errstate(invalid='ignore'):
+        stderr = np.sqrt(np.einsum('sjj->sj', normalized) * redchi[:, np.newaxis]) / norm
+    return values, stderr, redchi
+
+
+def _weighted_jacobian_and_residual(f, S, weight, values):
+    """
+    Return the derivatives of the weighted model with respect to A, nw, and fc, with shape (spectra, frequencies, 3),
+    and the weighted residual.
+    """
+    A, nw, fc = [v[:, np.newaxis] for v in values.T]
+    L = 1 / (1 + (f / fc) ** 2)
+    jacobian = np.empty(S.shape + (3,))
+    jacobian[..., 0] = weight * L
+    jacobian[..., 1] = weight
+    jacobian[..., 2] = weight * 2 * A * f ** 2 * L ** 2 / fc ** 3
+    residual = weight * (A * L + nw - S)
+    return jacobian, residual
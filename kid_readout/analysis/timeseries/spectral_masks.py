@@ -1,21 +1,200 @@
+"""
+This module contains functions that mask narrow lines in spectral densities, such as the harmonics of the pulse tube
+and of the mains frequency, and a notch filter that removes such lines from time series before their spectra are
+calculated.
+
+A mask is a boolean array with the shape of the frequency array that is True for the frequencies to keep. The masks
+depend only on the frequency grid and the line parameters, and they are cached, so masking the spectra of every channel
+of a stream, or of many streams with the same sample rate and FFT length, computes each mask once. The lines are found
+with np.searchsorted() on the grid, so the cost is linear in the number of frequencies plus the number of lines times
+its logarithm. The functions with the signature (frequency, S_xx, S_qq, S_xq) can be used as the masking_function
+argument of SingleSweepStream.set_S() and SweepStreamArray.compute_spectra(), which exclude the masked frequencies from
+the bins and their counts.
+"""
+from __future__ import division
+from collections import OrderedDict
+
 import numpy as np
+from scipy import signal
+
+# The maximum number of masks and notch filters that are cached.
+MASK_CACHE_SIZE = 64
+_mask_cache = OrderedDict()
+_notch_cache = OrderedDict()
+
+
+def harmonic_mask(frequency, fundamental, max_harmonics=1, fractional_half_width=0., half_width=0.,
+                  min_bins_to_mask_per_harmonic=1):
+    """
+    Return a mask that is False for the frequencies near the harmonics of the given fundamental frequency.
+
+    Harmonic n has center n * fundamental and masks the frequencies within
+    center * fractional_half_width + half_width of its center, inclusive. If it masks fewer than
+    min_bins_to_mask_per_harmonic frequencies, that many frequencies starting near the one closest to its center are
+    also masked. The result is cached for each frequency grid and set of parameters.
+
+    Parameters
+    ----------
+    frequency : numpy.ndarray(float)
+        The frequencies of the spectral densities.
+    fundamental : float
+        The frequency of the first harmonic.
+    max_harmonics : int
+        The number of harmonics to mask.
+    fractional_half_width : float
+        The half-width of each masked region as a fraction of its center frequency.
+    half_width : float
+        A half-width added to the fractional half-width, in the same units as the frequencies.
+    min_bins_to_mask_per_harmonic : int
+        The minimum number of frequencies masked by each harmonic.
 
-def pulse_tube_mask(frequency,S_xx,S_qq,S_qx,fundamental=1.4,max_harmonics=1,fractional_half_width=0.1,
+    Returns
+    -------
+    numpy.ndarray(bool)
+        The mask, which is True for the frequencies to keep.
+    """
+    frequency = np.asarray(frequency)
+    key = (frequency.size, frequency[0], frequency[-1], 'harmonic', fundamental, max_harmonics, fractional_half_width,
+           half_width, min_bins_to_mask_per_harmonic)
+    return _cached_mask(key, frequency, lambda: _harmonic_mask(frequency, fundamental, max_harmonics,
+                                                               fractional_half_width, half_width,
+                                                               min_bins_to_mask_per_harmonic))
+
+
+def pulse_tube_mask(frequency, S_xx, S_qq, S_qx, fundamental=1.4, max_harmonics=1, fractional_half_width=0.1,
                     min_bins_to_mask_per_harmonic=1):
-    mask = np.ones(frequency.shape,dtype='bool')
-    for harmonic in range(1,max_harmonics+1):
-        center = fundamental*harmonic
-        low = center*(1-fractional_half_width)
-        high = center*(1+fractional_half_width)
-        to_mask = (frequency>=low) & (frequency<=high)
-        if to_mask.sum() < min_bins_to_mask_per_harmonic:
-            center_idx = np.abs(frequency-center).argmin()
-            min_idx = center_idx - min_bins_to_mask_per_harmonic//2
-            if min_idx < 0:
-                min_idx = 0
-            max_idx = min_idx + min_bins_to_mask_per_harmonic
-            if max_idx >= frequency.shape[0]:
-                max_idx = frequency.shape[0]
-            to_mask[min_idx:max_idx] = 1
-        mask = mask & ~to_mask
+    """
+    Return a mask that is False for the frequencies near the harmonics of the pulse tube; see harmonic_mask().
+
+    The spectral densities are not used.
+    """
+    return harmonic_mask(frequency, fundamental=fundamental, max_harmonics=max_harmonics,
+                         fractional_half_width=fractional_half_width,
+                         min_bins_to_mask_per_harmonic=min_bins_to_mask_per_harmonic)
+
+
+def mains_mask(frequency, S_xx=None, S_qq=None, S_qx=None, mains_frequency=60., max_harmonics=10, half_width=0.5,
+               min_bins_to_mask_per_harmonic=1):
+    """
+    Return a mask that is False for the frequencies within half_width of the harmonics of the mains frequency; see
+    harmonic_mask().
+
+    The spectral densities are not used.
+    """
+    return harmonic_mask(frequency, fundamental=mains_frequency, max_harmonics=max_harmonics, half_width=half_width,
+                         min_bins_to_mask_per_harmonic=min_bins_to_mask_per_harmonic)
+
+
+def combine(*masking_functions):
+    """
+    Return a masking function that keeps only the frequencies kept by all of the given masking functions.
+
+    Example
+    -------
+    sss.set_S(masking_function=combine(pulse_tube_mask, mains_mask))
+    """
+    def masking_function(frequency, S_xx, S_qq, S_qx):
+        mask = np.ones(np.shape(frequency), dtype='bool')
+        for function in masking_functions:
+            mask &= function(frequency, S_xx, S_qq, S_qx)
+        return mask
+    return masking_function
+
+
+def notch_filter(data, sample_rate, frequencies, quality_factor=30.):
+    """
+    Return the data with narrow lines at the given frequencies removed by second-order IIR notch filters.
+
+    The filters are applied forward and backward, so they do not shift the phase, and they are cached for each sample
+    rate, set of frequencies, and quality factor. Frequencies at or above the Nyquist frequency are ignored.
+
+    Parameters
+    ----------
+    data : numpy.ndarray(float or complex)
+        The time series, with time on the last axis.
+    sample_rate : float
+        The sample rate of the data.
+    frequencies : iterable(float)
+        The frequencies of the lines, in the same units as the sample rate.
+    quality_factor : float
+        The quality factor of each notch, which is its frequency divided by its -3 dB bandwidth.
+
+    Returns
+    -------
+    numpy.ndarray
+        The filtered data.
+    """
+    sos = _notch_sos(sample_rate, tuple(np.atleast_1d(frequencies)), quality_factor)
+    if not sos.size:
+        return data
+    if np.iscomplexobj(data):
+        return signal.sosfiltfilt(sos, data.real) + 1j * signal.sosfiltfilt(sos, data.imag)
+    return signal.sosfiltfilt(sos, data)
+
+
+def _harmonic_mask(frequency, fundamental, max_harmonics, fractional_half_width, half_width,
+                   min_bins_to_mask_per_harmonic):
+    if np.all(np.diff(frequency) >= 0):
+        order = None
+        sorted_frequency = frequency
+    else:
+        order = np.argsort(frequency, kind='mergesort')
+        sorted_frequency = frequency[order]
+    size = frequency.size
+    center = fundamental * np.arange(1, max_harmonics + 1)
+    width = center * fractional_half_width + half_width
+    # Each harmonic masks the contiguous range of sorted frequencies from start to stop.
+    start = np.searchsorted(sorted_frequency, center - width, side='left')
+    stop = np.searchsorted(sorted_frequency, center + width, side='right')
+    few = stop - start < min_bins_to_mask_per_harmonic
+    if np.any(few):
+        # Find the frequency closest to each of these centers; on a tie, use the lower one.
+        upper = np.clip(np.searchsorted(sorted_frequency, center[few]), 0, size - 1)
+        lower = np.clip(upper - 1, 0, size - 1)
+        closer_lower = np.abs(sorted_frequency[lower] - center[few]) <= np.abs(sorted_frequency[upper] - center[few])
+        closest = np.where(closer_lower, lower, upper)
+        extra_start = np.maximum(closest - min_bins_to_mask_per_harmonic // 2, 0)
+        extra_stop = np.minimum(extra_start + min_bins_to_mask_per_harmonic, size)
+        # The closest frequency is in both ranges when the first is not empty, so their union is a range.
+        empty = start[few] >= stop[few]
+        start[few] = np.where(empty, extra_start, np.minimum(start[few], extra_start))
+        stop[few] = np.where(empty, extra_stop, np.maximum(stop[few], extra_stop))
+    nonempty = start < stop
+    change = np.zeros(size + 1, dtype=int)
+    np.add.at(change, start[nonempty], 1)
+    np.add.at(change, stop[nonempty], -1)
+    keep = np.cumsum(change[:-1]) == 0
+    if order is None:
+        return keep
+    mask = np.empty(size, dtype='bool')
+    mask[order] = keep
     return mask
+
+
+def _cached_mask(key, frequency, compute):
+    """Return a copy of the cached mask for the given key and frequencies, calling compute() to create it if needed."""
+    cached = _mask_cache.pop(key, None)
+    if cached is None or not np.array_equal(cached[0], frequency):
+        cached = (frequency.copy(), compute())
+    _mask_cache[key] = cached  # The most recently used entry is last.
+    while len(_mask_cache) > MASK_CACHE_SIZE:
+        _mask_cache.popitem(last=False)
+    return cached[1].copy()
+
+
+def _notch_sos(sample_rate, frequencies, quality_factor):
+    """Return the cached second-order sections of the notch filters, creating them if necessary."""
+    key = (sample_rate, frequencies, quality_factor)
+    sos = _notch_cache.pop(key, None)
+    if sos is None:
+        nyquist = sample_rate / 2
+        sections = [signal.tf2sos(*signal.iirnotch(f / nyquist, quality_factor)) for f in frequencies
+                    if 0 < f < nyquist]
+        if sections:
+            sos = np.vstack(sections)
+        else:
+            sos = np.zeros((0, 6))
+    _notch_cache[key] = sos
+    while len(_notch_cache) > MASK_CACHE_SIZE:
+        _notch_cache.popitem(last=False)
+    return sos
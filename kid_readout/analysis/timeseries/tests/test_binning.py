@@ -0,0 +1,104 @@
+import numpy as np
+
+from kid_readout.analysis.timeseries import binning
+
+
+def loop_log_bin_with_variance(frequency, bins_per_decade, data, variance):
+    # This is the original implementation, which loops over the bins.
+    edges = binning.log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
+    bin_indices = np.digitize(frequency, edges)
+    indices_used = np.unique(bin_indices)
+    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
+    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
+    binned_data = np.array([np.mean(data[bin_indices == n]) for n in indices_used])
+    binned_variance = np.array([np.mean(variance[bin_indices == n]) / c for n, c in zip(indices_used, counts)])
+    return edges, counts, mean_frequency, binned_data, binned_variance
+
+
+def test_log_bin_with_variance():
+    np.random.seed(0)
+    for frequency in [np.linspace(0, 1000, 10001), np.linspace(0.5, 200, 4000)]:
+        data = np.random.randn(frequency.size) + 1j * np.random.randn(frequency.size)
+        variance = np.random.rand(frequency.size)
+        expected = loop_log_bin_with_variance(frequency, 10, data, variance)
+        edges, counts, mean_frequency, [(binned_data, binned_variance)] = binning.log_bin_with_variance(
+            frequency, 10, (data, variance))
+        np.testing.assert_array_equal(edges, expected[0])
+        np.testing.assert_array_equal(counts, expected[1])
+        np.testing.assert_allclose(mean_frequency, expected[2], rtol=1e-12)
+        np.testing.assert_allclose(binned_data, expected[3], rtol=1e-10)
+        np.testing.assert_allclose(binned_variance, expected[4], rtol=1e-10)
+        edges, counts, mean_frequency, [binned] = binning.log_bin(frequency, 10, np.vstack((data.real, data.imag)))
+        np.testing.assert_allclose(binned[0], expected[3].real, rtol=1e-10)
+        np.testing.assert_allclose(binned[1], expected[3].imag, rtol=1e-10)
+
+
+def test_log_bins_cache():
+    frequency = np.linspace(0, 100, 1001)
+    bins = binning.log_bins(frequency, 30)
+    assert binning.log_bins(frequency.copy(), 30) is bins
+    assert binning.log_bins(frequency, 20) is not bins
+    changed = frequency.copy()
+    changed[500] += 0.01
+    assert binning.log_bins(changed, 30) is not bins
+
+
+def test_log_bin_returns_copies():
+    frequency = np.linspace(0, 100, 1001)
+    data = np.ones(frequency.size)
+    edges, counts, mean_frequency, [binned] = binning.log_bin(frequency, 30, data)
+    edges[:] = 0
+    counts[:] = 0
+    mean_frequency[:] = 0
+    edges, counts, mean_frequency, [(binned, variance)] = binning.log_bin_with_variance(frequency, 30, (data, data))
+    assert np.all(counts > 0)
+    assert np.all(mean_frequency[1:] > 0)
+    np.testing.assert_array_equal(edges, binning.log_bin_edges(frequency, 30, ensure_none_empty=True))
+    edges[:] = 0
+    counts[:] = 0
+    bins = binning.log_bins(frequency, 30)
+    assert np.all(bins.counts > 0)
+    assert np.all(np.diff(bins.edges) > 0)
+
+
+def test_unsorted_frequency():
+    np.random.seed(1)
+    frequency = np.linspace(0, 100, 1001)
+    data = np.random.randn(frequency.size)
+    order = np.random.permutation(frequency.size)
+    bins = binning.log_bins(frequency, 10)
+    shuffled = binning.Bins(frequency[order], bins.edges)
+    np.testing.assert_array_equal(shuffled.counts, bins.counts)
+    np.testing.assert_allclose(shuffled.mean_frequency, bins.mean_frequency, rtol=1e-12)
+    np.testing.assert_allclose(shuffled.mean(data[order]), bins.mean(data), rtol=1e-10)
+
+
+def test_log_bin_old():
+    np.random.seed(2)
+    frequency = np.linspace(0, 500, 2049)
+    data = np.random.randn(frequency.size)
+    freq_bins = binning.make_freq_bins(frequency)
+    bin_indices = np.digitize(frequency, freq_bins)
+    expected_frequency = np.array([frequency[bin_indices == k].mean() for k in range(1, len(freq_bins))])
+    expected_data = np.array([data[bin_indices == k].mean() for k in range(1, len(freq_bins))])
+    binned_frequency, binned_data = binning.log_bin_old(frequency, data)
+    np.testing.assert_allclose(binned_frequency, expected_frequency, rtol=1e-12)
+    np.testing.assert_allclose(binned_data, expected_data, rtol=1e-10)
+    binned_frequency, [binned_data] = binning.log_bin_old(frequency, [data])
+    np.testing.assert_allclose(binned_data, expected_data, rtol=1e-10)
+
+
+def test_log_bin_with_mask():
+    np.random.seed(0)
+    frequency = np.linspace(0.5, 200, 4000)
+    data = np.random.randn(frequency.size)
+    mask = np.random.rand(frequency.size) > 0.2
+    mask[(frequency > 1) & (frequency < 1.5)] = False
+    edges, counts, mean_frequency, [binned] = binning.log_bin(frequency, 10, data, mask=mask)
+    np.testing.assert_array_equal(edges, binning.log_bin(frequency, 10, data)[0])
+    assert counts.sum() == mask.sum()
+    bin_indices = np.digitize(frequency, edges)
+    expected = [data[mask & (bin_indices == n)].mean() for n in np.unique(bin_indices[mask])]
+    np.testing.assert_allclose(binned, expected, rtol=1e-12)
+    assert binning.log_bins(frequency, 10, mask=mask.copy()) is binning.log_bins(frequency, 10, mask=mask)
+    assert binning.log_bins(frequency, 10, mask=mask) is not binning.log_bins(frequency, 10)
@@ -1,5 +1,6 @@
-from kid_readout.analysis.timeseries import fftfilt, decimating_fir
+from kid_readout.analysis.timeseries import fftfilt, decimating_fir, filters
 import numpy as np
+import scipy.signal
 
 def test_decimating_fir():
     np.random.seed(123)
@@ -36,4 +37,49 @@ def test_fir1d_nstream():
     stream1 = fir2.apply(data[0,:])
     stream1 = fir2.apply(data[0,:])
 
-    assert  np.allclose(stream1,full[0,:])
\ No newline at end of file
+    assert  np.allclose(stream1,full[0,:])
+
+def test_polyphase_decimator():
+    np.random.seed(123)
+    coeff = np.random.randn(37)
+    data = np.random.randn(1000, 3) + 1j * np.random.randn(1000, 3)
+    for factor in [1, 2, 5]:
+        for phase in range(factor):
+            decimator = decimating_fir.PolyphaseDecimator(coeff, factor, phase=phase)
+            result = np.concatenate([decimator.process(data[start:stop])
+                                     for start, stop in [(0, 7), (7, 8), (8, 300), (300, 1000)]])
+            gold = np.array([scipy.signal.upfirdn(coeff, data[:, k])[phase::factor] for k in range(3)]).T
+            assert np.allclose(gold[:result.shape[0]], result)
+            assert result.shape[0] == len(range(phase, 1000, factor))
+    decimator.reset()
+    assert np.allclose(decimator.process(data[:, 0]), result[:, 0])
+
+
+def test_multistage_decimator():
+    np.random.seed(123)
+    data = (np.random.randn(2**12, 4) + 1j * np.random.randn(2**12, 4)).astype(np.complex64)
+    decimator = decimating_fir.MultistageDecimator(12)
+    assert [stage.factor for stage in decimator.stages] == [2, 2, 3]
+    result = decimator.process(data)
+    assert result.dtype == np.complex64
+    decimator.reset()
+    chunked = np.concatenate([decimator.process(chunk) for chunk in np.array_split(data, 7)])
+    assert np.allclose(result, chunked, atol=1e-5)
+    # A tone well inside the pass band passes with unit gain and is delayed by the group delay.
+    n = np.arange(2**14)
+    tone = np.exp(2j * np.pi * 0.002 * n)[:, np.newaxis]
+    decimator = decimating_fir.MultistageDecimator(12)
+    result = decimator.process(tone)[100:, 0]
+    expected = np.exp(2j * np.pi * 0.002 * (12 * np.arange(100, 100 + result.size) - decimator.delay))
+    assert np.allclose(result, expected, atol=1e-3)
+
+
+def test_low_pass_fir():
+    np.random.seed(123)
+    data = np.random.randn(10001)
+    for decimate_by in [1, 3, 16]:
+        taps = scipy.signal.firwin(256, 1 / 64.)
+        gold = fftfilt.fftfilt(taps, data)[256:][::decimate_by]
+        result = filters.low_pass_fir(data, num_taps=256, cutoff=1 / 64., decimate_by=decimate_by)
+        assert result.shape == gold.shape
+        assert np.allclose(gold, result)
@@ -0,0 +1,78 @@
+import numpy as np
+
+from kid_readout.analysis.timeseries import despike
+
+
+def loop_deglitch_mask_mad(ts, thresh, mask_extend, window_length):
+    # This is the original implementation, which loops over the blocks and the mask extension offsets.
+    def block_mask(block):
+        deviations = np.abs(block - np.median(block))
+        mask = deviations > (np.median(deviations) * thresh)
+        new_mask = mask.copy()
+        for offset in range(1, mask_extend):
+            new_mask[:-offset] |= mask[offset:]
+            new_mask[offset:] |= mask[:-offset]
+        return new_mask
+
+    full_mask = np.zeros(ts.shape, dtype='bool')
+    step = min(window_length // 2, ts.shape[0])
+    nstep = ts.shape[0] // step
+    for k in range(nstep):
+        start = max(k - 1, 0)
+        mask = block_mask(ts[start * step:(k + 1) * step])
+        full_mask[start * step:((start + 1) * step)] |= mask[:step]
+    full_mask[start * step:start * step + len(mask)] |= mask
+    return full_mask
+
+
+def glitchy_data(num_channels, num_samples, seed):
+    random = np.random.RandomState(seed)
+    data = random.randn(num_channels, num_samples)
+    glitches = random.randint(0, num_samples, 5 * num_channels)
+    data[np.arange(glitches.size) % num_channels, glitches] += 50
+    return data
+
+
+def test_deglitch_mask_mad():
+    data = glitchy_data(3, 10000, 0)
+    for window_length, mask_extend in [(512, 50), (1000, 1), (2 ** 15, 10)]:
+        mask = despike.deglitch_mask_mad(data, thresh=6, mask_extend=mask_extend, window_length=window_length)
+        assert mask.shape == data.shape
+        for row in range(data.shape[0]):
+            expected = loop_deglitch_mask_mad(data[row], 6, mask_extend, window_length)
+            np.testing.assert_array_equal(mask[row], expected)
+            np.testing.assert_array_equal(despike.deglitch_mask_mad(data[row], thresh=6, mask_extend=mask_extend,
+                                                                    window_length=window_length), expected)
+
+
+def test_mask_glitches():
+    window_length = 512
+    step = window_length // 2
+    x = glitchy_data(2, 5000, 1)
+    q = 2 * x
+    mask = despike.deglitch_mask_mad(x, thresh=6, mask_extend=5, window_length=window_length)
+    assert mask.any()
+    clean_x, clean_q = despike.mask_glitches([x, q], mask=mask, window_length=window_length, seed=3)
+    # The same samples replace the glitches in both series.
+    np.testing.assert_array_equal(clean_q, 2 * clean_x)
+    np.testing.assert_array_equal(clean_x[~mask], x[~mask])
+    # Samples after the last full step are not replaced.
+    last = (x.shape[1] // step) * step
+    np.testing.assert_array_equal(clean_x[:, last:], x[:, last:])
+    for row, position in zip(*np.nonzero(mask[:, :last])):
+        start = min(position // step, last // step - 2) * step
+        window = slice(start, start + 2 * step)
+        assert clean_x[row, position] in x[row, window][~mask[row, window]]
+    repeated = despike.mask_glitches([x, q], mask=mask, window_length=window_length, seed=3)
+    np.testing.assert_array_equal(repeated[0], clean_x)
+
+
+def test_mask_glitches_transposed():
+    window_length = 512
+    x = glitchy_data(5000, 2, 1).T  # This is a Fortran-ordered view.
+    mask = despike.deglitch_mask_mad(x, thresh=6, mask_extend=5, window_length=window_length)
+    assert mask.any()
+    clean_x, = despike.mask_glitches(x, mask=mask, window_length=window_length, seed=3)
+    expected, = despike.mask_glitches(np.ascontiguousarray(x), mask=mask, window_length=window_length, seed=3)
+    np.testing.assert_array_equal(clean_x, expected)
+    assert np.any(clean_x[mask] != x[mask])
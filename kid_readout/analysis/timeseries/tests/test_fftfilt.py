@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.signal
 from kid_readout.analysis.timeseries import fftfilt
 
 def test_fftfilt_nd():
@@ -14,4 +15,31 @@ def test_fftfilt_nd():
     for k in range(16):
         oned[:,k] = fftfilt.fftfilt(b,x[:,k])
     nd = fftfilt.fftfilt_nd(b,x)
-    assert np.allclose(oned,nd)
\ No newline at end of file
+    assert np.allclose(oned,nd)
+
+
+def test_overlap_save_filter():
+    np.random.seed(123)
+    b = scipy.signal.firwin(64, 1 / 16.)
+    real = np.random.randn(5000, 3)
+    for data in [real, real + 1j * np.random.randn(5000, 3)]:
+        gold = np.array([np.convolve(b, data[:, k])[:data.shape[0]] for k in range(3)]).T
+        overlap_save_filter = fftfilt.OverlapSaveFilter(b, nfft=256)
+        assert np.allclose(gold, overlap_save_filter.filter(data))
+        assert np.allclose(gold[:, 1], overlap_save_filter.filter(data[:, 1]))
+        chunks = [overlap_save_filter.process(chunk) for chunk in np.array_split(data, [1, 100, 101, 3000])]
+        assert np.allclose(gold, np.concatenate(chunks))
+        overlap_save_filter.reset()
+        assert np.allclose(gold[:10], overlap_save_filter.process(data[:10]))
+        assert np.iscomplexobj(overlap_save_filter.filter(data)) == np.iscomplexobj(data)
+
+
+def test_fftfilt():
+    np.random.seed(123)
+    b = scipy.signal.firwin(256, 1 / 256.)
+    for length in [10, 1000, 100000]:
+        data = (np.random.randn(length) + 1j * np.random.randn(length)).astype(np.complex64)
+        result = fftfilt.fftfilt(b, data)
+        assert result.dtype == np.complex64
+        assert np.allclose(np.convolve(b, data)[:length], result, atol=1e-5)
+    assert fftfilt._cached_filter(b) is fftfilt._cached_filter(b.copy())
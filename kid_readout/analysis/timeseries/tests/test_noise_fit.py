@@ -0,0 +1,46 @@
+import numpy as np
+
+from kid_readout.analysis.timeseries import noise_fit
+
+
+def fake_spectra(num_spectra=20, seed=123):
+    np.random.seed(seed)
+    frequency = np.logspace(0, 4, 60)
+    A = 10 ** np.random.uniform(0, 2, num_spectra)
+    nw = A * 10 ** np.random.uniform(-2, -0.5, num_spectra)
+    fc = 10 ** np.random.uniform(1.5, 3.5, num_spectra)
+    S = A[:, np.newaxis] / (1 + (frequency / fc[:, np.newaxis]) ** 2) + nw[:, np.newaxis]
+    S *= 1 + 0.05 * np.random.randn(*S.shape)
+    return frequency, S, 0.05 * S, A, nw, fc
+
+
+def test_fit_single_pole_noise_batch():
+    frequency, S, errors, A, nw, fc = fake_spectra()
+    table = noise_fit.fit_single_pole_noise_batch(frequency, S, errors, max_num_masked=1)
+    assert list(table.columns) == ['fc', 'fc_err', 'A', 'A_err', 'nw', 'nw_err', 'redchi', 'num_masked']
+    for k in range(0, S.shape[0], 4):
+        model = noise_fit.SinglePoleNoiseModel(frequency, S[k], errors=errors[k])
+        row = table.iloc[k]
+        for name in ['fc', 'A', 'nw']:
+            np.testing.assert_allclose(row[name], getattr(model, name), rtol=1e-5)
+            np.testing.assert_allclose(row[name + '_err'], model.result.params[name].stderr, rtol=1e-3)
+        np.testing.assert_allclose(row['redchi'], model.result.redchi, rtol=1e-8)
+    # The fit does not depend on the scale of the spectra.
+    scaled = noise_fit.fit_single_pole_noise_batch(frequency, 1e-17 * S, 1e-17 * errors, max_num_masked=1)
+    np.testing.assert_allclose(scaled.fc, table.fc, rtol=1e-6)
+    np.testing.assert_allclose(scaled.A, 1e-17 * table.A, rtol=1e-6)
+
+
+def test_fit_single_pole_noise_batch_masking():
+    frequency, S, errors, A, nw, fc = fake_spectra()
+    # Add two narrow lines, higher than any other point, to every spectrum.
+    S[:, [20, 40]] = 10 * S.max(axis=1)[:, np.newaxis]
+    table = noise_fit.fit_single_pole_noise_batch(frequency, S, errors, max_num_masked=4)
+    assert (table.num_masked >= 2).all()
+    np.testing.assert_allclose(table.fc, fc, rtol=0.1)
+    nan_row = np.vstack((S[0], np.full(frequency.size, np.nan)))
+    table = noise_fit.fit_single_pole_noise_batch(frequency, nan_row, max_num_masked=2)
+    assert np.isfinite(table.fc[0]) and np.isnan(table.fc[1])
+    model = noise_fit.fit_single_pole_noise(frequency, S[0], errors=errors[0], max_num_masked=4)
+    assert np.sum(~model.mask) >= 2
+    np.testing.assert_allclose(model.fc, fc[0], rtol=0.1)
@@ -0,0 +1,51 @@
+import numpy as np
+
+from kid_readout.analysis.timeseries import spectral_masks
+
+
+def loop_harmonic_mask(frequency, fundamental, max_harmonics, fractional_half_width, min_bins_to_mask_per_harmonic):
+    # This is the original implementation of pulse_tube_mask, which loops over the harmonics.
+    mask = np.ones(frequency.shape, dtype='bool')
+    for harmonic in range(1, max_harmonics + 1):
+        center = fundamental * harmonic
+        low = center * (1 - fractional_half_width)
+        high = center * (1 + fractional_half_width)
+        to_mask = (frequency >= low) & (frequency <= high)
+        if to_mask.sum() < min_bins_to_mask_per_harmonic:
+            min_idx = max(np.abs(frequency - center).argmin() - min_bins_to_mask_per_harmonic // 2, 0)
+            to_mask[min_idx:min_idx + min_bins_to_mask_per_harmonic] = 1
+        mask = mask & ~to_mask
+    return mask
+
+
+def test_harmonic_mask():
+    for frequency in [np.linspace(0, 100, 1001), np.linspace(0.1, 5, 20)]:
+        for max_harmonics, fractional_half_width, min_bins in [(1, 0.1, 1), (30, 0.1, 1), (30, 0.001, 5), (5, 0, 4)]:
+            expected = loop_harmonic_mask(frequency, 1.4, max_harmonics, fractional_half_width, min_bins)
+            mask = spectral_masks.pulse_tube_mask(frequency, None, None, None, max_harmonics=max_harmonics,
+                                                  fractional_half_width=fractional_half_width,
+                                                  min_bins_to_mask_per_harmonic=min_bins)
+            np.testing.assert_array_equal(mask, expected)
+    frequency = np.linspace(0, 1000, 10001)
+    mask = spectral_masks.mains_mask(frequency)
+    assert not mask[600] and mask[650]
+    assert np.sum(~mask) == 10 * 11
+    mask[:] = False  # The cached mask is not changed.
+    assert spectral_masks.mains_mask(frequency)[650]
+    combined = spectral_masks.combine(spectral_masks.pulse_tube_mask, spectral_masks.mains_mask)
+    np.testing.assert_array_equal(combined(frequency, None, None, None),
+                                  spectral_masks.pulse_tube_mask(frequency, None, None, None) &
+                                  spectral_masks.mains_mask(frequency))
+
+
+def test_notch_filter():
+    np.random.seed(0)
+    sample_rate = 1000.
+    t = np.arange(20000) / sample_rate
+    noise = 0.01 * np.random.randn(2, t.size)
+    data = np.sin(2 * np.pi * 60 * t) + np.cos(2 * np.pi * 180 * t) + noise
+    filtered = spectral_masks.notch_filter(data, sample_rate, [60, 180, 600])
+    assert filtered.shape == data.shape
+    np.testing.assert_allclose(filtered[:, 2000:-2000], noise[:, 2000:-2000], atol=0.02)
+    complex_filtered = spectral_masks.notch_filter(data + 1j * data, sample_rate, [60, 180])
+    np.testing.assert_allclose(complex_filtered, filtered + 1j * filtered)
@@ -0,0 +1,72 @@
+import numpy as np
+from matplotlib import mlab
+
+from kid_readout.analysis.timeseries import welch
+
+
+def check_against_mlab(data, block_size=2 ** 22, **kwargs):
+    S, f = welch.csd_matrix(data, block_size=block_size, **kwargs)
+    for i in range(data.shape[0]):
+        psd, f_mlab = mlab.psd(data[i], **kwargs)
+        np.testing.assert_array_equal(f, f_mlab)
+        np.testing.assert_allclose(S[i, i], psd, rtol=1e-10, atol=1e-12 * psd.max())
+        for j in range(data.shape[0]):
+            csd, f_mlab = mlab.csd(data[i], data[j], **kwargs)
+            np.testing.assert_allclose(S[i, j], csd, rtol=1e-10, atol=1e-12 * np.abs(csd).max())
+
+
+def test_real():
+    np.random.seed(0)
+    data = np.random.randn(3, 5000)
+    data[1] += 0.5 * data[0] + np.linspace(0, 3, data.shape[1])
+    check_against_mlab(data)
+    check_against_mlab(data, NFFT=512, Fs=100., noverlap=256, window=mlab.window_none, detrend=mlab.detrend_mean)
+    check_against_mlab(data, NFFT=255, noverlap=100, detrend=mlab.detrend_linear, pad_to=300)
+    check_against_mlab(data, NFFT=256, detrend='linear', sides='twosided', scale_by_freq=False, block_size=1000)
+    check_against_mlab(data[:, :100], NFFT=256, window=np.hanning(256), detrend=lambda x: x - x[0])
+
+
+def test_complex():
+    np.random.seed(1)
+    data = np.random.randn(2, 4096) + 1j * np.random.randn(2, 4096)
+    check_against_mlab(data, NFFT=512, noverlap=256)
+    check_against_mlab(data, NFFT=333, detrend=mlab.detrend_mean, sides='onesided')
+
+
+def test_csd_pairs():
+    np.random.seed(2)
+    x = np.random.randn(4, 3000)
+    y = 0.3 * x + np.random.randn(4, 3000)
+    kwargs = dict(NFFT=256, Fs=10., noverlap=128, detrend=mlab.detrend_mean)
+    S_xx, S_yy, S_xy, f = welch.csd_pairs(x, y, block_size=5000, **kwargs)
+    for k in range(x.shape[0]):
+        S, f_matrix = welch.csd_matrix(np.vstack((x[k], y[k])), **kwargs)
+        np.testing.assert_array_equal(f, f_matrix)
+        np.testing.assert_allclose(S_xx[k], S[0, 0].real, rtol=1e-12)
+        np.testing.assert_allclose(S_yy[k], S[1, 1].real, rtol=1e-12)
+        np.testing.assert_allclose(S_xy[k], S[0, 1], rtol=1e-12)
+
+
+def test_welch_accumulator():
+    np.random.seed(3)
+    data = np.random.randn(2, 10000) + 1j * np.random.randn(2, 10000)
+    kwargs = dict(NFFT=512, Fs=3., noverlap=200, detrend=mlab.detrend_mean)
+    accumulator = welch.WelchAccumulator(block_size=3000, **kwargs)
+    assert accumulator.S is None
+    edges = [0, 100, 101, 2000, 2001, 7777, 10000]
+    for start, stop in zip(edges[:-1], edges[1:]):
+        accumulator.update(data[:, start:stop])
+        if stop < kwargs['NFFT']:
+            assert np.all(np.isnan(accumulator.S))
+        else:
+            S, f = welch.csd_matrix(data[:, :stop], **kwargs)
+            np.testing.assert_array_equal(accumulator.f, f)
+            np.testing.assert_allclose(accumulator.S, S, rtol=1e-10)
+    assert accumulator.num_samples == data.shape[1]
+    # Compare the variance to that of the spectra of the individual segments.
+    step = kwargs['NFFT'] - kwargs['noverlap']
+    segments = [welch.csd_matrix(data[:, start:start + kwargs['NFFT']], **kwargs)[0]
+                for start in range(0, data.shape[1] - kwargs['NFFT'] + 1, step)]
+    assert accumulator.num_segments == len(segments)
+    variance = np.var(segments, axis=0, ddof=1) / len(segments)
+    np.testing.assert_allclose(accumulator.S_variance, variance, rtol=1e-8)
@@ -0,0 +1,333 @@
+"""
+This module estimates all of the auto- and cross-spectral densities of several time series at once using Welch's
+method, with the same arguments and results as matplotlib.mlab.psd() and matplotlib.mlab.csd().
+
+Calling mlab.psd() for each of two time series and mlab.csd() for the pair segments, detrends, windows, and transforms
+each time series two or three times. Here, each segment of each time series is transformed once, all of the spectra
+are formed from these transforms, and real time series that need only positive frequencies use the real FFT, which
+is about twice as fast. The segments are processed in blocks so that the memory used does not grow with the length of
+the time series.
+
+Use csd_matrix() for the spectra of every pair of a few time series, and csd_pairs() for the spectra of many pairs of
+time series, such as the x and q time series of every channel of a multi-channel stream. WelchAccumulator computes the
+same spectra as csd_matrix() from data that arrive in chunks, such as streams too long to load into memory or data
+being acquired, and keeps running estimates of the spectra and their variances.
+"""
+from __future__ import division
+
+import numpy as np
+from matplotlib import mlab
+from matplotlib.mlab import cbook
+
+
+def csd_matrix(data, NFFT=256, Fs=2, detrend=mlab.detrend_none, window=mlab.window_hanning, noverlap=0, pad_to=None,
+               sides='default', scale_by_freq=None, block_size=2 ** 22):
+    """
+    Return the matrix of all auto- and cross-spectral densities of the given time series.
+
+    The arguments other than data and block_size have the same meaning and defaults as for mlab.csd(), and element
+    [i, j] of the returned matrix is equal to mlab.csd(data[i], data[j], ...)[0], so the diagonal elements are the
+    values returned by mlab.psd(), stored as complex numbers with zero imaginary part.
+
+    Parameters
+    ----------
+    data : numpy.ndarray(real or complex)
+        The time series, with shape (number of series, number of samples); a 1-D array is treated as one series.
+    NFFT : int
+        The number of samples in each segment.
+    Fs : float
+        The sample rate.
+    detrend : callable or str
+        The function applied to each segment before windowing, or one of the strings accepted by mlab.detrend().
+    window : callable or numpy.ndarray
+        A function that returns its argument multiplied by the window, or an array of window values of length NFFT.
+    noverlap : int
+        The number of samples by which adjacent segments overlap.
+    pad_to : int or None
+        The number of points in each FFT; None means NFFT.
+    sides : str
+        'onesided', 'twosided', or 'default', which means one-sided for real data and two-sided for complex data.
+    scale_by_freq : bool or None
+        If True or None, the result is a density per unit frequency; otherwise, it is scaled to preserve the power in
+        each segment.
+    block_size : int
+        The approximate maximum number of samples in the block of segments that are transformed at once.
+
+    Returns
+    -------
+    S : numpy.ndarray(complex)
+        The spectral densities, with shape (number of series, number of series, number of frequencies).
+    f : numpy.ndarray(float)
+        The frequencies.
+    """
+    data = np.atleast_2d(np.asarray(data))
+    setup = _Setup(np.iscomplexobj(data), NFFT, Fs, window, noverlap, pad_to, sides, scale_by_freq)
+    num_series = data.shape[0]
+    S = np.zeros((num_series, num_series, setup.num_frequencies), dtype=np.complex)
+    for transform in _segment_transforms(data, setup, detrend, block_size):
+        for i in range(num_series):
+            conjugate = np.conj(transform[i])
+            S[i, i] += np.sum((conjugate * transform[i]).real, axis=0)
+            for j in range(i + 1, num_series):
+                S[i, j] += np.sum(conjugate * transform[j], axis=0)
+    for i in range(num_series):
+        for j in range(i):
+            S[i, j] = np.conj(S[j, i])
+    return setup.scale(S / setup.num_segments(data.shape[1]))
+
+
+def csd_pairs(x, y, NFFT=256, Fs=2, detrend=mlab.detrend_none, window=mlab.window_hanning, noverlap=0, pad_to=None,
+              sides='default', scale_by_freq=None, block_size=2 ** 22):
+    """
+    Return the auto-spectral densities of the rows of x and of y, and the cross-spectral density of each row of x with
+    the same row of y.
+
+    This is the calculation done by csd_matrix() for each pair of rows, without the cross-spectra between different
+    rows, so the cost is linear in the number of rows; it is intended for the x and q time series of many channels.
+    The arguments have the same meaning as for csd_matrix(), so S_xy[k] is equal to mlab.csd(x[k], y[k], ...)[0].
+
+    Parameters
+    ----------
+    x : numpy.ndarray(real or complex)
+        The first time series of each pair, with shape (number of pairs, number of samples).
+    y : numpy.ndarray(real or complex)
+        The second time series of each pair, with the same shape.
+
+    Returns
+    -------
+    S_xx : numpy.ndarray(float)
+        The spectral densities of the rows of x, with shape (number of pairs, number of frequencies).
+    S_yy : numpy.ndarray(float)
+        The spectral densities of the rows of y.
+    S_xy : numpy.ndarray(complex)
+        The cross-spectral densities.
+    f : numpy.ndarray(float)
+        The frequencies.
+    """
+    x = np.atleast_2d(np.asarray(x))
+    y = np.atleast_2d(np.asarray(y))
+    if x.shape != y.shape:
+        raise ValueError("The shapes of x and y differ: {} {}".format(x.shape, y.shape))
+    data = np.concatenate((x, y), axis=0)
+    setup = _Setup(np.iscomplexobj(data), NFFT, Fs, window, noverlap, pad_to, sides, scale_by_freq)
+    num_pairs = x.shape[0]
+    S_xx = np.zeros((num_pairs, setup.num_frequencies))
+    S_yy = np.zeros((num_pairs, setup.num_frequencies))
+    S_xy = np.zeros((num_pairs, setup.num_frequencies), dtype=np.complex)
+    for transform in _segment_transforms(data, setup, detrend, block_size):
+        x_transform = transform[:num_pairs]
+        y_transform = transform[num_pairs:]
+        conjugate = np.conj(x_transform)
+        S_xx += np.sum((conjugate * x_transform).real, axis=1)
+        S_yy += np.sum((np.conj(y_transform) * y_transform).real, axis=1)
+        S_xy += np.sum(conjugate * y_transform, axis=1)
+    num_segments = setup.num_segments(data.shape[1])
+    S_xx, f = setup.scale(S_xx / num_segments)
+    S_yy, f = setup.scale(S_yy / num_segments)
+    S_xy, f = setup.scale(S_xy / num_segments)
+    return S_xx, S_yy, S_xy, f
+
+
+class WelchAccumulator(object):
+    """
+    Accumulate the matrix of auto- and cross-spectral densities of several time series that arrive in chunks.
+
+    Call update() with each chunk of data, in order. The segments are the same as those that csd_matrix() uses for the
+    concatenated data, so after the last chunk the estimate S is equal to the one that csd_matrix() returns for the
+    same arguments. The running mean and variance of the segment spectra are updated with each block of segments, so
+    the memory used depends only on NFFT, block_size, and the chunk size, and the current estimates are always
+    available. Data shorter than NFFT are not zero-padded as they are by csd_matrix(), so until NFFT samples have
+    arrived the estimates contain NaN.
+    """
+
+    def __init__(self, NFFT=256, Fs=2, detrend=mlab.detrend_none, window=mlab.window_hanning, noverlap=0, pad_to=None,
+                 sides='default', scale_by_freq=None, block_size=2 ** 22):
+        """
+        The arguments have the same meaning and defaults as for csd_matrix().
+        """
+        self.NFFT = NFFT
+        self.Fs = Fs
+        self.detrend = detrend
+        self.window = window
+        self.noverlap = noverlap
+        self.pad_to = pad_to
+        self.sides = sides
+        self.scale_by_freq = scale_by_freq
+        self.block_size = block_size
+        self.num_samples = 0
+        self.num_segments = 0
+        self._setup = None
+        self._buffer = None
+        self._mean = None
+        self._sum_of_squares = None  # The sum of the squared deviations of the segment spectra from their mean.
+
+    def update(self, data):
+        """
+        Add a chunk of data.
+
+        Parameters
+        ----------
+        data : numpy.ndarray(real or complex)
+            The next samples of the time series, with shape (number of series, number of samples); a 1-D array is
+            treated as one series.
+        """
+        data = np.atleast_2d(np.asarray(data))
+        if self._setup is None:
+            self._setup = _Setup(np.iscomplexobj(data), self.NFFT, self.Fs, self.window, self.noverlap, self.pad_to,
+                                 self.sides, self.scale_by_freq)
+            shape = (data.shape[0], data.shape[0], self._setup.num_frequencies)
+            self._buffer = data[:, :0]
+            self._mean = np.zeros(shape, dtype=np.complex)
+            self._sum_of_squares = np.zeros(shape)
+        elif data.shape[0] != self._buffer.shape[0]:
+            raise ValueError("Expected {} time series, not {}.".format(self._buffer.shape[0], data.shape[0]))
+        self.num_samples += data.shape[1]
+        buffer = np.concatenate((self._buffer, data), axis=1)
+        if buffer.shape[1] < self.NFFT:
+            self._buffer = buffer
+            return
+        step = self.NFFT - self.noverlap
+        num_segments = self._setup.num_segments(buffer.shape[1])
+        for transform in _segment_transforms(buffer[:, :(num_segments - 1) * step + self.NFFT], self._setup,
+                                             self.detrend, self.block_size):
+            products = np.conj(transform[:, None, :, :]) * transform[None, :, :, :]
+            block_count = products.shape[2]
+            block_mean = products.mean(axis=2)
+            block_sum_of_squares = np.sum(np.abs(products - block_mean[:, :, None, :]) ** 2, axis=2)
+            # Combine the block statistics with the running statistics.
+            total = self.num_segments + block_count
+            delta = block_mean - self._mean
+            self._mean += delta * block_count / total
+            self._sum_of_squares += (block_sum_of_squares +
+                                     np.abs(delta) ** 2 * self.num_segments * block_count / total)
+            self.num_segments = total
+        # Keep the samples that start the next segment.
+        self._buffer = buffer[:, num_segments * step:].copy()
+
+    @property
+    def S(self):
+        """numpy.ndarray(complex): the current estimate of the spectral density matrix, like that of csd_matrix()."""
+        return self._scaled(self._mean, 1)
+
+    @property
+    def S_variance(self):
+        """
+        numpy.ndarray(float): the current estimate of the variance of each element of S, calculated from the scatter
+        of the segment spectra; overlapping segments are correlated, so this underestimates the variance if noverlap
+        is nonzero.
+        """
+        if self.num_segments < 2:
+            return self._scaled(np.full(self._mean.shape, np.nan), 2)
+        return self._scaled(self._sum_of_squares / ((self.num_segments - 1) * self.num_segments), 2)
+
+    @property
+    def f(self):
+        """numpy.ndarray(float): the frequencies."""
+        if self._setup is None:
+            return None
+        return self._setup.scale(np.zeros(self._setup.num_frequencies))[1]
+
+    def _scaled(self, values, power):
+        if self._setup is None:
+            return None
+        if not self.num_segments:
+            values = np.full(values.shape, np.nan, dtype=values.dtype)
+        return self._setup.scale(values, power=power)[0]
+
+
+class _Setup(object):
+    """The segment and scaling parameters shared by the functions in this module."""
+
+    def __init__(self, complex_data, NFFT, Fs, window, noverlap, pad_to, sides, scale_by_freq):
+        if noverlap >= NFFT:
+            raise ValueError("noverlap must be less than NFFT.")
+        if sides is None or sides == 'default':
+            sides = 'twosided' if complex_data else 'onesided'
+        elif sides not in ('onesided', 'twosided'):
+            raise ValueError("Unknown value for sides {}: must be 'default', 'onesided', or 'twosided'.".format(sides))
+        if pad_to is None:
+            pad_to = NFFT
+        if scale_by_freq is None:
+            scale_by_freq = True
+        if sides == 'twosided':
+            self.num_frequencies = pad_to
+            self.scaling_factor = 1.
+        else:
+            self.num_frequencies = (pad_to + 1) // 2 if pad_to % 2 else pad_to // 2 + 1
+            self.scaling_factor = 2.
+        if cbook.iterable(window):
+            self.window_values = np.asarray(window)
+            if self.window_values.size != NFFT:
+                raise ValueError("The window must have length NFFT.")
+        else:
+            self.window_values = window(np.ones(NFFT))
+        self.NFFT = NFFT
+        self.Fs = Fs
+        self.noverlap = noverlap
+        self.pad_to = pad_to
+        self.sides = sides
+        self.scale_by_freq = scale_by_freq
+        self.real_fft = sides == 'onesided' and not complex_data
+
+    def num_segments(self, num_samples):
+        """Return the number of segments in the given number of samples, which are zero-padded to at least NFFT."""
+        return 1 + (max(num_samples, self.NFFT) - self.NFFT) // (self.NFFT - self.noverlap)
+
+    def scale(self, S, power=1):
+        """
+        Return the means over segments in S of the products of transforms, with frequency on the last axis, as
+        spectral densities, and f. If power is 2, S contains variances, which are scaled by the square of the factors.
+        """
+        S = np.array(S)
+        # Like mlab, scale all but the DC component and, if NFFT is even, the last component.
+        if self.NFFT % 2:
+            S[..., 1:] *= self.scaling_factor ** power
+        else:
+            S[..., 1:-1] *= self.scaling_factor ** power
+        if self.scale_by_freq:
+            S /= (self.Fs * np.sum(np.abs(self.window_values) ** 2)) ** power
+        else:
+            S /= (np.abs(self.window_values).sum() ** 2) ** power
+        f = np.fft.fftfreq(self.pad_to, 1 / self.Fs)[:self.num_frequencies]
+        if self.sides == 'twosided':
+            center = (self.pad_to - 1) // 2 + 1 if self.pad_to % 2 else self.pad_to // 2
+            f = np.concatenate((f[center:], f[:center]))
+            S = np.concatenate((S[..., center:], S[..., :center]), axis=-1)
+        elif not self.pad_to % 2:
+            f[-1] *= -1
+        return S, f
+
+
+def _segment_transforms(data, setup, detrend, block_size):
+    """
+    Yield the transforms of blocks of detrended and windowed segments of the rows of data, each with shape (number of
+    rows, number of segments in the block, number of frequencies).
+    """
+    if data.shape[1] < setup.NFFT:
+        data = np.concatenate((data, np.zeros((data.shape[0], setup.NFFT - data.shape[1]), dtype=data.dtype)), axis=1)
+    num_series = data.shape[0]
+    num_segments = setup.num_segments(data.shape[1])
+    step = setup.NFFT - setup.noverlap
+    segments = np.lib.stride_tricks.as_strided(data, shape=(num_series, num_segments, setup.NFFT),
+                                               strides=(data.strides[0], step * data.strides[1], data.strides[1]))
+    segments_per_block = max(block_size // (num_series * setup.NFFT), 1)
+    for start in range(0, num_segments, segments_per_block):
+        block = _detrend(np.array(segments[:, start:start + segments_per_block, :]), detrend) * setup.window_values
+        if setup.real_fft:
+            yield np.fft.rfft(block, n=setup.pad_to, axis=2)
+        else:
+            yield np.fft.fft(block, n=setup.pad_to, axis=2)[:, :, :setup.num_frequencies]
+
+
+def _detrend(segments, detrend):
+    """Detrend the segments along the last axis, using vectorized versions of the mlab functions where possible."""
+    if detrend is mlab.detrend_none or detrend == 'none':
+        return segments
+    elif detrend is mlab.detrend_mean or detrend in ('mean', 'constant', 'default'):
+        return segments - segments.mean(axis=-1)[..., None]
+    elif detrend is mlab.detrend_linear or detrend == 'linear':
+        x = np.arange(segments.shape[-1]) - (segments.shape[-1] - 1) / 2
+        slope = np.sum(x * segments, axis=-1) / np.sum(x ** 2)
+        return segments - segments.mean(axis=-1)[..., None] - slope[..., None] * x
+    else:
+        return mlab.detrend(segments, key=detrend, axis=segments.ndim - 1)
@@ -5,6 +5,8 @@ from __future__ import division
 import time
 from collections import OrderedDict
 import logging
+import multiprocessing
+import multiprocessing.pool
 
 import numpy as np
 import pandas as pd
@@ -13,8 +15,9 @@ from scipy import signal
 from memoized_property import memoized_property
 
 from kid_readout.measurement import core
-from kid_readout.analysis.resonator import lmfit_resonator
-from kid_readout.analysis.timeseries import binning, despike, iqnoise, periodic
+from kid_readout.analysis.resonator import lmfit_resonator, peak_finder
+from kid_readout.analysis.timeseries import (binning, decimating_fir, despike, iqnoise, periodic, spectral_masks,
+                                             welch)
 from kid_readout.roach import calculate
 
 logger = logging.getLogger(__name__)
@@ -232,6 +235,42 @@ class RoachStream(RoachMeasurement):
                               data_demodulated=self.data_demodulated, roach_state=self.roach_state,
                               state=self.state, description=self.description)
 
+    def decimate(self, factor, **kwargs):
+        """
+        Return a new instance of the same class containing the data low-pass filtered and decimated by the given factor.
+
+        The data from all channels are filtered together by a decimating_fir.MultistageDecimator, which computes only
+        the samples that are kept. The roach_state of the returned instance has its decimation_factor multiplied by the
+        given factor, so its stream_sample_rate is lower by this factor. Its epoch is shifted earlier by the group delay
+        of the filter, so that the sample times match those of the original data; the first samples include the start-up
+        transient of the filter.
+
+        Parameters
+        ----------
+        factor : int
+            The decimation factor.
+        kwargs
+            Keyword arguments passed to decimating_fir.MultistageDecimator.
+
+        Returns
+        -------
+        RoachStream
+            An instance of the same class as this one.
+        """
+        decimator = decimating_fir.MultistageDecimator(factor, **kwargs)
+        # The decimator works on arrays with shape (samples, channels).
+        samples = self.s21_raw.reshape((-1, self.s21_raw.shape[-1])).T
+        s21_raw = decimator.process(samples).T.reshape(self.s21_raw.shape[:-1] + (-1,))
+        roach_state = core.StateDict(self.roach_state)
+        roach_state['decimation_factor'] = roach_state.get('decimation_factor', 1) * decimator.factor
+        return self.__class__(tone_bin=self.tone_bin, tone_amplitude=self.tone_amplitude,
+                              tone_phase=self.tone_phase, tone_index=self.tone_index,
+                              filterbank_bin=self.filterbank_bin,
+                              epoch=self.epoch - decimator.delay / self.stream_sample_rate,
+                              sequence_start_number=np.nan,  # This is not valid for the decimated data.
+                              s21_raw=s21_raw, data_demodulated=self.data_demodulated, roach_state=roach_state,
+                              state=self.state, description=self.description)
+
 
 class RoachStream0(RoachMeasurement):
     """
@@ -493,6 +532,8 @@ class SweepArray(RoachMeasurement):
                            number=number, state=self.state, description=self.description)
         ss._io = self._io
         ss._io_node_path = self._io_node_path
+        if getattr(self, '_resonators', None) is not None and self._resonators[number] is not None:
+            ss._resonator = self._resonators[number]
         return ss
 
     def sweep(self, number):
@@ -593,6 +634,78 @@ class SweepArray(RoachMeasurement):
         return model(frequency=self.frequency[mask], s21=self.s21_point_foreground[mask],
                      errors=self.s21_point_error_foreground[mask])
 
+    @memoized_property
+    def resonators(self):
+        """list[BaseResonator]: the resonators from the last call to fit_resonators(), in channel order."""
+        self.fit_resonators()
+        return self._resonators
+
+    def fit_resonators(self, model=lmfit_resonator.LinearResonatorWithCable, params=None, workers=1, cache=None):
+        """
+        Fit the s21 data of every channel with the given resonator model and return a table of the fit results. The
+        resonators are stored in self.resonators and are used by the SingleSweeps returned by sweep(), so that
+        sweep(number).resonator does not fit again.
+
+        The per-channel data are computed once for all channels from the StreamArrays. If workers is more than 1, the
+        channels are fit in that many processes. The resonator objects cannot be pickled, so the workers return the
+        fitted parameters and fit statistics, from which each resonator is restored in this process without fitting.
+
+        Parameters
+        ----------
+        model : BaseResonator
+            The resonator model to use for the fits.
+        params : lmfit.Parameters
+            A parameters object to use for initial values and limits in every fit; if None, each fit uses the guess
+            from the model.
+        workers : int
+            The number of processes to use; if 1, all fits are done in this process.
+        cache : lmfit_resonator.ParameterCache
+            If given and params is None, start each fit from an earlier fit of the same tone stored in this cache, and
+            store the results in it. Repeated fits of the same resonators then take only a few iterations.
+
+        Returns
+        -------
+        pandas.DataFrame
+            A table with one row per channel that contains the channel number, the value and error of each parameter,
+            Q_i, Q_e, the reduced chi-squared, and whether the fit succeeded. The row for a channel that could not be
+            fit contains NaN values and success is False.
+        """
+        # These arrays have shape (number of StreamArrays, number of channels), sorted by frequency in each channel.
+        frequency = np.vstack([sa.frequency for sa in self.stream_arrays])
+        index = (frequency.argsort(axis=0), np.arange(self.num_channels))
+        frequency = frequency[index]
+        s21_point = np.vstack([sa.s21_point for sa in self.stream_arrays])[index]
+        s21_point_error = np.vstack([sa.s21_point_error for sa in self.stream_arrays])[index]
+        tone_index = self.stream_arrays[0].tone_index
+        tasks = [(model, frequency[:, number], s21_point[:, number], s21_point_error[:, number], params, cache,
+                  tone_index[number]) for number in range(self.num_channels)]
+        parallel = workers > 1 and len(tasks) > 1
+        if parallel:
+            pool = multiprocessing.Pool(workers)
+            try:
+                # Send each worker only the cache entry for its channel; the results are stored when restoring.
+                summaries = pool.map(_fit_resonator_summary,
+                                     [task[:5] + (None if cache is None else cache.select(model, task[1], task[6]),)
+                                      + task[6:] for task in tasks])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            summaries = [None] * len(tasks)
+        resonators = []
+        for number, ((model, f, s21, errors, initial, cache, key), summary) in enumerate(zip(tasks, summaries)):
+            if parallel and summary is None:  # The fit failed in the worker process, which logged the error.
+                resonators.append(None)
+                continue
+            try:
+                resonators.append(model(frequency=f, s21=s21, errors=errors, params=initial, cache=cache,
+                                        cache_key=key, summary=summary))
+            except Exception:
+                logger.exception("Resonator fit failed for channel {}".format(number))
+                resonators.append(None)
+        self._resonators = resonators
+        return _resonator_table(resonators)
+
     def to_dataframe(self, add_origin=True, one_sweep_per_row=True):
         """
 
@@ -636,6 +749,40 @@ class SweepArray(RoachMeasurement):
         return pd.concat(dataframes, ignore_index=True)
 
 
+def _fit_resonator_summary(task):
+    """
+    Fit one channel and return the result of BaseResonator.fit_summary(), or None if the fit fails. This function is
+    used by SweepArray.fit_resonators() in worker processes, so it is at module level where it can be pickled.
+    """
+    model, frequency, s21, errors, params, cache, key = task
+    try:
+        return model(frequency=frequency, s21=s21, errors=errors, params=params, cache=cache,
+                     cache_key=key).fit_summary()
+    except Exception:
+        logger.exception("Resonator fit failed at {:.6f} MHz".format(1e-6 * np.mean(frequency)))
+        return None
+
+
+def _resonator_table(resonators):
+    """Return a DataFrame with one row of fit results for each resonator in the given list, which may contain None."""
+    rows = []
+    for number, resonator in enumerate(resonators):
+        row = OrderedDict([('number', number)])
+        if resonator is None:
+            row['success'] = False
+        else:
+            for param in resonator.current_result.params.values():
+                row[param.name] = param.value
+                row['{}_error'.format(param.name)] = param.stderr
+            row['Q_i'] = resonator.Q_i
+            row['Q_e'] = resonator.Q_e
+            row['redchi'] = resonator.current_result.redchi
+            row['success'] = bool(resonator.current_result.success)
+        rows.append(row)
+    columns = OrderedDict((key, None) for row in rows for key in row)
+    return pd.DataFrame(rows, columns=list(columns))
+
+
 class SingleSweep(RoachMeasurement):
     """
     This class contains a list of SingleStreams with different frequencies.
@@ -708,7 +855,7 @@ class SingleSweep(RoachMeasurement):
         """BaseResonator: the result of the last call to fit_resonator()."""
         return self.fit_resonator()
 
-    def fit_resonator(self, model=lmfit_resonator.LinearResonatorWithCable, params=None):
+    def fit_resonator(self, model=lmfit_resonator.LinearResonatorWithCable, params=None, cache=None):
         """
         Fit the s21 data with the given resonator model and, if given, the initial Parameters.
 
@@ -718,10 +865,13 @@ class SingleSweep(RoachMeasurement):
             The resonator model to use for the fit.
         params : lmfit.Parameters
             A parameters object to use for initial values and limits in the fit.
+        cache : lmfit_resonator.ParameterCache
+            If given and params is None, start from an earlier fit of the same tone stored in this cache, and store
+            the result in it.
         """
         self._delete_memoized_property_caches()
-        self._resonator = model(frequency=self.frequency, s21=self.s21_point, errors=self.s21_point_error)
-        self._resonator.fit(params)
+        self._resonator = model(frequency=self.frequency, s21=self.s21_point, errors=self.s21_point_error,
+                                params=params, cache=cache, cache_key=self.streams[0].tone_index)
         return self._resonator
 
     def to_dataframe(self, add_origin=True):
@@ -822,6 +972,152 @@ class SweepStreamArray(RoachMeasurement):
         """
         return self[number]
 
+    def compute_spectra(self, NFFT=None, window=mlab.window_none, detrend=mlab.detrend_none, noverlap=None,
+                        binned=True, bins_per_decade=30, masking_function=None, notch_frequencies=None,
+                        notch_quality_factor=30., deglitch=True, threshold=8, window_in_seconds=1,
+                        mask_extend_samples=50, seed=0, channels_per_block=16, workers=1, threads=False, **psd_kwds):
+        """
+        Calculate the spectral densities of x and q for all channels and return them in one table.
+
+        The results for each channel are the same as those that sweep_stream(number).set_S() calculates with the same
+        arguments, after sweep_stream(number).deglitch() with the same deglitching arguments, except that the random
+        samples that replace glitches differ. The glitches of all channels in a block are found and replaced at once.
+        The resonators come from
+        self.sweep_array.resonators, and if the sweep has not been fit yet then all channels are fit first using
+        SweepArray.fit_resonators(). The channels are processed in blocks: the inversion of the stream data is
+        vectorized over each block for resonator models whose invert() is a linear fractional function of s21, and
+        the segment FFTs of every channel in the block are done together by welch.csd_pairs(). If workers is more
+        than 1, the blocks are deglitched and transformed in a pool of that many processes, or threads if threads is
+        True.
+
+        Parameters
+        ----------
+        NFFT : int or None
+            The number of samples to use for each FFT chunk; if None, use the default of set_S().
+        window : callable
+            A function that takes a time series as argument and returns a windowed time series.
+        detrend : callable
+            A function that takes a time series as argument and returns a detrended time series.
+        noverlap : int or None
+            The number of samples to overlap in each chunk; if None, a value equal to half the NFFT value is used.
+        binned : bool
+            If True, the result is binned using bin sizes that increase with frequency.
+        bins_per_decade : int
+            If binned is True, this is the number of frequency bins per decade that will be used.
+        masking_function : callable
+            A function that takes the frequency and the spectral densities of all channels, with shape
+            (channels, frequencies), and returns one boolean mask for all channels, with the shape of the frequency
+            array, that is False for the points to remove; see set_S().
+        notch_frequencies : iterable(float) or None
+            If not None, remove lines at these frequencies, in Hz, from x and q after deglitching; see set_S().
+        notch_quality_factor : float
+            The quality factor of the notch filters.
+        deglitch : bool
+            If True, deglitch x and q as SingleSweepStream.deglitch() does before calculating the spectra.
+        threshold : float
+            The deglitching threshold.
+        window_in_seconds : float
+            The deglitching window length.
+        mask_extend_samples : int
+            The number of samples by which the deglitching mask is extended on each side of a glitch.
+        seed : None, int, or numpy.random.RandomState
+            The seed used to choose the samples that replace glitches in each block; see despike.mask_glitches().
+        channels_per_block : int
+            The number of channels processed together.
+        workers : int
+            The number of processes or threads to use; if 1, all blocks are processed in this process.
+        threads : bool
+            If True and workers is more than 1, use a pool of threads instead of processes.
+        psd_kwds : dict
+            Additional keywords to pass to welch.csd_pairs, which accepts the same keywords as mlab.psd and mlab.csd.
+
+        Returns
+        -------
+        pandas.DataFrame
+            A table with one row for each channel number and spectral frequency that contains the channel number,
+            the frequency, the number of spectral samples in the bin, and the values and variances of S_xx, S_qq, and
+            S_xq. Use table.pivot('number', 'frequency', 'S_xx') for an array with shape (channels, frequencies).
+            The rows for a channel with no resonator contain NaN values.
+        """
+        num_samples = self.stream_array.s21_raw.shape[1]
+        if NFFT is None:
+            NFFT = int(2**(np.floor(np.log2(num_samples)) - 3))
+        if noverlap is None:
+            noverlap = NFFT // 2
+        if getattr(self.sweep_array, '_resonators', None) is None:
+            self.sweep_array.fit_resonators(workers=workers)
+        resonators = self.sweep_array.resonators
+        sample_rate = self.stream_array.stream_sample_rate
+        if deglitch:
+            deglitch_args = (threshold, int(2 ** np.ceil(np.log2(window_in_seconds * sample_rate))),
+                             mask_extend_samples, seed)
+        else:
+            deglitch_args = None
+        if notch_frequencies is not None:
+            notch_args = (sample_rate, notch_frequencies, notch_quality_factor)
+        else:
+            notch_args = None
+        psd_kwds.update(NFFT=NFFT, Fs=sample_rate, window=window, detrend=detrend, noverlap=noverlap)
+        frequency = self.stream_array.frequency
+        s21_raw = self.stream_array.s21_raw
+
+        def tasks():
+            for start in range(0, self.num_channels, channels_per_block):
+                numbers = range(start, min(start + channels_per_block, self.num_channels))
+                x_raw, q_raw = _invert_channels([resonators[number] for number in numbers], frequency[numbers],
+                                                s21_raw[numbers])
+                yield x_raw, q_raw, deglitch_args, notch_args, psd_kwds
+
+        if workers > 1 and self.num_channels > channels_per_block:
+            if threads:
+                pool = multiprocessing.pool.ThreadPool(workers)
+            else:
+                pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.imap(_sweep_stream_spectra, tasks(), chunksize=1)
+                results = list(results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_sweep_stream_spectra(task) for task in tasks()]
+        f = results[0][3]
+        S_xx, S_qq, S_xq = [np.concatenate([result[k] for result in results]) for k in range(3)]
+        if masking_function is None:
+            mask = None
+        else:
+            mask = np.asarray(masking_function(f, S_xx, S_qq, S_xq), dtype='bool')[1:-1]
+        # Drop the DC and Nyquist bins as set_S() does, and estimate the variances in the same way.
+        f = f[1:-1]
+        S_xx = S_xx[:, 1:-1]
+        S_qq = S_qq[:, 1:-1]
+        S_xq = S_xq[:, 1:-1]
+        ndof = 2 * num_samples // NFFT
+        if binned:
+            edges, counts, f, d_and_v = binning.log_bin_with_variance(f, bins_per_decade, (S_xx, S_xx**2 / ndof),
+                                                                      (S_qq, S_qq**2 / ndof),
+                                                                      (S_xq, S_xq**2 / ndof), mask=mask)
+            (S_xx, V_xx), (S_qq, V_qq), (S_xq, V_xq) = d_and_v
+        else:
+            if mask is not None:
+                f = f[mask]
+                S_xx = S_xx[:, mask]
+                S_qq = S_qq[:, mask]
+                S_xq = S_xq[:, mask]
+            counts = np.ones(f.size, dtype=int)
+            V_xx = S_xx**2 / ndof
+            V_qq = S_qq**2 / ndof
+            V_xq = S_xq**2 / ndof
+        return pd.DataFrame(OrderedDict([('number', np.repeat(np.arange(self.num_channels), f.size)),
+                                         ('frequency', np.tile(f, self.num_channels)),
+                                         ('counts', np.tile(counts, self.num_channels)),
+                                         ('S_xx', S_xx.ravel()),
+                                         ('S_qq', S_qq.ravel()),
+                                         ('S_xq', S_xq.ravel()),
+                                         ('S_xx_variance', V_xx.ravel()),
+                                         ('S_qq_variance', V_qq.ravel()),
+                                         ('S_xq_variance', V_xq.ravel())]))
+
     def to_dataframe(self):
         dataframes = []
         for number in range(self.num_channels):
@@ -829,6 +1125,80 @@ class SweepStreamArray(RoachMeasurement):
         return pd.concat(dataframes, ignore_index=True)
 
 
+def _inversion_coefficients(resonator):
+    """
+    Return complex numbers (A, B) such that resonator.invert(s21_normalized) is equal to (w.imag / 2, w.real), where
+    w = A / (1 - s21_normalized) + B, or None if the inversion of the resonator model does not have this form. The
+    linear resonator models do, so many channels can be inverted at once using arrays of these coefficients.
+    """
+    probes = np.array([0, -1, 0.5j])
+    x, q = resonator.invert(probes)
+    w = np.asarray(q) + 2j * np.asarray(x)
+    if w.shape != probes.shape:
+        return None
+    A = 2 * (w[0] - w[1])
+    B = w[0] - A
+    if not np.isclose(w[2], A / (1 - probes[2]) + B, rtol=1e-9, atol=0):
+        return None
+    return A, B
+
+
+def _invert_channels(resonators, frequency, s21_raw):
+    """
+    Return the arrays x and q, with shape (channels, samples), calculated by inverting the given resonators, which
+    may contain None, at the given stream frequencies.
+    """
+    x = np.full(s21_raw.shape, np.nan)
+    q = np.full(s21_raw.shape, np.nan)
+    vectorized = []
+    coefficients = []
+    for row, (resonator, f) in enumerate(zip(resonators, frequency)):
+        if resonator is None:
+            continue
+        a_and_b = _inversion_coefficients(resonator)
+        if a_and_b is None:
+            x[row], q[row] = resonator.invert(resonator.remove_background(f, s21_raw[row]))
+        else:
+            vectorized.append(row)
+            coefficients.append(a_and_b + (resonator.remove_background(f, 1),))
+    if vectorized:
+        A, B, normalization = [np.array(c)[:, None] for c in zip(*coefficients)]
+        w = A / (1 - normalization * s21_raw[vectorized]) + B
+        x[vectorized] = w.imag / 2
+        q[vectorized] = w.real
+    return x, q
+
+
+def _sweep_stream_spectra(task):
+    """
+    Deglitch and notch filter the x and q arrays of a block of channels, if requested, and return S_xx, S_qq, S_xq, and
+    f for every channel. This function is used by SweepStreamArray.compute_spectra() in worker processes, so it is at
+    module level where it can be pickled.
+    """
+    x, q, deglitch_args, notch_args, psd_kwds = task
+    if deglitch_args is not None:
+        threshold, window_samples, mask_extend_samples, seed = deglitch_args
+        mask = despike.deglitch_mask_mad(x, thresh=threshold, window_length=window_samples,
+                                         mask_extend=mask_extend_samples)
+        try:
+            x, q = despike.mask_glitches([x, q], mask=mask, window_length=window_samples, seed=seed)
+        except ValueError:
+            # Like SingleSweepStream.deglitch(), keep the raw data of a channel if its glitches cannot be replaced.
+            x = x.copy()
+            q = q.copy()
+            for row in range(x.shape[0]):
+                try:
+                    x[row], q[row] = despike.mask_glitches([x[row], q[row]], mask=mask[row],
+                                                           window_length=window_samples, seed=seed)
+                except ValueError:
+                    pass
+    if notch_args is not None:
+        sample_rate, notch_frequencies, notch_quality_factor = notch_args
+        x = spectral_masks.notch_filter(x, sample_rate, notch_frequencies, quality_factor=notch_quality_factor)
+        q = spectral_masks.notch_filter(q, sample_rate, notch_frequencies, quality_factor=notch_quality_factor)
+    return welch.csd_pairs(x, q, **psd_kwds)
+
+
 class SingleSweepStream(RoachMeasurement):
 
     _version = 0
@@ -884,7 +1254,12 @@ class SingleSweepStream(RoachMeasurement):
             self.deglitch()
         return self._number_of_masked_samples
 
-    def deglitch(self, threshold=8, window_in_seconds=1, mask_extend_samples=50):
+    def deglitch(self, threshold=8, window_in_seconds=1, mask_extend_samples=50, seed=0):
+        """
+        Find glitches in x_raw and replace the glitch samples of x, q, and the normalized stream s21 with samples
+        chosen at random from nearby; see despike.deglitch_mask_mad() and despike.mask_glitches(). The replacement
+        samples are chosen using the given seed, so the result is reproducible.
+        """
         window_samples = int(2 ** np.ceil(np.log2(window_in_seconds * self.stream.stream_sample_rate)))
         logger.debug("deglitching with threshold %f, window %.f seconds, %d samples, extending mask by %d samples"
                      % (threshold, window_in_seconds,window_samples, mask_extend_samples))
@@ -895,7 +1270,8 @@ class SingleSweepStream(RoachMeasurement):
             self._x, self._q, self._stream_s21_normalized_deglitched = despike.mask_glitches([self.x_raw, self.q_raw,
                                                                                               self.stream_s21_normalized],
                                                                                              mask=self._glitch_mask,
-                                                                                             window_length=window_samples)
+                                                                                             window_length=window_samples,
+                                                                                             seed=seed)
         except:
             self._glitch_mask = np.zeros(self.x_raw.shape, dtype='bool')
             self._number_of_masked_samples = self._glitch_mask.sum()
@@ -1143,7 +1519,8 @@ class SingleSweepStream(RoachMeasurement):
         return self.S_qq_variance / 16
 
     def set_S(self, NFFT=None, window=mlab.window_none, detrend=mlab.detrend_none, noverlap=None, binned=True,
-              bins_per_decade=30, masking_function=None, **psd_kwds):
+              bins_per_decade=30, masking_function=None, notch_frequencies=None, notch_quality_factor=30.,
+              **psd_kwds):
         """
         Calculate the spectral density of self.x and self.q and set the related properties.
 
@@ -1163,10 +1540,16 @@ class SingleSweepStream(RoachMeasurement):
         bins_per_decade : int
             If binned is True, this is the number of frequency bins per decade that will be used.
         masking_function : callable
-            A function that takes the frequency and all spectral densities as inputs and produces a boolean mask used
-            to remove points from them.
+            A function that takes the frequency and all spectral densities as inputs and produces a boolean mask that
+            is False for the points to remove from them, such as the functions in spectral_masks. If binned is True,
+            the masked points are excluded from the bins and their counts, and the bins are the same as without a mask.
+        notch_frequencies : iterable(float) or None
+            If not None, remove lines at these frequencies, in Hz, from x and q before calculating the spectra; see
+            spectral_masks.notch_filter().
+        notch_quality_factor : float
+            The quality factor of the notch filters.
         psd_kwds : dict
-            Additional keywords to pass to mlab.psd and mlab.csd.
+            Additional keywords to pass to welch.csd_matrix, which accepts the same keywords as mlab.psd and mlab.csd.
 
         Returns
         -------
@@ -1176,20 +1559,23 @@ class SingleSweepStream(RoachMeasurement):
             NFFT = int(2**(np.floor(np.log2(self.stream.s21_raw.size)) - 3))
         if noverlap is None:
             noverlap = NFFT // 2
-        S_qq, f = mlab.psd(self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        S_xx, f = mlab.psd(self.x, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        S_xq, f = mlab.csd(self.x, self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        if masking_function is not None:
-            mask = masking_function(f, S_xx, S_qq, S_xq)
-            f = f[mask]
-            S_qq = S_qq[mask]
-            S_xx = S_xx[mask]
-            S_xq = S_xq[mask]
+        x_and_q = np.vstack((self.x, self.q))
+        if notch_frequencies is not None:
+            x_and_q = spectral_masks.notch_filter(x_and_q, self.stream.stream_sample_rate, notch_frequencies,
+                                                  quality_factor=notch_quality_factor)
+        # All three spectra come from one set of segment FFTs.
+        S, f = welch.csd_matrix(x_and_q, Fs=self.stream.stream_sample_rate, NFFT=NFFT,
+                                window=window, detrend=detrend, noverlap=noverlap, **psd_kwds)
+        S_xx = S[0, 0].real
+        S_qq = S[1, 1].real
+        S_xq = S[0, 1]
+        if masking_function is None:
+            mask = None
+        else:
+            mask = np.asarray(masking_function(f, S_xx, S_qq, S_xq), dtype='bool')
             self._S_mask = mask
             logger.debug("Masked %d frequencies from raw power spectra" % (~mask).sum())
+            mask = mask[1:-1]
         # Drop the DC and Nyquist bins since they're not helpful and make plots look messy.
         f = f[1:-1]
         S_xx = S_xx[1:-1]
@@ -1204,9 +1590,14 @@ class SingleSweepStream(RoachMeasurement):
             edges, counts, f_mean, d_and_v = binning.log_bin_with_variance(f, bins_per_decade,
                                                                            (S_xx, S_xx**2 / ndof),
                                                                            (S_qq, S_qq**2 / ndof),
-                                                                           (S_xq, S_xq**2 / ndof))
+                                                                           (S_xq, S_xq**2 / ndof), mask=mask)
             (S_xx, V_xx), (S_qq, V_qq), (S_xq, V_xq) = d_and_v
         else:
+            if mask is not None:
+                f = f[mask]
+                S_xx = S_xx[mask]
+                S_qq = S_qq[mask]
+                S_xq = S_xq[mask]
             edges = None
             counts = np.ones(f.size, dtype=int)
             f_mean = f
@@ -1223,6 +1614,50 @@ class SingleSweepStream(RoachMeasurement):
         self._S_qq_variance = V_qq
         self._S_xq_variance = V_xq
 
+    def accumulate_S(self, chunk_size=2 ** 20, NFFT=None, window=mlab.window_none, detrend=mlab.detrend_none,
+                     noverlap=None, **psd_kwds):
+        """
+        Calculate the spectral densities of x_raw and q_raw by reading the stream in chunks and return the
+        welch.WelchAccumulator that contains them.
+
+        Only one chunk of the stream data is in memory at a time, so this works for streams that are too long to load,
+        as long as the IO backend reads the s21_raw array lazily. The stream data are inverted one chunk at a time and
+        are not deglitched. The spectral density matrix of (x_raw, q_raw) is in the S attribute of the returned
+        accumulator, with element [0, 0] equal to S_xx, [1, 1] equal to S_qq, and [0, 1] equal to S_xq, before binning,
+        and its variance is in S_variance.
+
+        Parameters
+        ----------
+        chunk_size : int
+            The number of samples to read at once.
+        NFFT : int or None
+            The number of samples to use for each FFT chunk; if None, use the default of set_S().
+        window  : callable
+            A function that takes a time series as argument and returns a windowed time series.
+        detrend : callable
+            A function that takes a time series as argument and returns a detrended time series.
+        noverlap : int or None
+            The number of samples to overlap in each chunk; if None, a value equal to half the NFFT value is used.
+        psd_kwds : dict
+            Additional keywords to pass to welch.WelchAccumulator, which accepts the same keywords as mlab.csd.
+
+        Returns
+        -------
+        welch.WelchAccumulator
+        """
+        s21_raw = self.stream.s21_raw
+        if NFFT is None:
+            NFFT = int(2**(np.floor(np.log2(s21_raw.shape[0])) - 3))
+        if noverlap is None:
+            noverlap = NFFT // 2
+        accumulator = welch.WelchAccumulator(NFFT=NFFT, Fs=self.stream.stream_sample_rate, window=window,
+                                             detrend=detrend, noverlap=noverlap, **psd_kwds)
+        for start in range(0, s21_raw.shape[0], chunk_size):
+            x, q = self.resonator.invert(self.resonator.remove_background(self.stream.frequency,
+                                                                          s21_raw[start:start + chunk_size]))
+            accumulator.update(np.vstack((x, q)))
+        return accumulator
+
     @property
     def pca_S_frequency(self):
         if not hasattr(self, '_pca_frequency'):
@@ -1439,9 +1874,17 @@ class Scan(RoachMeasurement):
     """
     This class contains a MeasurementList of SweepArrays, and allows them to be addressed as a single scan across the
     entire range of frequencies. It can handle overlap by averaging.
+
+    The merged data are computed once and cached: points from all SweepArrays are sorted by frequency, and points with
+    frequencies that agree within frequency_tolerance are replaced by their average weighted by the inverse variance
+    from s21_point_error. SweepArrays added with append(), or to sweep_arrays directly, are merged into the cached data
+    without merging the earlier SweepArrays again.
     """
     _version = 0
 
+    # Points from different SweepArrays with frequencies that differ by at most this many Hz are averaged.
+    frequency_tolerance = 1e-3
+
     def __init__(self, sweep_arrays, state=None, description=''):
         """
         Parameters
@@ -1455,43 +1898,194 @@ class Scan(RoachMeasurement):
         self.sweep_arrays = sweep_arrays
         super(Scan, self).__init__(state=state, description=description)
 
+    def append(self, sweep_array):
+        """
+        Add a SweepArray to this scan, for example when each LO step finishes, and merge it into the cached data. This
+        works when sweep_arrays is an IOList that writes the SweepArray to disk without keeping it in memory.
+        """
+        self.sweep_arrays.append(sweep_array)
+        for name, merge in self._merges.items():
+            if merge.count == len(self.sweep_arrays) - 1:
+                merge.add(*self._merge_data(name, sweep_array))
+                merge.count += 1
+
     @property
     def frequency(self):
-        return np.concatenate([sa.frequency for sa in self.sweep_arrays])
+        """numpy.ndarray[float]: The frequencies of the merged data points in ascending order."""
+        return self._merged('point').frequency
 
     @property
     def s21_point(self):
-        return np.concatenate([sa.s21_point for sa in self.sweep_arrays])
+        """numpy.ndarray[complex]: The merged s21_point values, in ascending frequency order."""
+        return self._merged('point').s21
+
+    @property
+    def s21_point_error(self):
+        """numpy.ndarray[complex]: The errors of the merged s21_point values, in ascending frequency order."""
+        return self._merged('point').s21_error
 
     @property
     def s21_point_foreground(self):
-        return np.concatenate([sa.s21_point_foreground for sa in self.sweep_arrays])
+        """numpy.ndarray[complex]: The merged s21_point_foreground values, in ascending frequency order."""
+        return self._merged('foreground').s21
 
-    # ToDo: test and finish
-    def stitch(self, kernel=None):
-        n = self.sweep_arrays[0].frequency.size
-        duplicates = np.where(self.sweep_arrays[0].frequency == self.sweep_arrays[1].frequency[0])[0]
-        if duplicates.size == 0:
-            overlap = 0
+    # Private methods.
+
+    @property
+    def _merges(self):
+        if not hasattr(self, '_merge_cache'):
+            self._merge_cache = {}
+        return self._merge_cache
+
+    def _merged(self, name):
+        """Return the _WeightedMerge with the given name, after merging any SweepArrays that it does not contain."""
+        merge = self._merges.setdefault(name, _WeightedMerge(tolerance=self.frequency_tolerance))
+        for sweep_array in self.sweep_arrays[merge.count:]:
+            merge.add(*self._merge_data(name, sweep_array))
+            merge.count += 1
+        return merge
+
+    @staticmethod
+    def _merge_data(name, sweep_array):
+        if name == 'point':
+            return sweep_array.frequency, sweep_array.s21_point, sweep_array.s21_point_error
         else:
-            overlap = self.sweep_arrays[0].frequency.size - int(duplicates)  # will fail if more than 1 duplicate
-        left_weight = np.linspace(1, 0, overlap)
-        right_weight = np.linspace(0, 1, overlap)
-        frequencies = [self.sweep_arrays[0].frequency[:overlap]]
-        amplitudes = [np.abs(self.sweep_arrays[0].s21_point[:overlap])]
-        for left, right in zip(self.sweep_arrays[:-1], self.sweep_arrays[1:]):
-            frequencies.append(left.frequency[overlap:])
-            amplitudes.append(left_weight * np.abs(left.s21_point[overlap:]) +
-                              right_weight * np.abs(right.s21_point[:overlap]))
-        frequencies.append(self.sweep_arrays[-1].frequency[overlap:])
-        amplitudes.append(np.abs(self.sweep_arrays[-1].s21_point[overlap:]))
-        frequency = np.concatenate(frequencies)
-        amplitude = np.concatenate(amplitudes)
+            return sweep_array.frequency, sweep_array.s21_point_foreground, sweep_array.s21_point_error_foreground
+
+    def _delete_memoized_property_caches(self):
+        self._merge_cache = {}
+        super(Scan, self)._delete_memoized_property_caches()
+
+    def find_peaks(self, expected_Q=30000, threshold=5, **kwargs):
+        """
+        Return a list of peak_finder.PeakCandidates for the resonances in this scan, found in a single pass with a
+        peak_finder.StreamingPeakFinder that processes the SweepArrays one at a time in order of frequency. Points with
+        frequencies that are not above those already processed are skipped, so overlapping data are used once; the
+        index of each candidate counts only the points that are used.
+
+        Parameters
+        ----------
+        expected_Q : float
+            The expected resonator quality factor, which sets the linewidth at the center of the scan.
+        threshold : float
+            The minimum signal-to-noise ratio of a candidate.
+        kwargs
+            Other keyword arguments passed to StreamingPeakFinder.
+        """
+        sweep_arrays = sorted(self.sweep_arrays, key=lambda sa: sa.frequency.min())
+        center = (sweep_arrays[0].frequency.min() + sweep_arrays[-1].frequency.max()) / 2
+        finder = peak_finder.StreamingPeakFinder(linewidth=center / expected_Q,
+                                                 frequency_step=np.median(np.diff(sweep_arrays[0].frequency)),
+                                                 threshold=threshold, **kwargs)
+        candidates = []
+        last = -np.inf
+        for sa in sweep_arrays:
+            mask = sa.frequency > last
+            candidates.extend(finder.update(sa.frequency[mask], sa.s21_point[mask]))
+            last = max(last, sa.frequency.max())
+        candidates.extend(finder.finish())
+        return candidates
+
+    def stitch(self, kernel=None):
+        """
+        Return the merged frequencies, the magnitude of the merged s21_point, and this magnitude smoothed by convolution
+        with the given kernel.
+
+        Parameters
+        ----------
+        kernel : numpy.ndarray(float) or None
+            The smoothing kernel; None means use a Gaussian with a length of one tenth of the number of points in the
+            first SweepArray.
+
+        Returns
+        -------
+        tuple(numpy.ndarray)
+            The frequency, amplitude, and smoothed amplitude arrays.
+        """
+        frequency = self.frequency
+        amplitude = np.abs(self.s21_point)
         if kernel is None:
-            width = int(n / 10)
-            kernel = np.exp(-np.linspace(-4, 4, width) ** 2)
+            kernel = np.exp(-np.linspace(-4, 4, int(self.sweep_arrays[0].frequency.size / 10)) ** 2)
             kernel /= kernel.sum()
+        width = kernel.size
         smoothed = np.convolve(kernel, amplitude, mode='same')
         smoothed[:width] = smoothed[width + 1]
         smoothed[-width:] = smoothed[-(width + 1)]
         return frequency, amplitude, smoothed
+
+
+class _WeightedMerge(object):
+    """
+    Accumulate complex data at increasing frequencies from several sources, averaging the points from different sources
+    with frequencies within the given tolerance. The average of each of the real and imaginary parts is weighted by the
+    inverse variance from the corresponding part of the errors; points with errors that are zero or not finite are
+    given the median weight of the other points from the same source, or weight 1 if there are none, and points with
+    non-finite data are ignored.
+    """
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.count = 0  # The number of sources added, which is used by Scan.
+        self.frequency = np.empty(0)
+        self._weight = np.empty(0, dtype=np.complex)  # The sums of the real and imaginary weights.
+        self._weighted = np.empty(0, dtype=np.complex)  # The sums of the weighted real and imaginary parts.
+        self._s21 = None
+
+    @property
+    def s21(self):
+        if self._s21 is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._s21 = (self._weighted.real / self._weight.real + 1j * self._weighted.imag / self._weight.imag)
+        return self._s21
+
+    @property
+    def s21_error(self):
+        with np.errstate(divide='ignore'):
+            return 1 / np.sqrt(self._weight.real) + 1j / np.sqrt(self._weight.imag)
+
+    def add(self, frequency, s21, s21_error):
+        """Merge the given data, which need not be sorted."""
+        order = np.argsort(frequency, kind='mergesort')
+        frequency = np.asarray(frequency, dtype=np.float)[order]
+        s21 = np.asarray(s21)[order]
+        s21_error = np.asarray(s21_error)[order]
+        weight = self._weights(s21_error.real) + 1j * self._weights(s21_error.imag)
+        weight = np.where(np.isfinite(s21.real), weight.real, 0) + 1j * np.where(np.isfinite(s21.imag), weight.imag, 0)
+        weighted = (weight.real * np.where(np.isfinite(s21.real), s21.real, 0) +
+                    1j * weight.imag * np.where(np.isfinite(s21.imag), s21.imag, 0))
+        if not frequency.size:
+            return
+        # Combine the points from this source that are within the tolerance of the previous point.
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(frequency) > self.tolerance) + 1))
+        frequency = frequency[starts]
+        weight = np.add.reduceat(weight, starts)
+        weighted = np.add.reduceat(weighted, starts)
+        # Find the nearest existing point to each new point.
+        index = np.searchsorted(self.frequency, frequency)
+        left = np.clip(index - 1, 0, max(self.frequency.size - 1, 0))
+        right = np.clip(index, 0, max(self.frequency.size - 1, 0))
+        if self.frequency.size:
+            nearest = np.where(np.abs(self.frequency[left] - frequency) <= np.abs(self.frequency[right] - frequency),
+                               left, right)
+            matched = np.abs(self.frequency[nearest] - frequency) <= self.tolerance
+        else:
+            nearest = index
+            matched = np.zeros(frequency.size, dtype=np.bool)
+        np.add.at(self._weight, nearest[matched], weight[matched])
+        np.add.at(self._weighted, nearest[matched], weighted[matched])
+        new = ~matched
+        self.frequency = np.insert(self.frequency, index[new], frequency[new])
+        self._weight = np.insert(self._weight, index[new], weight[new])
+        self._weighted = np.insert(self._weighted, index[new], weighted[new])
+        self._s21 = None
+
+    @staticmethod
+    def _weights(error):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = 1 / error ** 2
+        valid = np.isfinite(weight) & (weight > 0)
+        if np.any(valid):
+            weight[~valid] = np.median(weight[valid])
+        else:
+            weight[:] = 1
+        return weight
@@ -94,6 +94,7 @@ _versioned = {'Measurement': {0: 'kid_readout.measurement.core.Measurement'},
 # This dict includes the IO implementations, which have no version numbers, as well as any classes that have no version
 # information. For these, it should map fully-qualified class name to fully-qualified class name.
 _unversioned = {'Dictionary': 'kid_readout.measurement.io.memory.Dictionary',
+                'HDF5File': 'kid_readout.measurement.io.hdf5.HDF5File',
                 'NCFile': 'kid_readout.measurement.io.nc.NCFile',
                 'NumpyDirectory': 'kid_readout.measurement.io.npy.NumpyDirectory',
                 # All of the pre-versioned data formats are identical to version 0 formats.
@@ -9,6 +9,7 @@ import keyword
 import importlib
 from numbers import Number
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
@@ -18,6 +19,12 @@ from kid_readout.measurement import classes
 CLASS_NAME = '_class'  # This is the string used by IO objects to save class names.
 VERSION = '_version'  # This is the string used by IO objects to save class versions.
 METADATA = '_metadata'  # This is the string used by IO objects to save metadata dictionaries.
+# In batch mode, a dictionary identical to one already written is saved as this prefix followed by the full node path
+# of the original, e.g. '_reference:/SweepArray0/stream_arrays/0/roach_state'.
+REFERENCE = '_reference:'
+# A node that contains references stores their keys, separated by spaces, under this name; only these values are
+# resolved on read, so a string that happens to start with the prefix is read unchanged.
+REFERENCES = '_references'
 
 # TODO: decide which names really need to be reserved, and clean this up after add_legacy_origin is refactored.
 # These names cannot be used for attributes because they are used as part of the public DataFrame interface.
@@ -587,6 +594,10 @@ class IO(object):
     # Subclasses can define a conventional extension for files or directories they create.
     EXTENSION = ''
 
+    # Subclasses whose read methods can safely be called concurrently from multiple threads should set this to True so
+    # that read() can use a thread pool.
+    THREAD_SAFE = False
+
     def __init__(self, root_path, metadata=None):
         """
         Return a new IO object that will read to or write from the given root directory or file. If the root does not
@@ -658,17 +669,24 @@ class IO(object):
         """
         return node.class_name() + str(len(self.node_names()))
 
-    def write(self, node, node_path=None):
+    def write(self, node, node_path=None, batch=False):
         """
         Write the node to disk at the given node path. If no node path is specified, write at the root level using the
         name given by self.default_name(). If a node path is specified, all but the final node must already exist.
 
+        All non-array values for each node are written using a single call to write_others(). If `batch` is True, each
+        dictionary that is identical to one already written in the same call, such as the roach_state of every
+        StreamArray in a SweepArray, is stored only once; later copies are saved as references that are resolved on
+        read. Older versions of this code cannot resolve these references, so this is not the default.
+
         Parameters
         ----------
         node : Node
             The instance to write to disk.
         node_path : str
              The node path to the node that will contain this object.
+        batch : bool
+            If True, deduplicate identical dictionaries.
         """
         if node_path is None:
             node_path = self.default_name(node)
@@ -679,16 +697,24 @@ class IO(object):
             absolute_node_path = node_path
         else:
             absolute_node_path = NODE_PATH_SEPARATOR + node_path
-        self._write_node(node, absolute_node_path)
+        if batch:
+            self._write_node(node, absolute_node_path, references={})
+        else:
+            self._write_node(node, absolute_node_path)
         logger.info("Wrote {} to node path {}".format(node.__class__.__name__, absolute_node_path))
 
-    def read(self, node_path, translate=None, force=False):
+    def read(self, node_path, translate=None, force=False, workers=None):
         """
         Read a measurement from disk and return it.
 
         The `force` keyword is intended for inspecting measurements for which the data on disk does not match the class
         structure; see _instantiate().
 
+        If `workers` is greater than 1 and this class is thread-safe, the contents of each MeasurementList and the arrays
+        of each node outside those lists are read concurrently using a pool of that many threads. This helps when
+        reading is limited by file system latency, as it is for large trees on network storage. Otherwise, the nodes
+        are read serially.
+
         Parameters
         ----------
         node_path : str
@@ -697,6 +723,8 @@ class IO(object):
             A dictionary with entries 'original_class': 'new_class'; class names must be fully-qualified.
         force : bool
             If True, attempt to create the classes specified on disk even if the variables do not match.
+        workers : int or None
+            The number of threads to use for reading; None or 1 means read serially.
 
         Returns
         -------
@@ -712,7 +740,17 @@ class IO(object):
             absolute_node_path = node_path
         if translate is None:
             translate = {}
-        return self._read_node(node_path=absolute_node_path, translate=translate, force=force)
+        if workers is None or workers <= 1:
+            return self._read_node(node_path=absolute_node_path, translate=translate, force=force)
+        elif not self.THREAD_SAFE:
+            logger.debug("{} is not thread-safe, so reading serially.".format(self.__class__.__name__))
+            return self._read_node(node_path=absolute_node_path, translate=translate, force=force)
+        pool = ThreadPool(workers)
+        try:
+            return self._read_node(node_path=absolute_node_path, translate=translate, force=force, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
 
     # The remaining public methods should be implemented by subclasses.
     # TODO: update comments, especially with exceptions raised and handling of private variables.
@@ -735,6 +773,15 @@ class IO(object):
         """
         pass
 
+    def write_others(self, node_path, items):
+        """
+        Write each value in the dict `items` to node_path using its key as the name; no value should be a numpy array.
+
+        Subclasses should override this if they can write many values in fewer operations than one per value.
+        """
+        for key, value in items.items():
+            self.write_other(node_path, key, value)
+
     def write_array(self, node_path, key, value, dimensions):
         """
         Write value, a numpy array, to node_path with name key.
@@ -786,7 +833,7 @@ class IO(object):
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, repr(self.root_path))
 
-    def _write_node(self, node, node_path):
+    def _write_node(self, node, node_path, references=None):
         """
         Write the data in node to a new node at the given node path.
 
@@ -796,24 +843,38 @@ class IO(object):
             This will usually be a subclass of Measurement or MeasurementList.
         node_path : str
             The path of the new node into which the instance will be written.
+        references : dict or None
+            If None, write each value as it is. Otherwise, this dict maps the fingerprint of each dictionary already
+            written to its full node path, and is used to replace duplicates with references.
         """
         self.create_node(node_path)
-        self.write_other(node_path, CLASS_NAME, node.class_name())
-        if hasattr(node, '_version'):
-            self.write_other(node_path, VERSION, getattr(node, '_version'))
-        else:
-            self.write_other(node_path, VERSION, None)
+        # The non-array values are collected and written with a single call to write_others().
+        others = OrderedDict()
+        others[CLASS_NAME] = node.class_name()
+        others[VERSION] = getattr(node, '_version', None)
+        referenced_keys = []
         for key, value in node.__dict__.items():
             if not key.startswith('_'):
                 if isinstance(value, Node):
-                    self._write_node(value, join(node_path, key))
+                    self._write_node(value, join(node_path, key), references)
                 elif hasattr(node, 'dimensions') and key in node.dimensions:
                     pass  # Skip array writing on the first pass so that the dimensions can be created in order.
+                elif references is not None and isinstance(value, dict) and value:
+                    fingerprint = _fingerprint(value)
+                    if fingerprint in references:
+                        others[key] = REFERENCE + references[fingerprint]
+                        referenced_keys.append(key)
+                    else:
+                        references[fingerprint] = join(node_path, key)
+                        others[key] = value
                 else:
-                    self.write_other(node_path, key, value)
+                    others[key] = value
+        if referenced_keys:
+            others[REFERENCES] = ' '.join(referenced_keys)
+        self.write_others(node_path, others)
         if isinstance(node, MeasurementList):
             for index, child in enumerate(node):
-                self._write_node(child, join(node_path, str(index)))
+                self._write_node(child, join(node_path, str(index)), references)
         # Saving arrays in order allows the netCDF group to create the dimensions.
         if hasattr(node, 'dimensions'):
             for array_name, dimensions in node.dimensions.items():
@@ -822,7 +883,30 @@ class IO(object):
         node._io = self
         node._io_node_path = node_path
 
-    def _read_node(self, node_path, translate, force):
+    def _read_node(self, node_path, translate, force, pool=None):
+        """
+        Read and return the node at the given node path, including all the nodes it contains.
+
+        If a thread pool is given, the contents of a MeasurementList are read concurrently and the arrays of other nodes
+        are read concurrently. The pool is passed only to nodes read in the calling thread, never to the tasks it runs,
+        so no task ever waits for another task in the same pool.
+
+        Parameters
+        ----------
+        node_path : str
+            The absolute node path.
+        translate : dict
+            See read().
+        force : bool
+            See read().
+        pool : multiprocessing.pool.ThreadPool or None
+            If not None, the pool to use for concurrent reads.
+
+        Returns
+        -------
+        Node
+            The node, tagged with this IO object and the node path.
+        """
         saved_class_name = self.read_other(node_path, CLASS_NAME)
         try:
             version = self.read_other(node_path, VERSION)
@@ -833,24 +917,47 @@ class IO(object):
         measurement_names = self.node_names(node_path)
         if issubclass(class_, MeasurementList):
             # Use the name of each measurement, which is an int, to restore the order in the sequence.
-            contents = [self._read_node(join(node_path, measurement_name), translate, force)
-                        for measurement_name in sorted(measurement_names, key=int)]
+            paths = [join(node_path, measurement_name) for measurement_name in sorted(measurement_names, key=int)]
+            if pool is None:
+                contents = [self._read_node(path, translate, force) for path in paths]
+            else:
+                contents = pool.map(lambda path: self._read_node(path, translate, force), paths)
             node = class_(contents)
         else:
             variables = {}
             for measurement_name in measurement_names:
-                variables[measurement_name] = self._read_node(join(node_path, measurement_name), translate, force)
+                variables[measurement_name] = self._read_node(join(node_path, measurement_name), translate, force,
+                                                              pool)
             array_names = self.array_names(node_path)
-            for array_name in array_names:
-                variables[array_name] = self.read_array(node_path, array_name)
+            if pool is None:
+                arrays = [self.read_array(node_path, array_name) for array_name in array_names]
+            else:
+                arrays = pool.map(lambda array_name: self.read_array(node_path, array_name), array_names)
+            variables.update(zip(array_names, arrays))
+            try:
+                referenced_keys = set(self.read_other(node_path, REFERENCES).split())
+            except ValueError:
+                referenced_keys = set()
             for other_name in self.other_names(node_path):
-                variables[other_name] = self.read_other(node_path, other_name)
+                if other_name in referenced_keys:
+                    variables[other_name] = self._read_reference(node_path, other_name)
+                else:
+                    variables[other_name] = self.read_other(node_path, other_name)
             node = _instantiate(class_, variables, force)
         # Update the node with information about how it was loaded.
         node._io = self
         node._io_node_path = node_path
         return node
 
+    def _read_reference(self, node_path, key):
+        """
+        Read the reference with name key, written in batch mode, from node_path and return the value to which it refers.
+        """
+        value = self.read_other(node_path, key)
+        if not (isinstance(value, basestring) and value.startswith(REFERENCE)):
+            raise MeasurementError("Invalid reference {} in {}: {}".format(key, node_path, repr(value)))
+        return self.read_other(*split(str(value[len(REFERENCE):])))
+
 
 # Class-related functions
 
@@ -929,6 +1036,20 @@ def _instantiate(class_, variables, force):
             raise MeasurementError("Extra values are present on disk: {}".format(extras))
     return instance
 
+def _fingerprint(value):
+    """
+    Return a string that is equal for two values only if they will be stored identically. Unlike ==, this
+    distinguishes True from 1 and 1 from 1.0; values that compare equal but have different fingerprints are just not
+    deduplicated.
+    """
+    if isinstance(value, dict):
+        return '{' + ', '.join('{!r}: {}'.format(k, _fingerprint(v)) for k, v in sorted(value.items())) + '}'
+    elif isinstance(value, (list, tuple)):
+        return '[' + ', '.join(_fingerprint(v) for v in value) + ']'
+    else:
+        return repr(value)
+
+
 # Node-related functions
 
 def join(node_path, *node_paths):
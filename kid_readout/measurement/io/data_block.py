@@ -6,6 +6,7 @@ import scipy.signal
 from kid_readout.analysis.timeseries import fftfilt
 
 lpf = scipy.signal.firwin(256,1/256.)
+lpf_filter = fftfilt.OverlapSaveFilter(lpf)
 
 class DataBlock():
     def __init__(self, data, tone, fftbin, 
@@ -36,13 +37,13 @@ class DataBlock():
     def mean(self):
         if self._mean is None:
             if self._lpf_data is None:
-                self._lpf_data = fftfilt.fftfilt(lpf,self.data)[len(lpf):]*self.wavenorm
+                self._lpf_data = lpf_filter.filter(self.data).astype(self.data.dtype, copy=False)[len(lpf):]*self.wavenorm
             self._mean = self._lpf_data.mean(0,dtype='complex')
         return self._mean
     def mean_error(self):
         if self._std is None:
             if self._lpf_data is None:
-                self._lpf_data = fftfilt.fftfilt(lpf,self.data)[len(lpf):]*self.wavenorm
+                self._lpf_data = lpf_filter.filter(self.data).astype(self.data.dtype, copy=False)[len(lpf):]*self.wavenorm
             # the standard deviation is scaled by the number of independent samples
             # to compute the error on the mean.
             real_error = self._lpf_data.real.std(0)/np.sqrt(self._lpf_data.shape[0]/len(lpf))
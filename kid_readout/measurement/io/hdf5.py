@@ -0,0 +1,332 @@
+"""
+This module implements reading and writing of Measurements using HDF5, through h5py.
+
+Each node is an HDF5 group;
+numpy arrays that have entries in the dimensions dictionary are stored as chunked datasets, optionally compressed;
+other sequences like lists and tuples are stored as datasets with special names (for restrictions, see below);
+dicts are stored hierarchically as groups with special names;
+other instance attributes are stored as attributes of the group.
+
+Because the arrays are chunked, a slice of an array can be read without reading the rest of it using
+read_array_slice(), and an array can be extended along any axis after it is written using append_array(). This makes
+the format suitable for data that is written while it is acquired and for lazy analysis of long streams.
+
+Files are created using the latest HDF5 file format, which supports single-writer, multiple-reader (SWMR) access. Any
+number of processes can read a file that is not open for writing. After calling start_swmr() on the writer, readers
+can open the file while the writer continues to append to existing arrays; no new nodes can be written after that.
+
+An existing file is opened read-only by default. Opening it with mode='a' allows new nodes to be written and existing
+arrays to be appended to, for example to continue an acquisition in a later session, and start_swmr() can then be
+called again.
+
+Limitations and issues.
+
+Sequence attributes are returned as lists of numpy scalars, and strings in sequences are returned as unicode.
+
+HDF5 attributes cannot store None, and booleans would be returned as numpy.bool_, which fails identity comparison.
+These are stored as special strings that are attributes of the IO class, and converted back on read, as in nc.NCFile.
+"""
+import os
+
+import h5py
+import numpy as np
+
+from kid_readout.measurement import core
+
+
+class HDF5File(core.IO):
+
+    # This can be used as a conventional extension for files created by this IO class, but it is not used or enforced
+    # anywhere internally.
+    EXTENSION = '.h5'
+
+    # h5py serializes all calls to the HDF5 library with its own lock.
+    THREAD_SAFE = True
+
+    # These special strings are used to store None, True, and False as attributes.
+    on_write = {None: '_None',
+                True: '_True',
+                False: '_False'}
+    on_read = {'_None': None,
+               '_True': True,
+               '_False': False}
+
+    # Dictionaries are stored as Groups with names that end with this string.
+    is_dict = '.dict'
+    # Sequences that are not explicitly declared as arrays are stored as Datasets with names that end with this
+    # string, and are returned on read as lists.
+    is_list = '.list'
+
+    # These are the modes that can be used to open an existing file.
+    MODES = ('r', 'a')
+
+    def __init__(self, root_path, metadata=None, compression=None, compression_opts=None, chunk_bytes=2 ** 20,
+                 mode='r'):
+        """
+        Return a new HDF5File that reads from and writes to the file at the given path. If the file exists it is opened
+        using the given mode, and if not it is created.
+
+        Parameters
+        ----------
+        root_path : str
+            The path to the HDF5 file.
+        metadata : dict
+            If the file does not exist, write this dict to the root node.
+        compression : str or None
+            The h5py compression filter to use for arrays, such as 'gzip' or 'lzf'; None means no compression.
+        compression_opts : int or None
+            Options for the compression filter, such as the gzip level.
+        chunk_bytes : int
+            The approximate size of each chunk of a new array, in bytes. Chunks span the whole array along every axis
+            except the last, which is usually time, so slices along the last axis read only the chunks they need.
+        mode : str
+            If the file exists, 'r' opens it read-only and 'a' opens it for reading and writing; a new file can always
+            be written.
+        """
+        if mode not in self.MODES:
+            raise ValueError("Invalid mode: {}".format(mode))
+        self.mode = mode
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunk_bytes = chunk_bytes
+        super(HDF5File, self).__init__(root_path=os.path.expanduser(root_path), metadata=metadata)
+
+    def _root_path_exists(self, root_path):
+        return os.path.isfile(root_path)
+
+    def _open_existing(self, root_path):
+        if self.mode == 'a':
+            return h5py.File(root_path, mode='r+')
+        try:
+            return h5py.File(root_path, mode='r', swmr=True)
+        except (IOError, ValueError):  # The file was not created with a format that supports SWMR.
+            return h5py.File(root_path, mode='r')
+
+    def _create_new(self, root_path):
+        return h5py.File(root_path, mode='w-', libver='latest')
+
+    def close(self):
+        if not self.closed:
+            self._root.close()
+            self._root = None
+
+    @property
+    def closed(self):
+        return self._root is None
+
+    def start_swmr(self):
+        """
+        Allow other processes to read this file while this object continues to append to existing arrays. After this is
+        called, no new nodes or values can be written.
+        """
+        self._root.swmr_mode = True
+
+    def create_node(self, node_path):
+        existing, new = core.split(node_path)
+        if not new:
+            raise core.MeasurementError("Cannot create root node.")
+        self._get_node(existing).create_group(new)
+
+    def write_array(self, node_path, name, array, dimensions):
+        """
+        Write the given array to the node at node_path with the given name. The dataset is chunked and can be extended
+        along every axis using append_array().
+
+        :param node_path: the node path as a string.
+        :param name: the name of the dataset.
+        :param array: the array containing the data.
+        :param dimensions: a tuple of strings with the dimensions that correspond to the dimensions of the array; these
+          are stored as an attribute of the dataset.
+        :return: None.
+        """
+        node = self._get_node(node_path)
+        array = np.asanyarray(array)
+        dataset = node.create_dataset(name, data=array, chunks=self._chunks(array), maxshape=(None,) * array.ndim,
+                                      compression=self.compression, compression_opts=self.compression_opts)
+        dataset.attrs['dimensions'] = np.array(dimensions, dtype=h5py.special_dtype(vlen=unicode))
+
+    def append_array(self, node_path, name, array, axis=-1):
+        """
+        Append the given array to the existing array at node_path along the given axis, which is the last axis by
+        default. The shapes must match along all other axes. Other arrays that share the extended dimension are not
+        changed, so the caller is responsible for appending to all of them.
+
+        :param node_path: the node path as a string.
+        :param name: the name of the existing dataset.
+        :param array: the array to append.
+        :param axis: the axis along which to append.
+        :return: None.
+        """
+        dataset = self._get_node(node_path)[name]
+        array = np.asanyarray(array)
+        axis = axis % dataset.ndim
+        start = dataset.shape[axis]
+        dataset.resize(start + array.shape[axis], axis=axis)
+        selection = [slice(None)] * dataset.ndim
+        selection[axis] = slice(start, None)
+        dataset[tuple(selection)] = array
+        if self._root.swmr_mode:
+            dataset.flush()
+
+    def write_other(self, node_path, key, value):
+        node = self._get_node(node_path)
+        self._write_to_group(node, key, value)
+
+    def write_others(self, node_path, items):
+        node = self._get_node(node_path)
+        for key, value in items.items():
+            self._write_to_group(node, key, value)
+
+    def read_array(self, node_path, name):
+        dataset = self._get_node(node_path)[name]
+        self._refresh(dataset)
+        return dataset[()]
+
+    def read_array_slice(self, node_path, name, selection):
+        """
+        Read only the given part of an array without reading the rest of it from disk.
+
+        :param node_path: the node path as a string.
+        :param name: the name of the dataset.
+        :param selection: anything that can index a numpy array of the same shape, such as np.s_[3, 1000:2000].
+        :return: a numpy array containing the selected data.
+        """
+        dataset = self._get_node(node_path)[name]
+        self._refresh(dataset)
+        return dataset[selection]
+
+    def read_other(self, node_path, name):
+        node = self._get_node(node_path)
+        if name + self.is_dict in node:
+            return self._read_dict(node[name + self.is_dict])
+        elif name + self.is_list in node:
+            return self._read_sequence(node[name + self.is_list])
+        elif name in node.attrs:
+            return self._decode_attribute(node.attrs[name])
+        else:
+            raise ValueError("Name not found: {}".format(name))
+
+    def node_names(self, node_path='/'):
+        node = self._get_node(node_path)
+        return [name for name, link in node.items()
+                if isinstance(link, h5py.Group) and not name.endswith(self.is_dict)]
+
+    def array_names(self, node_path):
+        node = self._get_node(node_path)
+        return [name for name, link in node.items()
+                if isinstance(link, h5py.Dataset) and not name.endswith(self.is_list)]
+
+    def other_names(self, node_path):
+        node = self._get_node(node_path)
+        attrs = [name for name in node.attrs if not name.startswith('_')]
+        dicts = [name[:-len(self.is_dict)] for name in node if name.endswith(self.is_dict)]
+        lists = [name[:-len(self.is_list)] for name in node if name.endswith(self.is_list)]
+        return attrs + lists + dicts
+
+    # Private methods.
+
+    def _get_node(self, node_path):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        node = self._root
+        if node_path != '':
+            core.validate_node_path(node_path)
+            for name in core.explode(node_path):
+                node = node[name]
+        return node
+
+    def _refresh(self, dataset):
+        """Update the shape of the given dataset in case another process has appended to it."""
+        if self._root.swmr_mode and self._root.mode == 'r':
+            dataset.refresh()
+
+    def _chunks(self, array):
+        """
+        Return a chunk shape that spans the array along every axis except the last and contains about chunk_bytes, or
+        None if the array is empty.
+        """
+        if array.size == 0 or array.ndim == 0:
+            return None
+        other = int(np.prod(array.shape[:-1]))
+        last = max(1, min(array.shape[-1], self.chunk_bytes // (other * array.dtype.itemsize)))
+        return array.shape[:-1] + (last,)
+
+    def _write_to_group(self, group, key, value):
+        """
+        This method directly writes non-container values to the given Group or calls the appropriate function to
+        write container values.
+
+        :param group: the h5py Group.
+        :param key: the external name of the value to write, with no special suffix.
+        :param value: the value to write
+        :return: None.
+        """
+        if isinstance(value, dict):
+            self._write_dict(group, key + self.is_dict, value)
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            self._write_sequence(group, key + self.is_list, value)
+        else:
+            for k, v in self.on_write.items():
+                if value is k:  # we need to use identity because, e.g., 0 == False evaluates to True.
+                    group.attrs[key] = v
+                    return
+            group.attrs[key] = value
+
+    def _write_sequence(self, group, key, value):
+        """
+        Write the given sequence (value) to the given Group using the given name (key). Strings and booleans are stored
+        as variable-length strings, with booleans stored as special strings.
+
+        :param group: the h5py Group.
+        :param key: the name of the Dataset to use for storing the sequence, ending with self.is_list.
+        :param value: the sequence to store.
+        :return: None.
+        """
+        array = np.array(value)
+        if array.dtype.type in (np.unicode_, np.str_):
+            group.create_dataset(key, data=array.astype(np.object), dtype=h5py.special_dtype(vlen=unicode))
+        elif array.dtype.type is np.bool_:  # This seems to be True only if all elements are bool.
+            group.create_dataset(key, data=np.array([self.on_write[obj] for obj in array], dtype=np.object),
+                                 dtype=h5py.special_dtype(vlen=unicode))
+        else:
+            group.create_dataset(key, data=array)
+
+    def _read_sequence(self, dataset):
+        """
+        Return a list containing the stored sequence in the given Dataset.
+
+        :param dataset: the h5py Dataset to read.
+        :return: a list containing the contents of the Dataset.
+        """
+        array = dataset[()]
+        try:
+            return [self.on_read[v] for v in array]
+        except (KeyError, TypeError):
+            return list(array)
+
+    def _decode_attribute(self, value):
+        try:
+            return self.on_read.get(value, value)
+        except TypeError:  # Unhashable values, such as arrays, cannot be special strings.
+            return value
+
+    def _write_dict(self, group, dict_name, dictionary):
+        """
+        Create a new Group with the given name and write the given dictionary to it.
+
+        :param group: the h5py Group.
+        :param dict_name: the name of the dictionary, ending with self.is_dict.
+        :param dictionary: the dict to write.
+        :return: None.
+        """
+        dict_group = group.create_group(dict_name)
+        for k, v in dictionary.items():
+            self._write_to_group(dict_group, k, v)
+
+    def _read_dict(self, group):
+        attrs = [(k, self._decode_attribute(v)) for k, v in group.attrs.items()]
+        lists = [(name[:-len(self.is_list)], self._read_sequence(group[name]))
+                 for name in group if name.endswith(self.is_list)]
+        dicts = [(name[:-len(self.is_dict)], self._read_dict(group[name]))
+                 for name in group if name.endswith(self.is_dict)]
+        return dict(attrs + lists + dicts)
@@ -9,6 +9,8 @@ class Dictionary(core.IO):
     _array = '_array'
     _node = '_node'
 
+    THREAD_SAFE = True
+
     def __init__(self, root_path=None, metadata=None):
         """
         Return a new diskless Dictionary IO object.
@@ -62,6 +64,13 @@ class Dictionary(core.IO):
         node = self._get_node(node_path)
         node[key] = value
 
+    def write_others(self, node_path, items):
+        """
+        Write each value in the dict items to node_path with its key as the name.
+        """
+        node = self._get_node(node_path)
+        node.update(items)
+
     def write_array(self, node_path, key, value, dimensions):
         """
         Write value, a numpy array, to node_path with name key.
@@ -21,6 +21,7 @@ These are stored as special strings that are attributes of the IO class, and con
 This is a little bit gross but probably safe in practice.
 """
 import os
+from collections import OrderedDict
 
 import netCDF4
 import numpy as np
@@ -80,12 +81,13 @@ class NCFile(core.IO):
     def closed(self):
         return self._root is None
 
-    def read(self, node_path, translate=None, force=False):
+    def read(self, node_path, translate=None, force=False, workers=None):
         if translate is None:
             translate = {}
         if self.cache_s21_raw:
             translate.update({'StreamArray': '{}.NCStreamArray'.format(__name__),
                               'SingleStream': '{}.NCSingleStream'.format(__name__)})
+        # The netCDF4 library is not thread-safe, so workers is accepted for compatibility but nodes are read serially.
         return self._read_node(node_path=node_path, translate=translate, force=force)
 
     def create_node(self, node_path):
@@ -128,6 +130,24 @@ class NCFile(core.IO):
         node = self._get_node(node_path)
         self._write_to_group(node, key, value)
 
+    def write_others(self, node_path, items):
+        """
+        Write all of the given values to the node at node_path; the values that are stored as ncattrs are set together
+        using a single call.
+
+        :param node_path: the node path as a string.
+        :param items: a dict mapping names to values, none of which should be numpy arrays.
+        :return: None.
+        """
+        node = self._get_node(node_path)
+        ncattrs = OrderedDict()
+        for key, value in items.items():
+            if isinstance(value, (dict, list, tuple, np.ndarray)):
+                self._write_to_group(node, key, value)
+            else:
+                ncattrs[key] = self._encode_ncattr(value)
+        node.setncatts(ncattrs)
+
     def read_array(self, node_path, name):
         node = self._get_node(node_path)
         nc_variable = node.variables[name]
@@ -190,11 +210,19 @@ class NCFile(core.IO):
         elif isinstance(value, (list, tuple, np.ndarray)):
             self._write_sequence(group, key + self.is_list, value)
         else:
-            for k, v in self.on_write.items():
-                if value is k:  # we need to use identity because, e.g., 0 == False evaluates to True.
-                    setattr(group, key, v)
-                    return
-            setattr(group, key, value)
+            setattr(group, key, self._encode_ncattr(value))
+
+    def _encode_ncattr(self, value):
+        """
+        Return the given non-container value, or the special string used to store it if it is None, True, or False.
+
+        :param value: the value to encode.
+        :return: a value that netCDF4 can store as an ncattr.
+        """
+        for k, v in self.on_write.items():
+            if value is k:  # we need to use identity because, e.g., 0 == False evaluates to True.
+                return v
+        return value
 
     def _write_sequence(self, group, key, value):
         """
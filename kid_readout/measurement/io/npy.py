@@ -5,13 +5,24 @@ Each node is a directory:
 Numpy arrays are stored as .npy files;
 Other values are stored using json.
 
+There are two layouts for the other values. In format version 1, the default for new roots, all of the other values
+for a node, including the class name and version, are stored as a single JSON object in a file named by
+NumpyDirectory.OTHERS. In format version 0, each value is stored in its own JSON file named for the key. Large sweeps
+written in version 0 contain tens of thousands of tiny files, and listing them requires a stat call per file, which is
+very slow on network file systems. Every node is read using whichever layout it has, so old directories can still be
+read, and an existing root keeps the layout it was created with when new nodes are written to it. Writing with
+IO.write() writes the JSON file for each node only once.
+
 Limitations and issues:
 -Because json has only a single sequence type, all sequences that are not declared to be numpy arrays (i.e. passed to
  write_array() are saved as JSON sequences and loaded from disk as lists.
 -
 """
 import os
+import copy
 import json
+import threading
+from collections import OrderedDict
 
 import numpy as np
 
@@ -27,8 +38,43 @@ class NumpyDirectory(core.IO):
     # enforced anywhere internally.
     EXTENSION = '.npd'
 
+    # In format version 1, all non-array values for a node are stored in a file with this name.
+    OTHERS = '_others.json'
+
+    # The others file is written to a file with this suffix appended and then renamed.
+    TEMPORARY_SUFFIX = '.tmp'
+
+    FORMAT_VERSIONS = (0, 1)
 
-    def __init__(self, root_path, metadata=None, memmap=False):
+    # The maximum number of nodes for which the other values are cached; see _read_others().
+    OTHERS_CACHE_SIZE = 64
+
+    # Reads only open files and list directories, and the cache of other values is guarded by a lock.
+    THREAD_SAFE = True
+
+    def __init__(self, root_path, metadata=None, memmap=False, format_version=1):
+        """
+        Return a new NumpyDirectory that reads from and writes to the given root directory, which is created if it does
+        not exist.
+
+        Parameters
+        ----------
+        root_path : str
+            The path to the root directory.
+        metadata : dict
+            If the root does not exist, write this dict to the root node.
+        memmap : bool
+            If True, arrays are memory-mapped on read instead of being loaded.
+        format_version : int
+            The layout to use for non-array values if the root is created; see the module docstring. An existing root
+            keeps its own format version.
+        """
+        if format_version not in self.FORMAT_VERSIONS:
+            raise ValueError("Invalid format version: {}".format(format_version))
+        # These must be set before the superclass reads or writes the root metadata.
+        self.format_version = format_version
+        self._others_cache = OrderedDict()
+        self._others_lock = threading.Lock()
         super(NumpyDirectory, self).__init__(root_path=os.path.abspath(os.path.expanduser(root_path)),
                                              metadata=metadata)
         if memmap:
@@ -40,6 +86,11 @@ class NumpyDirectory(core.IO):
         return os.path.isdir(root_path)
 
     def _open_existing(self, root_path):
+        # A root written in format version 0 contains a metadata file; an empty directory uses the requested version.
+        if os.path.isfile(os.path.join(root_path, self.OTHERS)):
+            self.format_version = 1
+        elif os.path.isfile(os.path.join(root_path, core.METADATA)):
+            self.format_version = 0
         return root_path
 
     def _create_new(self, root_path):
@@ -71,41 +122,114 @@ class NumpyDirectory(core.IO):
             np.save(f, value)
 
     def write_other(self, node_path, key, value):
+        if self.format_version == 0:
+            node = self._get_node(node_path)
+            filename = os.path.join(node, key)
+            with self._safe_open(filename) as f:
+                self._dump(key, value, f)
+        else:
+            self.write_others(node_path, {key: value})
+
+    def write_others(self, node_path, items):
+        """
+        Write all of the given values to the node at node_path. In format version 1, this reads and rewrites the single
+        file that contains the other values for the node, so writing all the values for a node in one call is much
+        faster than calling write_other() for each of them.
+        """
+        if self.format_version == 0:
+            super(NumpyDirectory, self).write_others(node_path, items)
+            return
         node = self._get_node(node_path)
-        filename = os.path.join(node, key)
-        with self._safe_open(filename) as f:
-            try:
-                json.dump(value, f)
-            except TypeError as e:
-                raise ValueError("json.dump({}) of {} ({}) failed: {}".format(key, value, repr(value), e.message))
+        others = self._read_others(node)
+        if others is None:
+            others = {}
+        for key in items:
+            if key in others:
+                raise RuntimeError("Name already exists: {}".format(os.path.join(node, key)))
+        # The cached dict may be in use by other threads, so build a new one.
+        others = dict(others)
+        others.update(items)
+        with self._others_lock:
+            self._others_cache.pop(node, None)
+        filename = os.path.join(node, self.OTHERS)
+        # Write to a temporary file and rename it so that the node is never left with a partially-written file.
+        temporary = filename + self.TEMPORARY_SUFFIX
+        with self._safe_open(temporary) as f:
+            self._dump(self.OTHERS, others, f)
+        os.rename(temporary, filename)
 
     def read_array(self, node_path, name):
         full = os.path.join(self._get_node(node_path), name + '.npy')
         return np.load(full, mmap_mode=self._mmap_mode)
 
     def read_other(self, node_path, name):
-        full_name = os.path.join(self._get_node(node_path), name)
+        node = self._get_node(node_path)
+        others = self._read_others(node)
+        if others is not None:
+            try:
+                # The cached values are shared, so return a copy that the caller can modify.
+                return copy.deepcopy(others[name])
+            except KeyError:
+                raise ValueError("Name not found: {}".format(name))
+        full_name = os.path.join(node, name)
         if not os.path.isfile(full_name):
             raise ValueError("Name not found: {}".format(name))
         with open(full_name) as f:
             return json.load(f)
 
+    # In format version 1, a node directory contains only node directories, .npy files, and the others file, possibly
+    # with a temporary file left by an interrupted write, so the contents can be classified by name; in version 0 each
+    # entry has to be checked using a stat call.
+
     def node_names(self, node_path='/'):
         node = self._get_node(node_path)
-        return [f for f in os.listdir(node) if os.path.isdir(os.path.join(node, f))]
+        entries = os.listdir(node)
+        if self.OTHERS in entries:
+            return [f for f in entries if f not in (self.OTHERS, self.OTHERS + self.TEMPORARY_SUFFIX) and
+                    os.path.splitext(f)[1] != '.npy']
+        return [f for f in entries if os.path.isdir(os.path.join(node, f))]
 
     def array_names(self, node_path):
         node = self._get_node(node_path)
-        return [os.path.splitext(f)[0] for f in os.listdir(node) if os.path.isfile(os.path.join(node, f))
+        entries = os.listdir(node)
+        if self.OTHERS in entries:
+            return [os.path.splitext(f)[0] for f in entries if os.path.splitext(f)[1] == '.npy']
+        return [os.path.splitext(f)[0] for f in entries if os.path.isfile(os.path.join(node, f))
                 and os.path.splitext(f)[1] == '.npy']
 
     def other_names(self, node_path):
         node = self._get_node(node_path)
+        others = self._read_others(node)
+        if others is not None:
+            return [key for key in others if not key.startswith('_')]
         return [f for f in os.listdir(node)
                 if os.path.isfile(os.path.join(node, f)) and
                 not f.startswith('_') and
                 os.path.splitext(f)[1] != '.npy']
 
+    def _read_others(self, node):
+        """
+        Return the dict of other values stored in the given node directory in format version 1, or None if the node
+        uses format version 0. The most recently read nodes are cached because reading a node requests each of its
+        values separately, and threads reading concurrently each read different nodes. The returned dict is shared by
+        all readers, so it must not be modified.
+        """
+        with self._others_lock:
+            if node in self._others_cache:
+                others = self._others_cache.pop(node)
+                self._others_cache[node] = others  # The most recently used entry is last.
+                return others
+        try:
+            with open(os.path.join(node, self.OTHERS)) as f:
+                others = json.load(f)
+        except IOError:
+            others = None
+        with self._others_lock:
+            self._others_cache[node] = others
+            while len(self._others_cache) > self.OTHERS_CACHE_SIZE:
+                self._others_cache.popitem(last=False)
+        return others
+
     def _get_node(self, node_path):
         if self.closed:
             raise ValueError("I/O operation on closed file")
@@ -116,6 +240,13 @@ class NumpyDirectory(core.IO):
             raise ValueError("Invalid path: {}".format(full_path))
         return full_path
 
+    @staticmethod
+    def _dump(key, value, f):
+        try:
+            json.dump(value, f)
+        except TypeError as e:
+            raise ValueError("json.dump({}) of {} ({}) failed: {}".format(key, value, repr(value), e.message))
+
     @staticmethod
     def _safe_open(filename):
         if os.path.exists(filename):
@@ -6,8 +6,7 @@ from collections import OrderedDict
 import numpy as np
 
 from kid_readout.roach.tools import ntone_power_correction
-import kid_readout.analysis.timeseries.fftfilt
-from kid_readout.measurement.io.data_block import lpf
+from kid_readout.measurement.io.data_block import lpf, lpf_filter
 import kid_readout.roach.tools
 
 
@@ -57,16 +56,12 @@ class TimestreamGroup(object):
             self.modulation_phase = np.zeros_like(self.epoch)
             self.modulation_freq = np.zeros_like(self.epoch)
             self.modulation_period_samples = np.zeros_like(self.epoch)
-            for index in range(len(self.epoch)):
-                out, rate = self.parent.get_modulation_state_at(self.epoch[index])
-                if out == 2:
-                    self.modulation_duty_cycle[index] = 0.5
-                    self.modulation_freq[index] = self.sample_rate[index]/2.**rate
-                    self.modulation_period_samples[index] = 2.**rate
-                else:
-                    self.modulation_duty_cycle[index] = out
-                    self.modulation_freq[index] = 0.0
-                    self.modulation_period_samples[index] = 0.0
+            out, rate = self.parent.get_modulation_states_at(self.epoch)
+            modulated = out == 2
+            sample_rate = self.sample_rate * np.ones_like(self.epoch)
+            self.modulation_duty_cycle[:] = np.where(modulated, 0.5, out)
+            self.modulation_freq[modulated] = sample_rate[modulated]/2.**rate[modulated]
+            self.modulation_period_samples[modulated] = 2.**rate[modulated]
 
         self._data = ncgroup.variables['data']
         self.num_data_samples = self._data.shape[1]
@@ -84,13 +79,24 @@ class TimestreamGroup(object):
             self._datacache = self._data[:].view(self._data.datatype.name)*wavenorm
         return self._datacache
     
+    @property
+    def data_shape(self):
+        """The shape of the data array, available without reading the data."""
+        return self._data.shape
+
     def get_data_index(self,index):
+        """
+        Return the data for the given row index, or for a sorted sequence of row indices, reading only those rows from
+        disk if the full data array has not been loaded.
+        """
         if self._datacache is None:
             if self.wavenorm is None:
                 wavenorm = 1.0
                 warnings.warn("wave normalization not found, time series will not match sweep")
             else:
-                wavenorm = self.wavenorm[index]            
+                wavenorm = self.wavenorm[index]
+                if np.ndim(wavenorm):
+                    wavenorm = wavenorm[:,None]
             return self._data[index].view(self._data.datatype.name)*wavenorm
         else:
             return self._datacache[index]
@@ -118,16 +124,14 @@ class SweepGroup(object):
             indexes_to_calculate = np.arange(self.timestream_group.data.shape[0],dtype='int')
         else:
             indexes_to_calculate = np.flatnonzero(mask)
-        errors = np.zeros(indexes_to_calculate.shape[0], dtype='complex')
-        for output_index,input_index in enumerate(indexes_to_calculate):
-            filtered = kid_readout.analysis.timeseries.fftfilt.fftfilt(lpf, self.timestream_group.data[input_index,
-                                                                            :])[len(lpf):]
-            # the standard deviation is scaled by the number of independent samples
-            # to compute the error on the mean.
-            error_scaling = np.sqrt(float(len(filtered))/len(lpf))
-            real_error = filtered.real.std()/error_scaling
-            imag_error = filtered.imag.std()/error_scaling
-            errors[output_index] = real_error + 1j*imag_error
+        # Filter all of the channels at once; the filter works along the first axis.
+        filtered = lpf_filter.filter(self.timestream_group.data[indexes_to_calculate, :].T)[len(lpf):]
+        # the standard deviation is scaled by the number of independent samples
+        # to compute the error on the mean.
+        error_scaling = np.sqrt(float(filtered.shape[0])/len(lpf))
+        real_error = filtered.real.std(axis=0)/error_scaling
+        imag_error = filtered.imag.std(axis=0)/error_scaling
+        errors = real_error + 1j*imag_error
 
         return errors
 
@@ -215,6 +219,15 @@ class ReadoutNetCDF(object):
             index = 0
         return index
 
+    def _get_hwstate_indices_at(self,epochs):
+        """
+        Vectorized version of _get_hwstate_index_at.
+        :param epochs: array of unix timestamps
+        :return: array of indices of the hardware state arrays
+        """
+        indices = np.searchsorted(self.hardware_state_epoch, epochs, side='left') - 1
+        return np.clip(indices, 0, None)
+
     def get_effective_dac_atten_at(self,epoch):
         """
         Get the dac attenuator value and total signal attenuation at a given time
@@ -243,4 +256,16 @@ class ReadoutNetCDF(object):
         index = self._get_hwstate_index_at(epoch)
         modulation_rate = self.modulation_rate[index]
         modulation_output = self.modulation_output[index]
-        return modulation_output, modulation_rate
\ No newline at end of file
+        return modulation_output, modulation_rate
+
+    def get_modulation_states_at(self,epochs):
+        """
+        Vectorized version of get_modulation_state_at.
+        :param epochs: array of unix timestamps
+        :return: arrays of modulation output states and modulation rate parameters
+        """
+        epochs = np.asarray(epochs)
+        if self.modulation_rate is None:
+            return np.zeros(epochs.shape, dtype=int), np.zeros(epochs.shape, dtype=int)
+        indices = self._get_hwstate_indices_at(epochs)
+        return np.asarray(self.modulation_output)[indices], np.asarray(self.modulation_rate)[indices]
@@ -0,0 +1,13 @@
+import numpy as np
+
+from kid_readout.analysis.timeseries import fftfilt
+from kid_readout.measurement.io import data_block
+
+
+def test_mean_dtype():
+    np.random.seed(123)
+    data = (1 + 2j + 0.1 * (np.random.randn(4096) + 1j * np.random.randn(4096))).astype(np.complex64)
+    block = data_block.DataBlock(data=data, tone=1, fftbin=1, nsamp=2 ** 16, nfft=2 ** 14, wavenorm=2.)
+    expected = fftfilt.fftfilt(data_block.lpf, data)[len(data_block.lpf):] * 2.
+    assert expected.dtype == np.complex64
+    np.testing.assert_array_equal(block.mean(), expected.mean(0, dtype='complex'))
@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.measurement.test import utilities
+from kid_readout.measurement.io import hdf5
+
+
+def test_read_write_measurement():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.CornerCases()
+        name = 'measurement'
+        io.write(original, name)
+        assert original == io.read(name)
+
+
+def test_read_write_stream():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_single_stream()
+        name = 'stream'
+        io.write(original, name)
+        assert original == io.read(name)
+
+
+def test_read_write_streamarray():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_stream_array()
+        name = 'stream_array'
+        io.write(original, name)
+        assert original == io.read(name)
+
+
+def test_read_write_sweeparray():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_sweep_array()
+        name = 'sweep_array'
+        io.write(original, name)
+        assert original == io.read(name)
+
+
+def test_read_write_sweepstreamarray():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        assert original == io.read(name)
+
+
+def test_read_write_sweepstreamarray_batch():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name, batch=True)
+        assert original == io.read(name)
+
+
+def test_read_sweepstreamarray_workers():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        assert original == io.read(name, workers=4)
+
+
+def test_read_write_sweepstreamarray_compression():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename), compression='gzip')
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        io.close()
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        assert original == io.read(name)
+
+
+def test_append_and_slice():
+    with TempDirectory() as directory:
+        filename = 'test.h5'
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        original = utilities.fake_stream_array()
+        name = 'stream_array'
+        io.write(original, name)
+        io.append_array(name, 's21_raw', original.s21_raw)
+        io.close()
+        io = hdf5.HDF5File(os.path.join(directory.path, filename))
+        s21_raw = io.read_array(name, 's21_raw')
+        assert s21_raw.shape == (original.s21_raw.shape[0], 2 * original.s21_raw.shape[1])
+        assert np.all(s21_raw[:, original.s21_raw.shape[1]:] == original.s21_raw)
+        assert np.all(io.read_array_slice(name, 's21_raw', np.s_[1, 10:20]) == original.s21_raw[1, 10:20])
+
+
+def test_append_mode():
+    with TempDirectory() as directory:
+        filename = os.path.join(directory.path, 'test.h5')
+        io = hdf5.HDF5File(filename)
+        original = utilities.fake_stream_array()
+        name = 'stream_array'
+        io.write(original, name)
+        io.close()
+        io = hdf5.HDF5File(filename)
+        try:
+            io.append_array(name, 's21_raw', original.s21_raw)
+        except (IOError, ValueError, RuntimeError):
+            pass
+        else:
+            raise AssertionError("A file opened read-only was modified.")
+        io.close()
+        io = hdf5.HDF5File(filename, mode='a')
+        io.append_array(name, 's21_raw', original.s21_raw)
+        io.write(original, 'another')
+        io.start_swmr()
+        io.append_array(name, 's21_raw', original.s21_raw)
+        io.close()
+        io = hdf5.HDF5File(filename)
+        assert io.read_array(name, 's21_raw').shape == (original.s21_raw.shape[0], 3 * original.s21_raw.shape[1])
+        assert original == io.read('another')
@@ -57,6 +57,26 @@ def test_read_write_sweepstreamarray():
         assert original == io.read(name)
 
 
+def test_read_write_sweepstreamarray_batch():
+    with TempDirectory() as directory:
+        filename = 'test.nc'
+        io = nc.NCFile(os.path.join(directory.path, filename))
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name, batch=True)
+        assert original == io.read(name)
+
+
+def test_read_sweepstreamarray_workers():
+    with TempDirectory() as directory:
+        filename = 'test.nc'
+        io = nc.NCFile(os.path.join(directory.path, filename))
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        assert original == io.read(name, workers=4)
+
+
 def test_cached_single_stream():
     with TempDirectory() as directory:
         filename = 'test.nc'
@@ -1,3 +1,6 @@
+import os
+from collections import OrderedDict
+
 from testfixtures import TempDirectory
 
 from kid_readout.measurement.test import utilities
@@ -49,6 +52,24 @@ def test_read_write_sweepstreamarray():
         assert original == io.read(name)
 
 
+def test_read_write_sweepstreamarray_batch():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name, batch=True)
+        assert original == io.read(name)
+
+
+def test_read_sweepstreamarray_workers():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        assert original == io.read(name, workers=4)
+
+
 def test_memmap():
     with TempDirectory() as directory:
         io = npy.NumpyDirectory(directory.path, memmap=True)
@@ -56,3 +77,98 @@ def test_memmap():
         name = 'stream'
         io.write(original, name)
         assert original == io.read(name)
+
+
+def test_read_write_sweepstreamarray_format_version_0():
+    with TempDirectory() as directory:
+        root_path = os.path.join(directory.path, 'test' + npy.NumpyDirectory.EXTENSION)
+        io = npy.NumpyDirectory(root_path, format_version=0)
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        io.close()
+        io = npy.NumpyDirectory(root_path)
+        assert io.format_version == 0
+        assert not os.path.exists(os.path.join(root_path, name, npy.NumpyDirectory.OTHERS))
+        assert original == io.read(name)
+
+
+def test_format_version_1_files():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_single_stream()
+        name = 'stream'
+        io.write(original, name, batch=True)
+        io.close()
+        io = npy.NumpyDirectory(directory.path)
+        assert io.format_version == 1
+        expected = set([npy.NumpyDirectory.OTHERS] + [array_name + '.npy' for array_name in original.dimensions])
+        assert set(os.listdir(os.path.join(directory.path, name))) == expected
+        assert original == io.read(name)
+
+
+def test_write_others_once_per_node():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        written = []
+        write_others = io.write_others
+
+        def counting_write_others(node_path, items):
+            written.append(node_path)
+            write_others(node_path, items)
+
+        io.write_others = counting_write_others
+        original = utilities.fake_sweep_stream_array()
+        name = 'sweep_stream_array'
+        io.write(original, name)
+        assert len(written) == len(set(written))
+        assert set(written) == set(os.path.join(root, '').rstrip('/')[len(directory.path):]
+                                   for root, dirs, files in os.walk(os.path.join(directory.path, name)))
+        assert original == io.read(name)
+
+
+def test_node_names_ignores_temporary_file():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_single_stream()
+        name = 'stream'
+        io.write(original, name)
+        open(os.path.join(directory.path, name, npy.NumpyDirectory.OTHERS + npy.NumpyDirectory.TEMPORARY_SUFFIX),
+             'w').close()
+        assert io.node_names(name) == []
+        assert original == io.read(name)
+
+
+def test_others_cache():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_sweep_array()
+        name = 'sweep_array'
+        io.write(original, name)
+        assert original == io.read(name, workers=4)
+        # Each stream array was read by one of the threads, and they share the cache.
+        assert len(io._others_cache) > len(original.stream_arrays)
+        io.write_other(name, 'extra', 1)
+        assert io.read_other(name, 'extra') == 1
+
+
+def test_others_cache_is_not_modified():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        io.write(utilities.fake_sweep_array(), 'sweep_array')
+        io.write_other('sweep_array', 'a', [1])
+        # A failed write leaves no trace of the keys before the one that already exists.
+        try:
+            io.write_others('sweep_array', OrderedDict([('b', 2), ('a', 3)]))
+            assert False
+        except RuntimeError:
+            pass
+        assert 'b' not in io.other_names('sweep_array')
+        try:
+            io.read_other('sweep_array', 'b')
+            assert False
+        except ValueError:
+            pass
+        # Modifying a value that was read does not change the value read next.
+        io.read_other('sweep_array', 'a').append(2)
+        assert io.read_other('sweep_array', 'a') == [1]
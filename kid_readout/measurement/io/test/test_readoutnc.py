@@ -0,0 +1,63 @@
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.measurement.io import readoutnc
+from kid_readout.measurement.test import utilities
+
+
+def test_get_hwstate_indices_at():
+    with TempDirectory() as directory:
+        rnc = readoutnc.ReadoutNetCDF(utilities.fake_legacy_file(directory.path))
+        epochs = np.concatenate(([0, 1e10], rnc.hardware_state_epoch, rnc.hardware_state_epoch + 0.5,
+                                 np.linspace(980, 1110, 53)))
+        np.testing.assert_array_equal(rnc._get_hwstate_indices_at(epochs),
+                                      [rnc._get_hwstate_index_at(epoch) for epoch in epochs])
+        rnc.close()
+
+
+def test_get_modulation_states_at():
+    with TempDirectory() as directory:
+        rnc = readoutnc.ReadoutNetCDF(utilities.fake_legacy_file(directory.path))
+        epochs = np.concatenate((rnc.hardware_state_epoch, np.linspace(980, 1110, 53)))
+        out, rate = rnc.get_modulation_states_at(epochs)
+        loop = np.array([rnc.get_modulation_state_at(epoch) for epoch in epochs])
+        np.testing.assert_array_equal(out, loop[:, 0])
+        np.testing.assert_array_equal(rate, loop[:, 1])
+        rnc.close()
+
+
+def test_timestream_group_modulation():
+    with TempDirectory() as directory:
+        rnc = readoutnc.ReadoutNetCDF(utilities.fake_legacy_file(directory.path))
+        for tg in [rnc.sweeps[0].timestream_group, rnc.timestreams[0]]:
+            sample_rate = tg.sample_rate * np.ones_like(tg.epoch)
+            assert np.any(tg.modulation_freq)
+            for index in range(len(tg.epoch)):
+                out, rate = rnc.get_modulation_state_at(tg.epoch[index])
+                if out == 2:
+                    assert tg.modulation_duty_cycle[index] == 0.5
+                    assert tg.modulation_freq[index] == sample_rate[index] / 2. ** rate
+                    assert tg.modulation_period_samples[index] == 2. ** rate
+                else:
+                    assert tg.modulation_duty_cycle[index] == out
+                    assert tg.modulation_freq[index] == 0
+                    assert tg.modulation_period_samples[index] == 0
+        rnc.close()
+
+
+def test_get_data_index():
+    with TempDirectory() as directory:
+        rnc = readoutnc.ReadoutNetCDF(utilities.fake_legacy_file(directory.path))
+        tg = rnc.sweeps[0].timestream_group
+        rows = np.flatnonzero(tg.epoch == tg.epoch[1])
+        # Read before the data is cached, so that only the rows are read.
+        assert tg.data_shape == (tg.epoch.size, tg.num_data_samples)
+        single = tg.get_data_index(rows[1])
+        selected = tg.get_data_index(rows)
+        assert tg._datacache is None
+        data = tg.data
+        assert tg.data_shape == data.shape
+        np.testing.assert_array_equal(single, data[rows[1]])
+        np.testing.assert_array_equal(selected, data[rows, :])
+        np.testing.assert_array_equal(tg.get_data_index(rows), data[rows, :])
+        rnc.close()
@@ -0,0 +1,113 @@
+"""
+This module contains functions that convert legacy ReadoutNetCDF files to files that contain Measurements.
+
+Each SweepGroup in a legacy file is converted to a SweepArray and each TimestreamGroup is converted to a StreamArray,
+and these are written at the root level using the names of the legacy groups. The data rows of the legacy files are
+read only as they are needed, so the memory used is about the size of the largest single measurement.
+
+A conversion is first written to a file with PARTIAL appended to the output name, which is renamed only after every
+group has been written. If a batch conversion is interrupted, running it again removes any partial outputs and skips
+the files that were already converted.
+"""
+from __future__ import division
+import os
+import shutil
+import logging
+import multiprocessing
+
+from kid_readout.measurement.io import nc, readoutnc
+from kid_readout.measurement.legacy import read
+
+logger = logging.getLogger(__name__)
+
+PARTIAL = '.partial'
+
+
+def convert(rnc_filename, output_filename, io_class=nc.NCFile):
+    """
+    Convert every SweepGroup and TimestreamGroup in the given legacy file and write them to a new output.
+
+    :param rnc_filename: the path to a legacy ReadoutNetCDF file.
+    :param output_filename: the path of the output, which must not exist.
+    :param io_class: the IO subclass used to write the output.
+    :return: the list of node names written to the output.
+    """
+    if os.path.exists(output_filename):
+        raise ValueError("Output already exists: {}".format(output_filename))
+    partial = output_filename + PARTIAL
+    _remove(partial)
+    rnc = readoutnc.ReadoutNetCDF(rnc_filename)
+    try:
+        io = io_class(partial, metadata={'legacy_filename': os.path.abspath(rnc_filename)})
+        names = []
+        try:
+            for index, name in enumerate(rnc.sweeps_dict):
+                io.write(read.sweeparray_from_rnc(rnc, index), name, batch=True)
+                names.append(name)
+            for index, name in enumerate(rnc.timestreams_dict):
+                io.write(read.streamarray_from_rnc(rnc, index), name, batch=True)
+                names.append(name)
+        finally:
+            io.close()
+    finally:
+        rnc.close()
+    os.rename(partial, output_filename)
+    return names
+
+
+def convert_files(rnc_filenames, output_directory, io_class=nc.NCFile, processes=1):
+    """
+    Convert the given legacy files, writing each to output_directory using the same base name and the extension of the
+    IO class. Files that have already been converted are skipped, so an interrupted batch can be resumed by running it
+    again with the same arguments. A file that fails to convert is logged and does not stop the others.
+
+    :param rnc_filenames: a sequence of paths to legacy ReadoutNetCDF files.
+    :param output_directory: the directory in which to write the converted files.
+    :param io_class: the IO subclass used to write the outputs.
+    :param processes: the number of files to convert in parallel; if 1, the files are converted in this process.
+    :return: a dict with keys that are the legacy filenames and values that are the output filenames, or None for files
+      that failed to convert.
+    """
+    tasks = []
+    results = {}
+    for rnc_filename in rnc_filenames:
+        base = os.path.splitext(os.path.basename(rnc_filename))[0]
+        output_filename = os.path.join(output_directory, base + io_class.EXTENSION)
+        if os.path.exists(output_filename):
+            logger.debug("Skipping {}: {} exists".format(rnc_filename, output_filename))
+            results[rnc_filename] = output_filename
+        else:
+            tasks.append((rnc_filename, output_filename, io_class))
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            outputs = pool.map(_convert_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [_convert_task(task) for task in tasks]
+    for (rnc_filename, output_filename, io_class), output in zip(tasks, outputs):
+        results[rnc_filename] = output
+    return results
+
+
+# Private functions.
+
+def _convert_task(task):
+    """Convert one file and return the output filename, or None on failure. This is module-level so it can be pickled."""
+    rnc_filename, output_filename, io_class = task
+    try:
+        convert(rnc_filename, output_filename, io_class=io_class)
+        return output_filename
+    except Exception:
+        logger.exception("Failed to convert {}".format(rnc_filename))
+        _remove(output_filename + PARTIAL)
+        return None
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
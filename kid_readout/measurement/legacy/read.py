@@ -246,7 +246,7 @@ def sweep_from_rnc(rnc, sweep_group_index, number, description=''):
     tg = sg.timestream_group
     sweep_indices = np.unique(tg.sweep_index)
     start_epochs = np.unique(tg.epoch)
-    if not tg.data.shape == (sweep_indices.size * start_epochs.size, tg.num_data_samples):
+    if not tg.data_shape == (sweep_indices.size * start_epochs.size, tg.num_data_samples):
         raise ValueError("Data shape problem.")
     streams = []
     # Extract simultaneously-sampled data
@@ -261,7 +261,8 @@ def sweep_from_rnc(rnc, sweep_group_index, number, description=''):
         # All of the epochs are the same
         epoch = int(common(tg.epoch[simultaneous]))
         ssn = np.nan  # The sequence start numbers weren't saved.
-        s21_raw = tg.data[simultaneous, :][increasing_order][number]
+        # Read only the row for this channel.
+        s21_raw = tg.get_data_index(np.flatnonzero(simultaneous)[increasing_order][number])
         data_demodulated = True  # Modify this if possible to determine from the rnc.
         streams.append(SingleStream(tone_bin=tone_bin, tone_amplitude=tone_amplitude, tone_phase=tone_phase,
                                     tone_index=number, filterbank_bin=fpga_fft_bin_plus_one, epoch=epoch,
@@ -277,7 +278,7 @@ def sweeparray_from_rnc(rnc, sweep_group_index, description=''):
     tg = sg.timestream_group
     sweep_indices = np.unique(tg.sweep_index)
     start_epochs = np.unique(tg.epoch)
-    if not tg.data.shape == (sweep_indices.size * start_epochs.size, tg.num_data_samples):
+    if not tg.data_shape == (sweep_indices.size * start_epochs.size, tg.num_data_samples):
         raise ValueError("Data shape problem.")
     stream_arrays = []
     # Extract simultaneously-sampled data
@@ -293,7 +294,8 @@ def sweeparray_from_rnc(rnc, sweep_group_index, description=''):
         # All of the epochs are the same
         epoch = int(common(tg.epoch[simultaneous]))
         ssn = np.nan  # The sequence start numbers weren't saved.
-        s21_raw = tg.data[simultaneous, :][increasing_order]
+        # Read only the rows for this epoch.
+        s21_raw = tg.get_data_index(np.flatnonzero(simultaneous))[increasing_order]
         data_demodulated = True  # Modify this if possible to determine from the rnc.
         stream_arrays.append(StreamArray(tone_bin=tone_bin, tone_amplitude=amplitude, tone_phase=phase,
                                          tone_index=tone_index, filterbank_bin=fpga_fft_bin_plus_one, epoch=epoch,
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.measurement.io import nc, readoutnc
+from kid_readout.measurement.legacy import convert, read
+from kid_readout.measurement.test import utilities
+
+
+def assert_equal(converted, original):
+    # The sequence start numbers of legacy data are NaN, which is not equal to itself.
+    streams = [converted, original]
+    for measurement in (converted, original):
+        streams.extend(getattr(measurement, 'stream_arrays', []))
+    for stream in streams:
+        if hasattr(stream, 'sequence_start_number'):
+            assert np.isnan(stream.sequence_start_number)
+            stream.sequence_start_number = 0
+    assert converted == original
+
+
+def test_convert():
+    with TempDirectory() as directory:
+        rnc_filename = utilities.fake_legacy_file(directory.path)
+        output_filename = os.path.join(directory.path, 'converted' + nc.NCFile.EXTENSION)
+        names = convert.convert(rnc_filename, output_filename)
+        assert os.path.isfile(output_filename)
+        assert not os.path.exists(output_filename + convert.PARTIAL)
+        rnc = readoutnc.ReadoutNetCDF(rnc_filename)
+        io = nc.NCFile(output_filename)
+        assert names == rnc.sweeps_dict.keys() + rnc.timestreams_dict.keys()
+        sweep_array = io.read(rnc.sweeps_dict.keys()[0])
+        assert_equal(sweep_array, read.sweeparray_from_rnc(rnc, 0))
+        # Compare to indexing the whole data array, as the readers did before reading only the rows they need.
+        tg = rnc.sweeps[0].timestream_group
+        for stream_array, start_epoch in zip(sweep_array.stream_arrays, np.unique(tg.epoch)):
+            simultaneous = tg.epoch == start_epoch
+            increasing_order = tg.tonebin[simultaneous].argsort()
+            np.testing.assert_array_equal(stream_array.s21_raw, tg.data[simultaneous, :][increasing_order])
+        stream_array = io.read(rnc.timestreams_dict.keys()[0])
+        assert_equal(stream_array, read.streamarray_from_rnc(rnc, 0))
+        tg = rnc.timestreams[0]
+        np.testing.assert_array_equal(stream_array.s21_raw, tg.data[tg.tonebin.argsort(), :])
+        io.close()
+        rnc.close()
+
+
+def test_convert_files():
+    with TempDirectory() as directory:
+        input_directory = directory.makedir('input')
+        output_directory = directory.makedir('output')
+        rnc_filenames = []
+        # Legacy files are named using the time they were created, so create each in its own directory and rename it.
+        for number in range(2):
+            rnc_filename = os.path.join(input_directory, 'legacy{}.nc'.format(number))
+            os.rename(utilities.fake_legacy_file(directory.makedir(str(number)), seed=number), rnc_filename)
+            rnc_filenames.append(rnc_filename)
+        bad_filename = os.path.join(input_directory, 'bad.nc')
+        with open(bad_filename, 'w') as f:
+            f.write('not a netCDF file')
+        # A partial output left by an interrupted conversion is removed.
+        stale = os.path.join(output_directory, 'legacy0' + nc.NCFile.EXTENSION + convert.PARTIAL)
+        with open(stale, 'w') as f:
+            f.write('interrupted')
+        results = convert.convert_files(rnc_filenames + [bad_filename], output_directory, processes=2)
+        assert results[bad_filename] is None
+        assert sorted(os.listdir(output_directory)) == ['legacy0' + nc.NCFile.EXTENSION,
+                                                        'legacy1' + nc.NCFile.EXTENSION]
+        for rnc_filename in rnc_filenames:
+            rnc = readoutnc.ReadoutNetCDF(rnc_filename)
+            io = nc.NCFile(results[rnc_filename])
+            assert_equal(io.read(rnc.sweeps_dict.keys()[0]), read.sweeparray_from_rnc(rnc, 0))
+            io.close()
+            rnc.close()
+        # Files that were already converted are skipped.
+        modified = [os.path.getmtime(results[rnc_filename]) for rnc_filename in rnc_filenames]
+        assert convert.convert_files(rnc_filenames, output_directory) == dict((rnc_filename, results[rnc_filename])
+                                                                              for rnc_filename in rnc_filenames)
+        assert modified == [os.path.getmtime(results[rnc_filename]) for rnc_filename in rnc_filenames]
@@ -1,7 +1,9 @@
 import numpy as np
 import warnings
 
+from kid_readout.measurement import basic
 from kid_readout.measurement.test import utilities
+from kid_readout.analysis.resonator import equations, lmfit_resonator
 from kid_readout.analysis.timeseries import spectral_masks
 
 
@@ -27,6 +29,21 @@ def test_s21_raw_mean():
     np.testing.assert_allclose(s21_raw_mean[3], -50 + 0j)
 
 
+def test_decimate():
+    sa = utilities.fake_stream_array(num_tones=4)
+    sa.s21_raw = sa.s21_raw + np.arange(1, 5)[:, np.newaxis]
+    decimated = sa.decimate(8)
+    assert isinstance(decimated, basic.StreamArray)
+    assert decimated.s21_raw.shape == (4, sa.s21_raw.shape[1] // 8)
+    np.testing.assert_allclose(decimated.stream_sample_rate, sa.stream_sample_rate / 8)
+    np.testing.assert_allclose(decimated.decimate(2).stream_sample_rate, sa.stream_sample_rate / 16)
+    assert decimated.epoch < sa.epoch
+    # The filters have unit gain at zero frequency, so the mean is preserved away from the start-up transient.
+    np.testing.assert_allclose(decimated.s21_raw[:, 32:].mean(axis=1), sa.s21_raw[:, 256:].mean(axis=1), atol=0.05)
+    single = sa.stream(0).decimate(8)
+    np.testing.assert_allclose(single.s21_raw, decimated.s21_raw[0], rtol=1e-5)
+
+
 def test_s21_raw_mean_error():
     num_tones = 4
     num_samples = 128
@@ -122,6 +139,46 @@ class TestSweepArray(object):
     def test_start_epoch(self):
         assert self.sa.start_epoch() == self.sa.stream_arrays[0].epoch
 
+    def test_fit_resonators(self):
+        sa = utilities.fake_sweep_array(num_tones=4)
+        serial = sa.fit_resonators()
+        assert len(serial) == sa.num_channels
+        assert np.all(np.isfinite(serial.f_0))
+        for number in range(sa.num_channels):
+            sweep = sa.sweep(number)
+            assert sweep._resonator is sa.resonators[number]
+            np.testing.assert_array_equal(sweep.resonator.frequency, sweep.frequency)
+            np.testing.assert_array_equal(sweep.resonator.s21, sweep.s21_point)
+            np.testing.assert_array_equal(sweep.resonator.errors, sweep.s21_point_error)
+        parallel = sa.fit_resonators(workers=2)
+        # The resonators are restored from the fits done by the worker processes, which are the same as the serial fits.
+        np.testing.assert_allclose(parallel.f_0, serial.f_0)
+        np.testing.assert_allclose(parallel.Q, serial.Q, rtol=1e-6)
+        np.testing.assert_allclose(parallel.Q_error, serial.Q_error, rtol=1e-6)
+        np.testing.assert_allclose(parallel.redchi, serial.redchi, rtol=1e-6)
+        for resonator in sa.resonators:
+            np.testing.assert_allclose(resonator.current_result.best_fit, resonator.eval())
+
+    def test_fit_resonators_warm_start(self):
+        sa = utilities.fake_sweep_array(num_tones=4)
+        # Replace the noise with resonances that are not centered in the sweeps.
+        random = np.random.RandomState(0)
+        for stream_array in sa.stream_arrays:
+            f = stream_array.frequency
+            f_0 = np.linspace(100e6, 200e6, f.size) + 20e3
+            s21 = equations.linear_resonator(f, f_0, 2e3, 4e3, 5e2)
+            noise = random.randn(*stream_array.s21_raw.shape) + 1j * random.randn(*stream_array.s21_raw.shape)
+            stream_array.s21_raw = (s21[:, np.newaxis] + 0.01 * noise).astype(stream_array.s21_raw.dtype)
+        np.testing.assert_allclose(sa.fit_resonators().Q, 2e3, rtol=0.01)
+        cold = [resonator.current_result.nfev for resonator in sa.resonators]
+        cache = lmfit_resonator.ParameterCache()
+        for resonator, tone_index in zip(sa.resonators, sa.stream_arrays[0].tone_index):
+            cache.put(resonator, key=tone_index)
+        for workers in [1, 2]:
+            sa.fit_resonators(workers=workers, cache=cache)
+            warm = [resonator.current_result.nfev for resonator in sa.resonators]
+            assert all(w < c for w, c in zip(warm, cold)), (warm, cold)
+
 
 class TestSingleSweep(object):
 
@@ -181,7 +238,7 @@ class TestSingleSweepStream(object):
         self.sss.set_S()
         with warnings.catch_warnings(record=True) as ws:
             warnings.simplefilter('always')
-            self.sss.set_pca()  # This raises 40 ComplexWarnings
+            self.sss.set_pca()  # Any warnings should be ComplexWarnings
             for w in ws:
                 assert issubclass(w.category, np.ComplexWarning)
         for attr in memoized:
@@ -198,7 +255,90 @@ class TestSingleSweepStream(object):
         self.sss.stream.tone_offset_frequency()
         self.sss.stream.tone_offset_frequency(normalized_frequency=False)
 
+    def test_accumulate_S(self):
+        sss = utilities.fake_single_sweep_stream(stream_length_seconds=0.1)
+        sss._x = sss.x_raw
+        sss._q = sss.q_raw
+        sss.set_S(binned=False)
+        accumulator = sss.accumulate_S(chunk_size=1000)
+        np.testing.assert_allclose(accumulator.f[1:-1], sss.S_frequency)
+        np.testing.assert_allclose(accumulator.S[0, 0, 1:-1].real, sss.S_xx, rtol=1e-8)
+        np.testing.assert_allclose(accumulator.S[1, 1, 1:-1].real, sss.S_qq, rtol=1e-8)
+        np.testing.assert_allclose(accumulator.S[0, 1, 1:-1], sss.S_xq, rtol=1e-8)
+
     def test_spectral_mask(self):
         self.sss.set_S(masking_function=spectral_masks.pulse_tube_mask)
+        self.sss.set_S()
+        edges = self.sss._S_edges
+        counts = self.sss.S_counts.sum()
+        masking_function = spectral_masks.combine(spectral_masks.pulse_tube_mask, spectral_masks.mains_mask)
+        self.sss.set_S(masking_function=masking_function, notch_frequencies=[60.])
+        # The masked frequencies are removed from the same bins.
+        np.testing.assert_array_equal(self.sss._S_edges, edges)
+        assert np.all(self.sss.S_counts > 0)
+        assert self.sss.S_counts.sum() == counts - np.sum(~self.sss._S_mask[1:-1])
+
+
+class TestSweepStreamArray(object):
+
+    def test_compute_spectra(self):
+        ssa = utilities.fake_sweep_stream_array(num_tones=4, stream_length_seconds=0.1)
+        table = ssa.compute_spectra(deglitch=False, channels_per_block=3)
+        assert set(table.number) == set(range(ssa.num_channels))
+        for number in range(ssa.num_channels):
+            if ssa.sweep_array.resonators[number] is None:
+                continue
+            sss = ssa.sweep_stream(number)
+            sss._x = sss.x_raw
+            sss._q = sss.q_raw
+            sss.set_S()
+            rows = table[table.number == number]
+            np.testing.assert_allclose(rows.frequency, sss.S_frequency)
+            np.testing.assert_array_equal(rows.counts, sss.S_counts)
+            for name in ['S_xx', 'S_qq', 'S_xq', 'S_xx_variance', 'S_qq_variance']:
+                np.testing.assert_allclose(rows[name], getattr(sss, name), rtol=1e-8)
+        parallel = ssa.compute_spectra(deglitch=False, channels_per_block=1, workers=2)
+        np.testing.assert_allclose(parallel.S_xx, table.S_xx, rtol=1e-12)
+        threaded = ssa.compute_spectra(channels_per_block=1, workers=2, threads=True, binned=False)
+        assert threaded.pivot('number', 'frequency', 'S_qq').shape[0] == ssa.num_channels
+
+
+class TestScan(object):
+
+    @classmethod
+    def setup(cls):
+        cls.sweep_arrays = [utilities.fake_sweep_array(num_tones=4, num_waveforms=8) for _ in range(2)]
+
+    def test_merge(self):
+        first, second = self.sweep_arrays
+        scan = basic.Scan(self.sweep_arrays)
+        np.testing.assert_array_equal(scan.frequency, first.frequency)
+        weight_1 = 1 / first.s21_point_error.real ** 2
+        weight_2 = 1 / second.s21_point_error.real ** 2
+        np.testing.assert_allclose(scan.s21_point.real, (weight_1 * first.s21_point.real +
+                                                         weight_2 * second.s21_point.real) / (weight_1 + weight_2))
+        np.testing.assert_allclose(scan.s21_point_error.real, 1 / np.sqrt(weight_1 + weight_2))
+        frequency, amplitude, smoothed = scan.stitch(kernel=np.ones(3) / 3)
+        np.testing.assert_array_equal(amplitude, np.abs(scan.s21_point))
 
+    def test_append(self):
+        scan = basic.Scan(self.sweep_arrays[:1])
+        frequency = scan.frequency
+        merge = scan._merges['point']
+        scan.append(self.sweep_arrays[1])
+        assert scan._merges['point'] is merge and merge.count == 2
+        full = basic.Scan(self.sweep_arrays)
+        np.testing.assert_array_equal(scan.frequency, frequency)
+        np.testing.assert_allclose(scan.s21_point, full.s21_point)
+        scan._delete_memoized_property_caches()
+        np.testing.assert_allclose(scan.s21_point, full.s21_point)
 
+    def test_weighted_merge(self):
+        merge = basic._WeightedMerge(tolerance=1e-3)
+        merge.add(np.array([3., 1., 2.]), np.array([3, 1, 2j]), np.ones(3) * (1 + 1j))
+        # These overlap the first points at 2 and 3 and extend the range; the first point at 2.5 is a duplicate.
+        merge.add(np.array([2.0001, 2.5, 2.5, 3, 4]), np.array([4j, 1, 3, 1, 4]), np.array([1, 1, 1, 0.5, 1]) * (1 + 1j))
+        np.testing.assert_array_equal(merge.frequency, [1, 2, 2.5, 3, 4])
+        np.testing.assert_allclose(merge.s21, [1, 3j, 2, 1.4, 4])
+        np.testing.assert_allclose(merge.s21_error, np.array([1, 1 / np.sqrt(2), 1 / np.sqrt(2), 1 / np.sqrt(5), 1]) *
+                                   (1 + 1j))
@@ -91,6 +91,48 @@ def test_read_write():
     assert original == io.read(name)
 
 
+def test_read_write_batch():
+    io = memory.Dictionary()
+    original = utilities.fake_sweep_array()
+    name = 'sweep_array'
+    io.write(original, name, batch=True)
+    first = core.join(name, 'stream_arrays', '0')
+    assert not isinstance(io.read_other(first, 'roach_state'), basestring)
+    for n in range(1, len(original.stream_arrays)):
+        stored = io.read_other(core.join(name, 'stream_arrays', str(n)), 'roach_state')
+        assert stored == core.REFERENCE + core.join('/', first, 'roach_state')
+    assert original == io.read(name)
+
+
+def test_read_write_reference_prefix_string():
+    for batch in [False, True]:
+        io = memory.Dictionary()
+        original = utilities.fake_sweep_array()
+        original.description = core.REFERENCE + '/not/a/node'
+        name = 'sweep_array'
+        io.write(original, name, batch=batch)
+        assert original == io.read(name)
+        assert io.read(name).description == original.description
+
+
+def test_read_workers():
+    io = memory.Dictionary()
+    original = utilities.fake_sweep_stream_array()
+    name = 'ssa'
+    io.write(original, name)
+    ssa = io.read(name, workers=4)
+    assert original == ssa
+    for number, stream_array in enumerate(ssa.sweep_array.stream_arrays):
+        assert stream_array._io is io
+        assert stream_array.io_node_path == core.join('/', name, 'sweep_array', 'stream_arrays', str(number))
+
+
+def test_fingerprint():
+    assert core._fingerprint({'a': 1, 'b': [1, 2]}) == core._fingerprint({'b': [1, 2], 'a': 1})
+    assert core._fingerprint({'a': 1}) != core._fingerprint({'a': True})
+    assert core._fingerprint({'a': 1}) != core._fingerprint({'a': 1.})
+
+
 def test_eq_state():
     m1 = utilities.CornerCases()
     m2 = utilities.CornerCases()
@@ -4,6 +4,7 @@ This module contains helper functions and data structures for running tests.
 import numpy as np
 
 from kid_readout.measurement import core, basic, acquire
+from kid_readout.measurement.io import data_block, data_file
 from kid_readout.roach import baseband  # TODO: incorporate heterodyne, r2heterodyne
 from kid_readout.roach.tests import mock_roach, mock_valon
 
@@ -139,3 +140,41 @@ def fake_single_sweep_stream(sweep_num_waveforms=16, sweep_num_tone_samples=2 **
                                   stream_num_tone_samples=stream_num_tone_samples,
                                   stream_length_seconds=stream_length_seconds, state=state, description=description)
     return ssa[0]
+
+
+def fake_legacy_file(directory, num_tones=4, num_steps=5, num_samples=2 ** 10, num_stream_samples=2 ** 12,
+                     seed=0):
+    """
+    Write a small legacy ReadoutNetCDF file in the given directory, with one sweep and one timestream and hardware states
+    that change between and during them, and return its filename.
+    """
+    random = np.random.RandomState(seed)
+    df = data_file.DataFile(base_dir=directory)
+    nfft = 2 ** 14
+    tone_nsamp = 2 ** 16
+    fs = 512.
+    tone_bins = random.permutation(np.arange(1000, 1000 + 100 * num_tones, 100))  # Roach FPGA order is not sorted.
+    sweep = data_block.SweepData()
+    # Each step of the sweep shifts all of the tones, and the sweep index of each block is its tone number.
+    for step in range(num_steps):
+        for sweep_index, tone_bin in enumerate(tone_bins):
+            sweep.add_block(data_block.DataBlock(
+                data=(random.randn(num_samples) + 1j * random.randn(num_samples)).astype('complex64'),
+                tone=tone_bin + step, fftbin=tone_bin // 4, nsamp=tone_nsamp, nfft=nfft, wavenorm=0.5,
+                t0=1000. + 10 * step, fs=fs, sweep_index=sweep_index))
+    df.add_sweep(sweep)
+    tsg = None
+    for tone_bin in tone_bins:
+        tsg = df.add_block_to_timestream(data_block.DataBlock(
+            data=(random.randn(num_stream_samples) + 1j * random.randn(num_stream_samples)).astype('complex64'),
+            tone=tone_bin, fftbin=tone_bin // 4, nsamp=tone_nsamp, nfft=nfft, wavenorm=0.25, t0=1100., fs=fs),
+            tsg=tsg)
+    # The modulation state changes during the sweep.
+    df.hw_epoch[:] = np.array([990., 1015., 1030., 1095.])
+    df.hw_adc_atten[:] = np.array([10., 10., 20., 20.])
+    df.hw_dac_atten[:] = np.array([30., 30., 30., 40.])
+    df.hw_ntones[:] = num_tones * np.ones(4, dtype=int)
+    df.hw_modulation_rate[:] = np.array([0, 7, 3, 5])
+    df.hw_modulation_output[:] = np.array([0, 2, 1, 2])
+    df.close()
+    return df.filename
@@ -27,12 +27,14 @@ def frequency(roach_state, tone_bin):
 
 
 def stream_sample_rate(roach_state):
+    # Data that has been decimated after acquisition records the total decimation factor in the state.
+    decimation_factor = roach_state.get('decimation_factor', 1)
     if roach_state['heterodyne']:
         # In the heterodyne case, the number of complex samples per FFT is just num_filterbank_channels.
-        return roach_state['adc_sample_rate'] / roach_state['num_filterbank_channels']
+        return roach_state['adc_sample_rate'] / (roach_state['num_filterbank_channels'] * decimation_factor)
     else:
         # In the baseband case, the number of real samples per FFT is 2 * num_filterbank_channels.
-        return roach_state['adc_sample_rate'] / (2 * roach_state['num_filterbank_channels'])
+        return roach_state['adc_sample_rate'] / (2 * roach_state['num_filterbank_channels'] * decimation_factor)
 
 def modulation_period_samples(roach_state):
     if roach_state.modulation_output != 2: